@@ -134,12 +134,13 @@ class _LinkedAction(object):
 
     def link_to(self, source, **kwargs):
         from kervi.values.kervi_value import KerviValue
+        from kervi.values.value_batch import register_value_changed_handler
         if isinstance(source, KerviValue):
             source.add_observer(self)
             self._spine_observers[source.value_id] = kwargs
             
         elif isinstance(source, str):
-            self.spine.register_event_handler("valueChanged", self._link_changed_event, source)
+            register_value_changed_handler(self.spine, self._link_changed_event, source)
             self._spine_observers[source] = kwargs
 
     def kervi_value_changed(self, source, value):
@@ -651,12 +652,13 @@ class Action(KerviComponent):
 
         """
         from kervi.values.kervi_value import KerviValue
+        from kervi.values.value_batch import register_value_changed_handler
         if isinstance(source, KerviValue):
             source.add_observer(self)
             self._spine_observers[source.value_id] = kwargs
             
         elif isinstance(source, str):
-            self.spine.register_event_handler("valueChanged", self._link_changed_event, source)
+            register_value_changed_handler(self.spine, self._link_changed_event, source)
 
             self._spine_observers[source] = kwargs
 
@@ -3,7 +3,7 @@
 
 import time
 from kervi.controllers import Controller
-from kervi.values import NumberValue, BooleanValue
+from kervi.values import NumberValue, BooleanValue, batch
 from kervi.actions import action
 from kervi.controllers import Controller
 class MotorSteering(Controller):
@@ -48,8 +48,9 @@ class MotorSteering(Controller):
     @action
     def stop(self, **kwargs):
         coast = kwargs.pop("break", True)
-        self.outputs["left_speed"].value = 0
-        self.outputs["right_speed"].value = 0
+        with batch():
+            self.outputs["left_speed"].value = 0
+            self.outputs["right_speed"].value = 0
 
     @action
     def rotate(self, **kwargs):
@@ -62,8 +63,9 @@ class MotorSteering(Controller):
         left_speed = speed * (-new_direction / 100)
         right_speed = speed * (new_direction / 100)
 
-        self.outputs["left_speed"].value = left_speed
-        self.outputs["right_speed"].value = right_speed
+        with batch():
+            self.outputs["left_speed"].value = left_speed
+            self.outputs["right_speed"].value = right_speed
         if duration:
             time.sleep(duration)
 
@@ -82,8 +84,9 @@ class MotorSteering(Controller):
             left_speed = speed
             right_speed = speed
 
-        self.outputs["left_speed"].value = left_speed
-        self.outputs["right_speed"].value = right_speed
+        with batch():
+            self.outputs["left_speed"].value = left_speed
+            self.outputs["right_speed"].value = right_speed
 
     def input_changed(self, changed_input):
         if changed_input in [self.speed, self.direction, self.adaptive_speed]:
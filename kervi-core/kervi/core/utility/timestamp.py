@@ -0,0 +1,27 @@
+#Copyright 2017 Tim Wentlau.
+#Distributed under the MIT License. See LICENSE in root of project.
+
+"""
+Value changes carry the time of the change as seconds since epoch (time.time()).
+The timestamp is only formatted where it leaves the application, in the UI and in storage.
+"""
+
+try:
+    from datetime import datetime
+except:
+    from kervi.core.utility.udatetime import datetime
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def format_timestamp(timestamp, timestamp_format=TIMESTAMP_FORMAT, milliseconds=False):
+    """
+    Formats an epoch timestamp as utc time, with the milliseconds appended if milliseconds is True.
+    Timestamps that are already formatted are returned as they are.
+    """
+    if isinstance(timestamp, (int, float)):
+        utc_time = datetime.utcfromtimestamp(timestamp)
+        result = utc_time.strftime(timestamp_format)
+        if milliseconds:
+            result += ".%03d" % (getattr(utc_time, "microsecond", 0) // 1000)
+        return result
+    return timestamp
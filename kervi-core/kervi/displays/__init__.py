@@ -11,6 +11,7 @@ from kervi.controllers import Controller
 from kervi.values import *
 from kervi.sensors import Sensor
 from kervi.values.value_list import ValueList
+from kervi.values.value_batch import register_value_changed_handler
 from kervi.actions import action 
 from PIL import Image, ImageDraw
 
@@ -257,7 +258,7 @@ class _DisplayLink:
 class DisplayPage(Controller):
     def __init__(self, page_id, name = None):
         Controller.__init__(self, page_id, name)
-        self.spine.register_event_handler("valueChanged", self._link_changed_event)
+        register_value_changed_handler(self.spine, self._link_changed_event)
         self._template = ""
         self._links = {}
         self._displays = []
@@ -11,7 +11,7 @@ import time
 from kervi.controllers import Controller
 from kervi.core.utility.thread import KerviThread
 from kervi.spine import Spine
-from kervi.values import NumberValue, ColorValue, KerviValue
+from kervi.values import NumberValue, ColorValue, KerviValue, batch
 from kervi.config import Configuration
 #from kervi.actions import action
 #from kervi.settings import Settings
@@ -224,9 +224,10 @@ class Sensor(Controller):
             return
         
         if self._dimensions > 1:
-            for dimension in range(0, self._dimensions):
-                value = sensor_value[dimension]
-                self._sub_sensors[dimension]._new_sensor_reading(value)
+            with batch():
+                for dimension in range(0, self._dimensions):
+                    value = sensor_value[dimension]
+                    self._sub_sensors[dimension]._new_sensor_reading(value)
         else:
             self._sensor_value.value = sensor_value
             
@@ -279,6 +280,13 @@ class Sensor(Controller):
 
         :type event_type: ``str``
 
+        :Keyword Arguments:
+
+            * *hysteresis* (``float``) -- After the event is triggered it is not triggered again
+                before the value has moved this much back past the threshold. Default 0.
+
+            * *cooldown* (``float``) -- Minimum number of seconds between two triggers of the event. Default 0.
+
         """
         self._sensor_value.add_value_event(event_value, func, event_type, parameters, **kwargs)
     
@@ -29,6 +29,9 @@ def stream_observer(method=None, **kwargs) -> StreamObserver:
         def my_observer(stream_id, stream_event, stream_data)
             ...
 
+        stream_data is a read only memoryview of the data, its buffer is not reused
+        so the view can be kept after the observer returns.
+
         :Keyword Arguments:
 
             * *observer_id* (``str``) -- 
@@ -8,6 +8,9 @@ except:
     from kervi.core.utility.udatetime import datetime
 
 from kervi.values.kervi_value import KerviValue
+from kervi.values.units import units_available, get_converter
+from kervi.values.sparkline import Sparkline
+from kervi.values.value_batch import batch
 from kervi.core.utility.component import KerviComponent
 from kervi.config import Configuration
 
@@ -19,18 +22,9 @@ class NumberValue(KerviValue):
     If is an output it is possible to specify different kinds of gauges.
     """
     def __init__(self, name, **kwargs):
-        self._q_unit = None
-        self._q_display = None
+        self._converter = None
         self._min_value = -100
         self._max_value = 100
-        
-        try:
-            from pint import UnitRegistry
-            self._ureg = UnitRegistry()
-            self._ureg.autoconvert_offset_to_baseunit = True
-            self._Q = self._ureg.Quantity
-        except ImportError:
-            self._Q = None
 
         KerviValue.__init__(self, name, "number-value", **kwargs)
         #self.spine = Spine()
@@ -80,6 +74,10 @@ class NumberValue(KerviValue):
         self._ui_parameters["display_unit"] = True
 
         self._last_reading = None
+        self._sparkline = Sparkline(kwargs.get("sparkline_size", 100))
+        self._sparkline_points = 10
+        # Each value has its own query so a request is only handled by the value it asks for
+        self.spine.register_query_handler("getSparkline:" + self.component_id, self._query_sparkline, groups=self.user_groups)
 
     @property
     def delta(self):
@@ -121,6 +119,22 @@ class NumberValue(KerviValue):
 
     
 
+    @property
+    def sparkline_size(self):
+        """
+        Number of readings kept in memory for sparklines and real time charts.
+
+        :type: ``int``
+        """
+        return self._sparkline.size
+
+    @sparkline_size.setter
+    def sparkline_size(self, value):
+        sparkline = Sparkline(value)
+        for timestamp, reading in zip(*self._sparkline.readings()):
+            sparkline.append(reading, timestamp)
+        self._sparkline = sparkline
+
     @property
     def type(self):
         """
@@ -143,45 +157,26 @@ class NumberValue(KerviValue):
         """
         if self._display_unit:
             return self._display_unit
-        elif self._Q:
+        elif units_available():
             config = Configuration.display.unit_systems
             default_system = Configuration.unit_system
             units = config.systems[default_system]
 
             self._display_unit = units.get(self._type, self._unit)
+            self._converter = get_converter(self._unit, self._display_unit, self._type)
 
-            if self._type == "temperature":
-                from_unit = "deg" + self._unit.upper()
-                to_unit = "deg" + self._display_unit.upper()
-            else:
-                from_unit = self._unit
-                to_unit = self._display_unit
-
-            self._q_unit = self._Q("1 " + from_unit)
-            self._q_display = self._Q("1 " + to_unit)
-            
-            
         return self._display_unit
 
     @display_unit.setter
     def display_unit(self, value):
         if value != self._display_unit:
             self._display_unit = value
-            if self._type == "temperature":
-                from_unit = "deg" + self._unit.upper()
-                to_unit = "deg" + self._display_unit.upper()
-            else:
-                from_unit = self._unit
-                to_unit = self.display_unit
-
-            self._q_unit = self._ureg.parse_expression(from_unit)
-            self._q_display = self._ureg.parse_expression(to_unit)
+            self._converter = get_converter(self._unit, self._display_unit, self._type)
 
     @property
     def display_value(self):
-        if self._q_display and self._q_unit:
-            dv = self._value * self._q_unit
-            return round(dv.to(self._q_display).magnitude, 3)
+        if self._converter and self._value is not None:
+            return round(self._converter(self._value), 3)
         else:
             if self._value:
                 return round(self._value, 3)
@@ -197,9 +192,13 @@ class NumberValue(KerviValue):
             "minValue":self._min_value,
             "command":self.command,
             "ranges":self._event_ranges,
-            "sparkline":self._sparkline,
+            "sparkline":self._sparkline.last(self._sparkline_points),
         }
 
+    def _query_sparkline(self, date_from=None, date_to=None, points=None, method="lttb"):
+        """ Readings kept in memory between the epoch timestamps date_from and date_to downsampled to points """
+        return self._sparkline.query(date_from, date_to, points, method)
+
     def __delta_exceeded(self, value):
         if self._delta is None:
             return True
@@ -223,45 +222,12 @@ class NumberValue(KerviValue):
             )
             old_value = self._value
             self._value = new_value
-            self.value_changed(new_value, old_value)
-            for observer in self._observers:
-                if isinstance(observer, tuple):
-                    item, transformation = observer
-                    if transformation:
-                        item.kervi_value_changed(self, transformation(new_value))
-                    else:
-                        item.kervi_value_changed(self, new_value)
-                else:
-                    observer.kervi_value_changed(self, new_value)
-
-            self._check_value_events(new_value, old_value)
-            if self._persist_value and allow_persist:
-                self.settings.store_value("value", self.value)
-
-            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            if len(self._sparkline) == 0:
-                self._sparkline += [{"timestamp":timestamp, "value":new_value}]
-            elif len(self._sparkline) >= 10:
-                self._sparkline.pop(0)
-            self._sparkline += [{"timestamp":timestamp, "value":new_value}]
-            self._last_reading = time.clock()
+            self._commit_change(new_value, old_value, allow_persist)
 
-            
-            val = {
-                "id":self.component_id,
-                "value":new_value,
-                "timestamp":timestamp,
-                "display_value": self.display_value,
-                "display_unit": self.display_unit
-            }
-            self.spine.trigger_event(
-                "valueChanged",
-                self.component_id,
-                val,
-                self._log_values,
-                groups=self.user_groups
-            )
-            
+    def _notify_change(self, new_value, old_value, allow_persist, timestamp):
+        KerviValue._notify_change(self, new_value, old_value, allow_persist, timestamp)
+        self._sparkline.append(new_value, timestamp)
+        self._last_reading = timestamp
 
     def link_to_dashboard(self, dashboard_id=None, panel_id=None, **kwargs):
         r"""
@@ -541,6 +507,9 @@ class EnumValue(KerviValue):
             "value":self.value
         }
 
+    def _change_payload(self, value, timestamp):
+        return {"id":self.component_id, "value":value, "timestamp":timestamp}
+
     def _set_value(self, selected_options, allow_persist=True):
         self.spine.log.debug(
             "enum value changed:{0}",
@@ -563,33 +532,7 @@ class EnumValue(KerviValue):
         old_value = self._value
         new_value = selected
         self._value = new_value
-        self.value_changed(new_value, old_value)
-
-        for observer in self._observers:
-            if isinstance(observer, tuple):
-                item, transformation = observer
-                if transformation:
-                    item.kervi_value_changed(self, transformation(new_value))
-                else:
-                    item.kervi_value_changed(self, new_value)
-            else:
-                observer.kervi_value_changed(self, new_value)
-
-        if self._persist_value and allow_persist:
-            self.settings.store_value("value", self.value)
-
-        #timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        self._last_reading = time.clock()
-
-        #val = {"value_id":self.component_id, "value":new_value, "timestamp":datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")}
-        
-        self.spine.trigger_event(
-            "valueChanged",
-            self.component_id,
-            {"id":self.component_id, "value":new_value, "timestamp":datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")},
-            self._log_values,
-            groups=self.user_groups
-        )
+        self._commit_change(new_value, old_value, allow_persist)
 
     
         
@@ -1,14 +1,12 @@
 #Copyright 2017 Tim Wentlau.
 #Distributed under the MIT License. See LICENSE in root of project.
 
-try:
-    from datetime import datetime
-except:
-    from kervi.core.utility.udatetime import datetime
-
+import time
 from kervi.core.utility.component import KerviComponent
 from kervi.core.utility.schedule import default_scheduler
 from kervi.values.value_job import ValueJob
+from kervi.values.threshold_index import ThresholdIndex
+from kervi.values.value_batch import current_batch, register_value_changed_handler
 from kervi.actions import Actions
 VALUE_COUNTER = 0
 class KerviValue(KerviComponent):
@@ -41,6 +39,7 @@ class KerviValue(KerviComponent):
         self._sparkline = []
         self._observers = []
         self._value_event_handlers = []
+        self._value_event_index = ThresholdIndex()
         if parent:
             self._observers += [parent]
         self._spine_observers = {}
@@ -204,7 +203,7 @@ class KerviValue(KerviComponent):
                 raise Exception("input/output mismatch in kervi value link:{0} - {1}".format(source.name, self.name))
         elif isinstance(source, str):
             if len(self._spine_observers) == 0:
-                self.spine.register_event_handler("valueChanged", self._link_changed_event)
+                register_value_changed_handler(self.spine, self._link_changed_event)
 
             self._spine_observers[source] = transformation
 
@@ -273,40 +272,67 @@ class KerviValue(KerviComponent):
 
             old_value = self.value
             self._value = nvalue
+            self._commit_change(nvalue, old_value, allow_persist)
+
+    def _commit_change(self, new_value, old_value, allow_persist=True):
+        """ Notifies observers and publishes a change, inside a batch it is done when the batch ends """
+        batch = current_batch()
+        if batch:
+            batch.add(self, old_value, allow_persist)
+            return
+        timestamp = time.time()
+        self._notify_change(new_value, old_value, allow_persist, timestamp)
+        self._publish_change(new_value, timestamp)
+
+    def _notify_change(self, new_value, old_value, allow_persist, timestamp):
+        """ Runs value_changed, observers, value events and persistence of a change """
+        try:
+            self.value_changed(new_value, old_value)
+        except Exception as Ex:
+            self.spine.log.exception("Error in value changed")
+
+        for observer in self._observers:
             try:
-                self.value_changed(nvalue, old_value)
-            except Exception as Ex:
-                self.spine.log.exception("Error in value changed")
-            
-            for observer in self._observers:
-                try:
+                if isinstance(observer, tuple):
                     item, transformation = observer
                     if transformation:
-                        item.kervi_value_changed(self, transformation(nvalue))
+                        item.kervi_value_changed(self, transformation(new_value))
                     else:
-                        item.kervi_value_changed(self, nvalue)
-                except Exception:
-                    self.spine.log.exception("error in value observer:")
-
-            self._check_value_events(nvalue, old_value)
-
-            if self._persist_value and allow_persist:
-                self.settings.store_value("value", self.value)
-
-            val = {
-                "id":self.component_id,
-                "value":nvalue,
-                "timestamp":datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                "display_value": self.display_value,
-                "display_unit": self.display_unit
-            }
-            self.spine.trigger_event(
-                "valueChanged",
-                self.component_id,
-                val,
-                self._log_values,
-                groups=self.user_groups
-            )
+                        item.kervi_value_changed(self, new_value)
+                else:
+                    observer.kervi_value_changed(self, new_value)
+            except Exception:
+                self.spine.log.exception("error in value observer:")
+
+        self._check_value_events(new_value, old_value)
+
+        if self._persist_value and allow_persist:
+            self.settings.store_value("value", self.value)
+
+    def _publish_change(self, value, timestamp):
+        """
+        Sends the valueChanged event. The timestamp is seconds since epoch and is formatted
+        by the UI and storage, the payload is not built if no component handles the event.
+        """
+        has_subscribers = getattr(self.spine, "has_event_subscribers", None)
+        if has_subscribers and not has_subscribers("valueChanged", self.component_id):
+            return
+        self.spine.trigger_event(
+            "valueChanged",
+            self.component_id,
+            self._change_payload(value, timestamp),
+            self._log_values,
+            groups=self.user_groups
+        )
+
+    def _change_payload(self, value, timestamp):
+        return {
+            "id":self.component_id,
+            "value":value,
+            "timestamp":timestamp,
+            "display_value": self.display_value,
+            "display_unit": self.display_unit
+        }
 
     def kervi_value_changed(self, source, value):
         self._set_value(value, False)
@@ -335,8 +361,19 @@ class KerviValue(KerviComponent):
 
         :type event_type: ``str``
 
+        :Keyword Arguments:
+
+            * *hysteresis* (``float``) -- After the event is triggered it is not triggered again
+                before the value has moved this much back past the threshold. Default 0.
+
+            * *cooldown* (``float``) -- Minimum number of seconds between two triggers of the event. Default 0.
+
         """
+        hysteresis = kwargs.pop("hysteresis", 0)
+        cooldown = kwargs.pop("cooldown", 0)
         self._value_event_handlers += [(event_value, func, event_type, parameters, kwargs)]
+        if func:
+            self._value_event_index.add(event_value, func, parameters, kwargs, hysteresis, cooldown)
 
 
     def _handle_range_event(self, value, message, func, level, **kwargs):
@@ -396,20 +433,10 @@ class KerviValue(KerviComponent):
         self.add_value_event(value, self._handle_range_event, event_type="error", parameters=[message, func, 1], **kwargs)
 
     def _check_value_events(self, new_value, old_value):
-        for event in self._value_event_handlers:
-            value, func, event_type, parameters, kwargs = event
-            if func:
-                if isinstance(value, tuple):
-                    value_start, value_end = value
-                    if old_value < value_start and new_value >= value_start:
-                        func(self, *parameters, **kwargs)
-                    elif old_value > value_end and new_value <= value_end:
-                        func(self, *parameters, **kwargs)
-                else:
-                    if old_value < value and new_value >= value:
-                        func(self, *parameters, **kwargs)
-                    elif old_value > value and new_value <= value:
-                        func(self, *parameters, **kwargs)
+        if not self._value_event_index:
+            return
+        for event in self._value_event_index.crossed(old_value, new_value):
+            event.func(self, *event.parameters, **event.kwargs)
 
     @property
     def _event_ranges(self):
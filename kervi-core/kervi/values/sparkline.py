@@ -0,0 +1,162 @@
+#Copyright 2017 Tim Wentlau.
+#Distributed under the MIT License. See LICENSE in root of project.
+
+"""
+In memory history of a number value used for sparklines and real time charts.
+
+The readings are kept in a ring buffer of two arrays with epoch timestamps and values,
+so a value can keep thousands of readings without allocating an object per reading.
+A window of the history is downsampled to the number of points a chart can show.
+"""
+
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from kervi.core.utility.timestamp import format_timestamp
+
+def _bucket_bounds(count, buckets):
+    """ Splits count points in buckets of almost the same size, returns a list of (start, end) """
+    size = count / float(buckets)
+    return [(int(i * size), int((i + 1) * size)) for i in range(buckets)]
+
+def downsample_min_max(timestamps, values, points):
+    """ Keeps the lowest and highest reading of each bucket in the order they were read """
+    result = []
+    for start, end in _bucket_bounds(len(values), max(1, points // 2)):
+        if start == end:
+            continue
+        low = high = start
+        for i in range(start + 1, end):
+            if values[i] < values[low]:
+                low = i
+            elif values[i] > values[high]:
+                high = i
+        result += sorted(set([low, high]))
+    return [timestamps[i] for i in result], [values[i] for i in result]
+
+def _downsample_bucket(timestamps, values, points, select):
+    result = []
+    for start, end in _bucket_bounds(len(values), points):
+        if start < end:
+            result += [select(range(start, end), key=values.__getitem__)]
+    return [timestamps[i] for i in result], [values[i] for i in result]
+
+def downsample_min(timestamps, values, points):
+    return _downsample_bucket(timestamps, values, points, min)
+
+def downsample_max(timestamps, values, points):
+    return _downsample_bucket(timestamps, values, points, max)
+
+def downsample_lttb(timestamps, values, points):
+    """ Largest triangle three buckets, keeps the readings that form the shape of the curve """
+    count = len(values)
+    if points >= count or points < 3:
+        return list(timestamps), list(values)
+
+    result = [0]
+    bucket_size = (count - 2) / float(points - 2)
+    selected = 0
+    for bucket in range(points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        # The average point of the next bucket is the third corner of the triangle
+        next_start = end
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        next_count = next_end - next_start
+        average_time = sum(timestamps[next_start:next_end]) / next_count
+        average_value = sum(values[next_start:next_end]) / next_count
+
+        selected_time = timestamps[selected]
+        selected_value = values[selected]
+        max_area = -1
+        next_selected = start
+        for i in range(start, end):
+            area = abs(
+                (selected_time - average_time) * (values[i] - selected_value) -
+                (selected_time - timestamps[i]) * (average_value - selected_value)
+            )
+            if area > max_area:
+                max_area = area
+                next_selected = i
+        selected = next_selected
+        result += [selected]
+    result += [count - 1]
+    return [timestamps[i] for i in result], [values[i] for i in result]
+
+DOWNSAMPLE_METHODS = {
+    "lttb": downsample_lttb,
+    "minmax": downsample_min_max,
+    "min": downsample_min,
+    "max": downsample_max
+}
+
+class Sparkline(object):
+    """ Ring buffer that holds the last size readings of a value """
+    def __init__(self, size=100):
+        self._size = max(1, size)
+        self._timestamps = array("d", bytes(8 * self._size))
+        self._values = array("d", bytes(8 * self._size))
+        self._next = 0
+        self._count = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, timestamp=None):
+        if value is None:
+            return
+        index = self._next
+        self._timestamps[index] = time.time() if timestamp is None else timestamp
+        self._values[index] = value
+        self._next = (index + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def readings(self):
+        """ Returns (timestamps, values) of the readings, oldest first """
+        if self._count < self._size:
+            return self._timestamps[:self._count], self._values[:self._count]
+        index = self._next
+        return (
+            self._timestamps[index:] + self._timestamps[:index],
+            self._values[index:] + self._values[:index]
+        )
+
+    def window(self, date_from=None, date_to=None):
+        """ Returns (timestamps, values) of the readings between the epoch timestamps date_from and date_to """
+        timestamps, values = self.readings()
+        start = 0 if date_from is None else bisect_left(timestamps, date_from)
+        end = len(timestamps) if date_to is None else bisect_right(timestamps, date_to)
+        return timestamps[start:end], values[start:end]
+
+    def query(self, date_from=None, date_to=None, points=None, method="lttb"):
+        """
+        Returns the readings between date_from and date_to as a list of {"timestamp", "value"}.
+
+        :param points: If the window holds more readings they are downsampled to this number of points.
+        :param method: Downsampling method, lttb (default), minmax, min or max.
+        """
+        timestamps, values = self.window(date_from, date_to)
+        if points and len(values) > points:
+            timestamps, values = DOWNSAMPLE_METHODS[method](timestamps, values, points)
+        return [
+            {"timestamp": format_timestamp(timestamp), "value": value}
+            for timestamp, value in zip(timestamps, values)
+        ]
+
+    def last(self, count):
+        """ The last count readings as a list of {"timestamp", "value"} """
+        timestamps, values = self.readings()
+        return [
+            {"timestamp": format_timestamp(timestamp), "value": value}
+            for timestamp, value in zip(timestamps[-count:], values[-count:])
+        ]
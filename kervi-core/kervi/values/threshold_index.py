@@ -0,0 +1,112 @@
+#Copyright 2017 Tim Wentlau.
+#Distributed under the MIT License. See LICENSE in root of project.
+
+"""
+Index of the thresholds of value events.
+
+A value event is triggered when the value rises to or past the start of its range or
+falls to or past the end of it, a single value is a range that starts and ends at the
+value. The start and end boundaries are kept in sorted lists so a change finds the
+thresholds it passes with bisect instead of testing every event.
+"""
+
+import time
+from bisect import bisect_left, bisect_right
+
+class ThresholdEvent(object):
+    """ A value event in the index """
+    def __init__(self, order, value, func, parameters, kwargs, hysteresis, cooldown):
+        self.order = order
+        self.value = value
+        self.func = func
+        self.parameters = parameters or []
+        self.kwargs = kwargs or {}
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.last_triggered = None
+        if isinstance(value, tuple):
+            self.start, self.end = value
+        else:
+            self.start = self.end = value
+            if hysteresis:
+                self.end = value - hysteresis
+
+class ThresholdIndex(object):
+    """
+    Finds the value events whose thresholds are reached or passed when a value changes.
+
+    hysteresis: After an event is triggered by a rising value it is not triggered again
+    before the value has fallen hysteresis below the threshold, the same applies to
+    falling values. An event on a single value is triggered by a falling value at
+    value - hysteresis, so it does not trigger on every change around the value.
+
+    cooldown: Minimum number of seconds between two triggers of an event.
+    """
+    def __init__(self):
+        self._events = []
+        self._rising_keys = []
+        self._rising = []
+        self._falling_keys = []
+        self._falling = []
+        # (event order, rising) of the thresholds that wait for the value to pass the hysteresis
+        self._disarmed = set()
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, value, func, parameters=None, kwargs=None, hysteresis=0, cooldown=0):
+        event = ThresholdEvent(len(self._events), value, func, parameters, kwargs, hysteresis, cooldown)
+        self._events.append(event)
+        self._insert(self._rising_keys, self._rising, event.start, event.order)
+        self._insert(self._falling_keys, self._falling, event.end, event.order)
+        return event
+
+    def _insert(self, keys, orders, key, order):
+        position = bisect_right(keys, key)
+        keys.insert(position, key)
+        orders.insert(position, order)
+
+    def _rearm(self, value):
+        for order, rising in list(self._disarmed):
+            event = self._events[order]
+            if rising and value <= event.start - event.hysteresis:
+                self._disarmed.discard((order, rising))
+            elif not rising and value >= event.end + event.hysteresis:
+                self._disarmed.discard((order, rising))
+
+    def crossed(self, old_value, new_value, now=None):
+        """ Returns the events triggered by a change from old_value to new_value in the order they were added """
+        if old_value is None or new_value is None or old_value == new_value:
+            return []
+
+        if self._disarmed:
+            self._rearm(new_value)
+
+        if new_value > old_value:
+            rising = True
+            start = bisect_right(self._rising_keys, old_value)
+            end = bisect_right(self._rising_keys, new_value)
+            orders = self._rising[start:end]
+        else:
+            rising = False
+            start = bisect_left(self._falling_keys, new_value)
+            end = bisect_left(self._falling_keys, old_value)
+            orders = self._falling[start:end]
+
+        if not orders:
+            return []
+
+        if now is None:
+            now = time.time()
+        result = []
+        for order in sorted(orders):
+            event = self._events[order]
+            if (order, rising) in self._disarmed:
+                continue
+            if event.cooldown and event.last_triggered is not None and now - event.last_triggered < event.cooldown:
+                continue
+            if event.hysteresis:
+                self._disarmed.add((order, rising))
+            event.last_triggered = now
+            result += [event]
+        return result
@@ -0,0 +1,88 @@
+#Copyright 2017 Tim Wentlau.
+#Distributed under the MIT License. See LICENSE in root of project.
+
+"""
+Unit conversion of number values.
+
+All values share one pint UnitRegistry that is created the first time a conversion is
+needed. pint is only used to find a conversion, conversions between units that are
+linear are reduced to a scale and an offset that are applied with float arithmetic.
+"""
+
+import threading
+
+_registry = None
+_registry_lock = threading.Lock()
+_pint_available = None
+_converters = {}
+
+def units_available():
+    """ True if pint is installed, checked without importing it """
+    global _pint_available
+    if _pint_available is None:
+        try:
+            from importlib.util import find_spec
+            _pint_available = find_spec("pint") is not None
+        except ImportError:
+            _pint_available = True
+    return _pint_available
+
+def get_unit_registry():
+    """ The pint UnitRegistry shared by all values or None if pint is not installed """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                try:
+                    from pint import UnitRegistry
+                    registry = UnitRegistry()
+                    registry.autoconvert_offset_to_baseunit = True
+                    _registry = registry
+                except ImportError:
+                    _registry = False
+    return _registry or None
+
+def _create_converter(from_unit, to_unit):
+    registry = get_unit_registry()
+    if registry is None:
+        return None
+    quantity = registry.Quantity
+    try:
+        offset = quantity(0.0, from_unit).to(to_unit).magnitude
+        scale = quantity(1.0, from_unit).to(to_unit).magnitude - offset
+        check = quantity(100.0, from_unit).to(to_unit).magnitude
+    except Exception:
+        return None
+
+    if abs(check - (100.0 * scale + offset)) <= 1e-9 * max(1.0, abs(check)):
+        if offset == 0:
+            return lambda value: value * scale
+        return lambda value: value * scale + offset
+
+    # Logarithmic units are converted by pint
+    return lambda value: quantity(value, from_unit).to(to_unit).magnitude
+
+def get_converter(unit, display_unit, value_type=None):
+    """
+    Returns a function that converts a value in unit to display_unit or None
+    if the units can not be converted. Converters are created once per process.
+    """
+    key = (unit, display_unit, value_type)
+    try:
+        return _converters[key]
+    except KeyError:
+        pass
+
+    if value_type == "temperature" and unit and display_unit:
+        from_unit = "deg" + unit.upper()
+        to_unit = "deg" + display_unit.upper()
+    else:
+        from_unit = unit
+        to_unit = display_unit
+
+    if from_unit == to_unit:
+        converter = None
+    else:
+        converter = _create_converter(from_unit, to_unit)
+    _converters[key] = converter
+    return converter
@@ -0,0 +1,134 @@
+#Copyright 2017 Tim Wentlau.
+#Distributed under the MIT License. See LICENSE in root of project.
+
+"""
+Batched value changes.
+
+    from kervi.values import batch
+
+    with batch():
+        self.left_speed.value = left_speed
+        self.right_speed.value = right_speed
+
+Values that are set inside a batch get their new value at once, but observers, value
+events and persistence run when the batch ends, once per changed value. All changes
+are published in one valuesChanged event with the same timestamp instead of a
+valueChanged event per value. The event carries a list of [value, log_values, groups]
+where value is the payload of a valueChanged event. Components that follow values
+register with register_value_changed_handler to get the changes of both events.
+
+If an exception leaves a batch the values get their old value back and nothing is published.
+"""
+
+import threading
+import time
+
+_local = threading.local()
+
+def current_batch():
+    return getattr(_local, "batch", None)
+
+class ValueBatch(object):
+    """ Collects the changes of the values that are set by the calling thread until the batch ends """
+    def __init__(self):
+        self._changes = {}
+        self._order = []
+        self._depth = 0
+        self._failed = False
+
+    def __enter__(self):
+        if self._depth == 0:
+            _local.batch = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if exc_type:
+            # A nested batch that fails fails the batch it is part of
+            self._failed = True
+        if self._depth == 0:
+            try:
+                if self._failed:
+                    self.rollback()
+                else:
+                    self.commit()
+            finally:
+                _local.batch = None
+
+    def add(self, value, old_value, allow_persist):
+        """ Records a change of value, a value that changes twice keeps the old value of the first change """
+        change = self._changes.get(id(value), None)
+        if change is None:
+            self._changes[id(value)] = [value, old_value, allow_persist]
+            self._order.append(id(value))
+        elif allow_persist:
+            change[2] = True
+
+    def rollback(self):
+        """ Gives the changed values their old value back without notifying or publishing """
+        for key in reversed(self._order):
+            value, old_value, allow_persist = self._changes[key]
+            value._value = old_value
+        self._order = []
+        self._changes = {}
+
+    def commit(self):
+        timestamp = time.time()
+        changed = []
+        # Observers that set other values add them to the batch while it commits
+        while self._order:
+            order = self._order
+            changes = self._changes
+            self._order = []
+            self._changes = {}
+            for key in order:
+                value, old_value, allow_persist = changes[key]
+                if value._value == old_value:
+                    continue
+                value._notify_change(value._value, old_value, allow_persist, timestamp)
+                if not value in changed:
+                    changed.append(value)
+        publish_changes(changed, timestamp)
+
+def publish_changes(values, timestamp):
+    """ Sends the changes of values in one valuesChanged event per spine """
+    spines = []
+    for value in values:
+        for spine, changes in spines:
+            if spine is value.spine:
+                break
+        else:
+            changes = []
+            spines.append((value.spine, changes))
+        changes.append(value)
+
+    for spine, changed_values in spines:
+        has_subscribers = getattr(spine, "has_event_subscribers", None)
+        if has_subscribers and not has_subscribers("valuesChanged"):
+            continue
+        spine.trigger_event(
+            "valuesChanged",
+            None,
+            [[value._change_payload(value._value, timestamp), value._log_values, value.user_groups] for value in changed_values]
+        )
+
+def batch():
+    """
+    Returns a context manager that batches the value changes made inside it.
+    Batches can be nested, the changes are published when the outer batch ends.
+    """
+    return current_batch() or ValueBatch()
+
+def values_changed_handler(func, value_id=None):
+    """ Returns a valuesChanged handler that calls func(value_id, value, log_values) for each change of value_id or of all values """
+    def handle_values_changed(batch_id, changes):
+        for value, log_values, groups in changes:
+            if value_id is None or value["id"] == value_id:
+                func(value["id"], value, log_values)
+    return handle_values_changed
+
+def register_value_changed_handler(spine, func, value_id=None, **kwargs):
+    """ Registers func for the valueChanged events of value_id, or of all values if value_id is None, and for batched changes """
+    spine.register_event_handler("valueChanged", func, value_id, **kwargs)
+    spine.register_event_handler("valuesChanged", values_changed_handler(func, value_id), **kwargs)
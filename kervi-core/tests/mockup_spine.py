@@ -13,6 +13,7 @@ class MockupSpine(object):
         self.commandHandlers = {}
         self.eventHandlers = {}
         self.events={}
+        self.triggered_events = []
         
         self.log = MockupSpineLog()
    
@@ -41,6 +42,10 @@ class MockupSpine(object):
 
     def trigger_event(self, event, id, *args, **kwargs):
         self.events[event] = {"id":id, "args":args, "kwargs":kwargs}
+        self.triggered_events.append((event, id, args, kwargs))
+
+    def get_triggered_events(self, event):
+        return [(id, args, kwargs) for triggered, id, args, kwargs in self.triggered_events if triggered == event]
 
     def send_command(self, command, *args, **kwargs):
         self.commands.append({"command": command, "args":args, "kwargs": kwargs})
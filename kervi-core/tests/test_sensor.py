@@ -59,3 +59,22 @@ def test_multi_sensor():
     assert sensor[0].value == 10
     assert sensor[1].value == 20
     assert sensor[2].value == 30
+
+def test_multi_sensor_value_changed():
+    spine = MockupSpine()
+    device = MockupMultiDimSensorDeviceDriver()
+    device.value1 = 10
+    device.value2 = 20
+    device.value3 = 30
+    sensor = Sensor("test_id", "Test sensor", device, spine=spine, configuration = get_test_config())
+    spine.simulate_app_start()
+
+    MockupSensorThread(sensor).step()
+
+    # the readings of all dimensions are one valuesChanged event
+    assert spine.get_triggered_events("valueChanged") == []
+    values_changes = spine.get_triggered_events("valuesChanged")
+    assert len(values_changes) == 1
+    changes = values_changes[0][1][0]
+    assert sorted(value["value"] for value, log_values, groups in changes) == [10, 20, 30]
+    assert set(value["id"] for value, log_values, groups in changes) == set(sensor[i]._sensor_value.component_id for i in range(3))
@@ -0,0 +1,50 @@
+from mockup_spine import MockupSpine
+from kervi.values import NumberValue
+from kervi.values.sparkline import Sparkline, downsample_lttb, downsample_min_max
+
+def test_ring_keeps_last_readings():
+    sparkline = Sparkline(5)
+    for i in range(8):
+        sparkline.append(i, 1000.0 + i)
+
+    assert len(sparkline) == 5
+    timestamps, values = sparkline.readings()
+    assert list(values) == [3, 4, 5, 6, 7]
+    assert list(timestamps) == [1003, 1004, 1005, 1006, 1007]
+    assert [reading["value"] for reading in sparkline.last(2)] == [6, 7]
+    assert sparkline.last(1)[0]["timestamp"] == "1970-01-01 00:16:47"
+
+    timestamps, values = sparkline.window(1004, 1006)
+    assert list(values) == [4, 5, 6]
+
+def test_downsampling():
+    timestamps = [float(i) for i in range(100)]
+    values = [0.0] * 100
+    values[50] = 10.0
+    values[20] = -5.0
+
+    lttb_timestamps, lttb_values = downsample_lttb(timestamps, values, 10)
+    assert len(lttb_values) == 10
+    assert lttb_timestamps[0] == 0 and lttb_timestamps[-1] == 99
+    assert 10.0 in lttb_values and -5.0 in lttb_values
+
+    min_max_timestamps, min_max_values = downsample_min_max(timestamps, values, 10)
+    assert len(min_max_values) <= 10
+    assert 10.0 in min_max_values and -5.0 in min_max_values
+    assert min_max_timestamps == sorted(min_max_timestamps)
+
+def test_number_sparkline_query():
+    spine = MockupSpine()
+    number = NumberValue("Dynamic Number", value_id="dn", spine=spine, sparkline_size=1000)
+    for i in range(1, 501):
+        number.value = i
+
+    other = NumberValue("Other Number", value_id="on", spine=spine)
+    assert spine.queryHandlers["getSparkline:on"] == other._query_sparkline
+
+    assert len(number._get_info()["sparkline"]) == 10
+    readings = spine.queryHandlers["getSparkline:dn"](points=50, method="minmax")
+    assert len(readings) == 50
+    assert readings[-1]["value"] == 500
+    number.sparkline_size = 100
+    assert len(number._query_sparkline()) == 100
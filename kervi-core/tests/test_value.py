@@ -1,5 +1,8 @@
+import time
 from mockup_spine import MockupSpine
-from kervi.values import KerviValue, NumberValue, BooleanValue
+from kervi.values import KerviValue, NumberValue, BooleanValue, batch
+from kervi.values.value_batch import values_changed_handler
+from kervi.core.utility.timestamp import format_timestamp
 from kervi_config import get_test_config
 def test_value_instantitation_input():
     spine = MockupSpine()
@@ -129,3 +132,153 @@ def test_linking_transformation():
 
     number_out.value = 10
     assert number_in.value == -20
+
+def test_number_display_unit_conversion():
+    spine = MockupSpine()
+    number = NumberValue("Temperature", value_id="temp", spine=spine)
+    number.type = "temperature"
+    number.unit = "C"
+    number.display_unit = "F"
+    number.value = 100
+    assert number.display_value == 212.0
+
+    other = NumberValue("Length", value_id="length", spine=spine)
+    other.unit = "m"
+    other.display_unit = "cm"
+    other.value = 1.5
+    assert other.display_value == 150.0
+
+    unknown = NumberValue("Unknown", value_id="unknown", spine=spine)
+    unknown.unit = "m"
+    unknown.display_unit = "kg"
+    unknown.value = 2
+    assert unknown.display_value == 2.0
+
+def test_value_changed_payload():
+    spine = MockupSpine()
+    number = NumberValue("Dynamic Number", value_id="dn", spine=spine)
+    before = time.time()
+    number.value = 10
+    payload = spine.events["valueChanged"]["args"][0]
+    assert before <= payload["timestamp"] <= time.time()
+    assert payload["display_value"] == 10
+
+    del spine.events["valueChanged"]
+    spine.has_event_subscribers = lambda event, id=None: False
+    number.value = 11
+    assert "valueChanged" not in spine.events
+    assert number.value == 11
+
+def test_value_event_thresholds():
+    spine = MockupSpine()
+    number = NumberValue("Dynamic Number", value_id="dn", spine=spine)
+    triggered = []
+    number.add_value_event(10, lambda value, name: triggered.append(name), parameters=["point"])
+    number.add_value_event((20, 30), lambda value, name: triggered.append(name), parameters=["range"])
+    number.add_value_event(50, lambda value, name: triggered.append(name), parameters=["hysteresis"], hysteresis=5)
+
+    for value in [25, 5, 35, 29, 10]:
+        number.value = value
+    assert triggered == ["point", "range", "point", "point", "range", "range", "point"]
+
+    del triggered[:]
+    for value in [51, 49, 51, 44, 51]:
+        number.value = value
+    # the hysteresis event triggers at 50 going up and at 45 going down
+    assert triggered == ["range", "hysteresis", "hysteresis", "hysteresis"]
+
+def test_value_event_cooldown():
+    from kervi.values.threshold_index import ThresholdIndex
+    index = ThresholdIndex()
+    index.add(10, "alarm", cooldown=60)
+    assert len(index.crossed(0, 20, now=1000)) == 1
+    assert index.crossed(20, 0, now=1010) == []
+    assert index.crossed(0, 20, now=1020) == []
+    assert len(index.crossed(20, 0, now=1061)) == 1
+
+def test_value_batch():
+    spine = MockupSpine()
+    left = NumberValue("Left", value_id="left", spine=spine)
+    right = NumberValue("Right", value_id="right", spine=spine)
+    changes = []
+    left.add_observer(right)
+    right.value_changed = lambda new_value, old_value: changes.append((new_value, old_value))
+
+    with batch():
+        left.value = 10
+        with batch():
+            left.value = 20
+        assert left.value == 20
+        assert spine.triggered_events == []
+
+    # the observer sets right once with the final value of left
+    assert right.value == 20
+    assert changes == [(20, 0)]
+    values = spine.events["valuesChanged"]["args"][0]
+    assert [value["id"] for value, log_values, groups in values] == ["left", "right"]
+    assert values[0][0]["timestamp"] == values[1][0]["timestamp"]
+
+    # the batch is one message on the bus
+    assert spine.get_triggered_events("valueChanged") == []
+    assert len(spine.get_triggered_events("valuesChanged")) == 1
+
+    del spine.triggered_events[:]
+    with batch():
+        left.value = 5
+        left.value = 20
+    assert spine.triggered_events == []
+
+def test_value_batch_exception():
+    spine = MockupSpine()
+    left = NumberValue("Left", value_id="left", spine=spine)
+    right = NumberValue("Right", value_id="right", spine=spine)
+    changes = []
+    left.value_changed = lambda new_value, old_value: changes.append(new_value)
+
+    try:
+        with batch():
+            left.value = 10
+            right.value = 20
+            raise ValueError("stop")
+    except ValueError:
+        pass
+
+    assert left.value == 0
+    assert right.value == 0
+    assert changes == []
+    assert spine.triggered_events == []
+
+    # a nested batch that fails rolls back the outer batch
+    with batch():
+        left.value = 10
+        try:
+            with batch():
+                right.value = 20
+                raise ValueError("stop")
+        except ValueError:
+            pass
+    assert left.value == 0
+    assert right.value == 0
+    assert spine.triggered_events == []
+
+    left.value = 30
+    assert changes == [30]
+
+def test_format_timestamp():
+    assert format_timestamp(1514862245.25) == "2018-01-02 03:04:05"
+    assert format_timestamp(1514862245.25, milliseconds=True) == "2018-01-02 03:04:05.250"
+    assert format_timestamp("2018-01-02 03:04:05") == "2018-01-02 03:04:05"
+
+def test_value_changed_handler_gets_batched_changes():
+    spine = MockupSpine()
+    left = NumberValue("Left", value_id="left", spine=spine)
+    right = NumberValue("Right", value_id="right", spine=spine)
+    received = []
+    handler = values_changed_handler(lambda value_id, value, log_values: received.append((value_id, value["value"])), "right")
+
+    with batch():
+        left.value = 1
+        right.value = 2
+    handler(None, spine.events["valuesChanged"]["args"][0])
+
+    assert received == [("right", 2)]
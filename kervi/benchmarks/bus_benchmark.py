@@ -0,0 +1,318 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark of the ZMQ message bus.
+
+Starts real ZMQBus instances and measures throughput and latency of commands, events,
+queries and streams for a range of payload sizes. Topologies:
+
+    local       sender and handlers in one process
+    processes   the sender is the root process and handlers run in worker processes
+                started with _start_process, --processes is the total number of processes
+    module      handlers run in a root process and the sender is a module connected to it
+
+Each result is written as one json object per line to stdout and to --output if given,
+the first line describes the environment. Latency of commands, events and streams is
+measured from send until the handler is called in the receiving process, query latency
+is the round trip until all processes have answered.
+
+    python benchmarks/bus_benchmark.py --topology processes --processes 2,4,8 --output bus.jsonl
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import threading
+import time
+
+import kervi.utility.nethelper as nethelper
+import kervi.core.utility.process as process
+from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus
+
+KINDS = ["command", "event", "query", "stream"]
+
+class _Receiver(object):
+    """ Registers the benchmark handlers on a bus and records when messages arrive """
+    def __init__(self, bus):
+        self._lock = threading.Lock()
+        self.reset()
+        bus.register_command_handler("benchCommand", self._on_command)
+        bus.register_event_handler("benchEvent", self._on_event)
+        bus.register_stream_handler("bench", self._on_stream)
+        bus.register_query_handler("benchQuery", self._on_query)
+        bus.register_query_handler("benchReset", self.reset)
+        bus.register_query_handler("benchStats", self.get_stats)
+
+    def _record(self, kind, sent):
+        now = time.time()
+        with self._lock:
+            stats = self._stats.setdefault(kind, {"count": 0, "first": now, "last": now, "latencies": []})
+            stats["count"] += 1
+            stats["last"] = now
+            stats["latencies"] += [now - sent]
+
+    def _on_command(self, sent, payload):
+        self._record("command", sent)
+
+    def _on_event(self, event_id, sent, payload):
+        self._record("event", sent)
+
+    def _on_stream(self, stream_id, stream_event, data, sent):
+        self._record("stream", sent)
+
+    def _on_query(self, sent, payload):
+        return len(payload)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+class _BenchmarkProcess(process._KerviProcess):
+    """ Worker process that handles the benchmark messages """
+    def load_spine(self, process_id, spine_port, root_address=None, ip=None):
+        bus = ZMQBus(self.config.benchmark.bus.as_dict())
+        bus.set_log(process_id)
+        bus.reset_bus(process_id, spine_port, ip, root_address)
+        bus.run()
+        return bus
+
+    def init_process(self, **kwargs):
+        self._receiver = _Receiver(self.spine)
+
+def _run_root(port, bus_config, scope, ready):
+    """ Root process of the module topology """
+    bus = ZMQBus(bus_config)
+    bus.set_log("kervi-main")
+    bus.reset_bus("kervi-main", port, "127.0.0.1")
+    bus.run()
+    terminate = threading.Event()
+    receiver = _Receiver(bus)
+    bus.register_command_handler("terminateProcess", terminate.set, scopes=[scope])
+    ready.set()
+    terminate.wait()
+    bus.stop()
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * percent / 100.0))] * 1000, 3)
+
+def _merge_stats(result):
+    """ send_query returns a single value when only one process answers """
+    if isinstance(result, dict):
+        return [result]
+    return [stats for stats in result if isinstance(stats, dict)]
+
+def _send(bus, kind, sent, payload):
+    if kind == "command":
+        bus.send_command("benchCommand", sent, payload)
+    elif kind == "event":
+        bus.trigger_event("benchEvent", "bench", sent, payload)
+    elif kind == "stream":
+        bus.stream_data("bench", "data", payload, sent)
+
+def _run_case(bus, kind, size, count, receivers, timeout):
+    bus.send_query("benchReset")
+    if kind == "stream":
+        payload = b"x" * size
+    else:
+        payload = "x" * size
+
+    latencies = []
+    received = 0
+    start = time.time()
+    if kind == "query":
+        for i in range(count):
+            sent = time.time()
+            bus.send_query("benchQuery", sent, payload, timeout=timeout)
+            latencies += [time.time() - sent]
+        received = count
+        end = time.time()
+    else:
+        for i in range(count):
+            _send(bus, kind, time.time(), payload)
+
+        expected = count * receivers
+        wait_until = time.time() + timeout
+        while True:
+            stats = [process_stats.get(kind, None) for process_stats in _merge_stats(bus.send_query("benchStats"))]
+            stats = [kind_stats for kind_stats in stats if kind_stats]
+            received = sum(kind_stats["count"] for kind_stats in stats)
+            if received >= expected or time.time() > wait_until:
+                break
+            time.sleep(.1)
+        end = max([kind_stats["last"] for kind_stats in stats] + [start])
+        for kind_stats in stats:
+            latencies += kind_stats["latencies"]
+
+    seconds = max(end - start, 1e-9)
+    return {
+        "type": "result",
+        "kind": kind,
+        "payload": size,
+        "messages": count,
+        "receivers": receivers,
+        "received": received,
+        "seconds": round(seconds, 6),
+        "throughput": round(received / seconds, 1),
+        "p50_ms": _percentile(latencies, 50),
+        "p99_ms": _percentile(latencies, 99)
+    }
+
+def _wait_for_connections(bus, count, timeout=30):
+    wait_until = time.time() + timeout
+    while time.time() < wait_until:
+        if len([connection for connection in bus._connections if connection.is_alive]) >= count:
+            # one more ping so the peers know the subscriptions of each other
+            time.sleep(1)
+            return True
+        time.sleep(.2)
+    return False
+
+def _benchmark_config(args, root_port):
+    return {
+        "log": {
+            "level": "warning",
+            "file": "bus_benchmark.log",
+            "resetLog": False
+        },
+        "network": {
+            "ip": "127.0.0.1",
+            "ipc_root_address": "127.0.0.1",
+            "ipc_root_port": root_port
+        },
+        "benchmark": {
+            "bus": {
+                "codec": args.codec
+            }
+        }
+    }
+
+def _run_topology(topology, process_count, args, write):
+    from kervi.config import Configuration
+    root_port = nethelper.get_free_port([9700])
+    bus_config = {"codec": args.codec}
+    processes = []
+    receivers = 1
+    scope = "benchmark"
+
+    if topology == "module":
+        ready = multiprocessing.Event()
+        processes += [multiprocessing.Process(target=_run_root, args=(root_port, bus_config, scope, ready))]
+        processes[0].start()
+        ready.wait(30)
+        bus = ZMQBus(bus_config)
+        bus.set_log("module")
+        bus.reset_bus("module", nethelper.get_free_port([root_port + 1]), "127.0.0.1", "tcp://127.0.0.1:" + str(root_port))
+        bus.run()
+        _wait_for_connections(bus, 1)
+    else:
+        bus = ZMQBus(bus_config)
+        bus.set_log("kervi-main")
+        bus.reset_bus("kervi-main", root_port, "127.0.0.1")
+        bus.run()
+        if topology == "local":
+            _Receiver(bus)
+        else:
+            Configuration._load(config_base=_benchmark_config(args, root_port))
+            receivers = process_count - 1
+            port = root_port
+            for index in range(receivers):
+                port = nethelper.get_free_port([port + 1])
+                processes += [process._start_process(scope, "bench-" + str(index), Configuration, port, _BenchmarkProcess)]
+            _wait_for_connections(bus, receivers)
+
+    try:
+        for kind in args.kinds:
+            for size in args.sizes:
+                result = _run_case(bus, kind, size, args.count, receivers, args.timeout)
+                result["topology"] = topology
+                result["processes"] = process_count
+                write(result)
+    finally:
+        bus.send_command("terminateProcess", scope=[scope])
+        for child in processes:
+            child.join(10)
+        bus.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the kervi message bus")
+    parser.add_argument("--topology", default="local,processes,module", help="comma separated list of local, processes and module")
+    parser.add_argument("--processes", default="2,4,8", help="total number of processes in the processes topology")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="comma separated list of " + ", ".join(KINDS))
+    parser.add_argument("--sizes", default="16,1024,16384,262144", help="payload sizes in bytes")
+    parser.add_argument("--count", type=int, default=1000, help="messages per case")
+    parser.add_argument("--codec", default="json", help="message bus codec")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for the messages of a case")
+    parser.add_argument("--output", default=None, help="append the results as json lines to this file")
+    args = parser.parse_args(argv)
+    args.kinds = [kind for kind in args.kinds.split(",") if kind]
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    output = open(args.output, "a") if args.output else None
+    def write(result):
+        line = json.dumps(result)
+        print(line)
+        sys.stdout.flush()
+        if output:
+            output.write(line + "\n")
+            output.flush()
+
+    try:
+        from kervi.version import VERSION
+    except ImportError:
+        VERSION = "0.0.0"
+
+    write({
+        "type": "environment",
+        "version": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "codec": args.codec,
+        "count": args.count,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    })
+
+    try:
+        for topology in args.topology.split(","):
+            if topology == "processes":
+                for process_count in [int(count) for count in args.processes.split(",")]:
+                    _run_topology(topology, process_count, args, write)
+            elif topology in ["local", "module"]:
+                _run_topology(topology, 1 if topology == "local" else 2, args, write)
+            else:
+                parser.error("unknown topology: " + topology)
+    finally:
+        if output:
+            output.close()
+
+if __name__ == "__main__":
+    main()
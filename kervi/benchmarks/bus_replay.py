@@ -0,0 +1,66 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Replays a recording of bus traffic.
+
+Record the traffic of a process by setting record_file (and optionally record_stream_sample)
+in the config of the message bus plugin. The replay connects to a running application as a
+module, or runs as a root process when --root is not given, and sends the recorded messages
+at --speed times the recorded rate. The bus metrics of the replaying process are written as
+json when the replay is done.
+
+    python benchmarks/bus_replay.py traffic.rec.gz --root tcp://127.0.0.1:9500 --speed 5
+"""
+
+import argparse
+import json
+import time
+
+import kervi.utility.nethelper as nethelper
+from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus
+from kervi.plugin.message_bus.zmq.recorder import BusReplayer
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays a recording of kervi bus traffic")
+    parser.add_argument("recording", help="file written by the bus recorder")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 2 is twice the recorded rate")
+    parser.add_argument("--root", default=None, help="address of the root process to connect to")
+    parser.add_argument("--ip", default="127.0.0.1", help="ip of this process")
+    parser.add_argument("--codec", default="json", help="message bus codec")
+    parser.add_argument("--wait", type=float, default=2, help="seconds to wait for the connections before the replay")
+    args = parser.parse_args(argv)
+
+    bus = ZMQBus({"codec": args.codec, "metrics": True})
+    bus.set_log("bus-replay")
+    process_id = "bus-replay" if args.root else "kervi-main"
+    bus.reset_bus(process_id, nethelper.get_free_port([9600]), args.ip, args.root)
+    bus.run()
+    try:
+        time.sleep(args.wait)
+        stats = BusReplayer(bus, args.recording, args.speed).run()
+        time.sleep(1)
+        print(json.dumps({"replay": stats, "metrics": bus.get_metrics()}, indent=2))
+    finally:
+        bus.stop()
+
+if __name__ == "__main__":
+    main()
@@ -64,6 +64,7 @@ def get_default_config():
         },
         "plugins":{
             "kervi.plugin.message_bus.zmq": True,
+            "kervi.plugin.message_bus.zmq_asyncio": False,
             "kervi.plugin.io.files": True,
             "kervi.plugin.authentication.plain": False,
             "kervi.plugin.storage.sqlite_temp": True,
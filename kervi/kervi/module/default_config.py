@@ -69,6 +69,7 @@ def get_default_config():
         },
         "plugins":{
             "kervi.plugin.message_bus.zmq": True,
+            "kervi.plugin.message_bus.zmq_asyncio": False,
             "kervi.plugin.routing.kervi_io": False
         },
         "unit_system": "metric",
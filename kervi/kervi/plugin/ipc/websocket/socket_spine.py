@@ -26,6 +26,7 @@ import json
 from kervi.spine import Spine
 import kervi.utility.nethelper as nethelper
 from kervi.core.authentication import Authorization
+from kervi.core.utility.timestamp import format_timestamp
 import kervi.utility.encryption as encryption
 import logging
 import threading
@@ -129,10 +130,31 @@ class _WebEventHandler(object):
 
         if authorized and self.protocol.authenticated and not injected == "socketSpine":
             
+            if self.event == "valueChanged" and args and isinstance(args[0], dict) and "timestamp" in args[0]:
+                # Values send the time of the change as an epoch timestamp, the UI gets it with milliseconds
+                args = (dict(args[0], timestamp=format_timestamp(args[0]["timestamp"], milliseconds=True)),) + tuple(args[1:])
             cmd = {"messageType":"event", "event":self.event, "id":id_event, "args":args, "eps": self._eps, "ts": now}
+            if kwargs.get("trace", None):
+                # Lets the client continue the trace when it answers the event
+                cmd["trace"] = kwargs["trace"]
             jsonres = json.dumps(cmd, cls=_ObjectEncoder, ensure_ascii=False).encode('utf8')
             self.protocol.broadcast_message(self.protocol, jsonres)
 
+class _WebValuesHandler(object):
+    """ Relays the changes of a value batch to the valueChanged handlers of the connection """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.spine = Spine()
+        self.spine.register_event_handler("valuesChanged", self.on_event, injected="socketSpine")
+
+    def on_event(self, batch_id, changes, **kwargs):
+        injected = kwargs.get("injected", "")
+        handlers = [handler for handler in self.protocol.handlers["event"] if handler.event == "valueChanged"]
+        for value, log_values, groups in changes:
+            for handler in handlers:
+                if handler.id_event is None or handler.id_event == value["id"]:
+                    handler.on_event(value["id"], value, log_values, groups=groups, injected=injected)
+
 class _WebStreamHandler(object):
     def __init__(self, stream_id, stream_event, protocol):
         self.protocol = protocol
@@ -182,6 +204,7 @@ class _SpineProtocol(WebSocketServerProtocol):
         self.spine = Spine()
         WebSocketServerProtocol.__init__(self)
         self.handlers = {"command":[], "query":[], "event":[], "stream":[]}
+        self._values_handler = None
         self.authenticated = False
         self.session = None
         self.user = None
@@ -216,6 +239,8 @@ class _SpineProtocol(WebSocketServerProtocol):
                 found = True
         if not found:
             self.handlers["event"] += [_WebEventHandler(event, id_event, self)]
+            if event == "valueChanged" and not self._values_handler:
+                self._values_handler = _WebValuesHandler(self)
 
     def add_stream_handler(self, stream_id, stream_event):
         found = False
@@ -320,14 +345,14 @@ class _SpineProtocol(WebSocketServerProtocol):
                     pass
                 elif obj["messageType"] == "query":
                     #res = yield from self.async_query(obj["query"], obj["args"], injected="socketSpine", session=self.user)
-                    res = self.spine.send_query(obj["query"], *obj["args"], injected="socketSpine", session=self.user)
+                    res = self.spine.send_query(obj["query"], *obj["args"], injected="socketSpine", session=self.user, trace=obj.get("trace", None))
                     self.spine.log.debug("query response:{0}", res)
                     self.send_response(obj["id"], res)
                 elif obj["messageType"] == "registerQueryHandler":
                     self.add_query_handler(obj["query"])
                     self.send_response(None, None)
                 elif obj["messageType"] == "command":
-                    self.spine.send_command(obj["command"], *obj["args"], injected="socketSpine", session=self.user)
+                    self.spine.send_command(obj["command"], *obj["args"], injected="socketSpine", session=self.user, trace=obj.get("trace", None))
                     self.send_response(obj["id"], None)
                 elif obj["messageType"] == "registerCommandHandler":
                     self.add_command_handler(obj["command"])
@@ -336,7 +361,8 @@ class _SpineProtocol(WebSocketServerProtocol):
                     self.spine.trigger_event(
                         obj["event"], obj["id"],
                         obj["args"],
-                        injected="socketSpine"
+                        injected="socketSpine",
+                        trace=obj.get("trace", None)
                     )
                     self.send_response(obj["id"], None)
                 elif obj["messageType"] == "registerEventHandler":
@@ -33,6 +33,9 @@ class KerviBus:
     
     def send_query(self, query, *args, **kwargs):
         raise NotImplementedError
+
+    def send_query_async(self, query, *args, **kwargs):
+        raise NotImplementedError
     
     def register_query_handler(self, query, func, **kwargs):
         raise NotImplementedError
@@ -32,7 +32,7 @@ class ZMQPlugin(KerviBusPlugin):
 
     def load(self, process_id, spine_port, root_address = None, ip=None):
         from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus
-        self._bus = ZMQBus()
+        self._bus = ZMQBus(self.plugin_config)
         self._bus.set_log(process_id)
         self._bus.reset_bus(process_id, spine_port, ip, root_address)
         self._bus.run()
@@ -40,6 +40,38 @@ class ZMQPlugin(KerviBusPlugin):
         #    self._bus.wait_for_root()
         return self
 
+    def get_default_config(self):
+        return {
+            "codec": "json",
+            "handler_threads": 5,
+            "query_workers": 16,
+            "query_queue_size": 256,
+            "query_timeout": 10,
+            "conflation": {},
+            "shared_memory_size": 16 * 1024 * 1024,
+            "shared_memory_threshold": 16 * 1024,
+            "bulk_types": ["stream"],
+            "bulk_handler_threads": 2,
+            "bulk_queue_size": 32,
+            "bulk_block_timeout": 1,
+            "bulk_send_hwm": 16,
+            "control_send_hwm": 1000,
+            "ipc": True,
+            "ipc_dir": None,
+            "compression": "zlib",
+            "compression_threshold": 4096,
+            "record_file": None,
+            "record_stream_sample": 1.0,
+            "trace_sample": 0.0,
+            "trace_history": 100,
+            "metrics": False,
+            "metrics_dump_interval": 0,
+            "ping_interval": .5,
+            "liveness_timeout": 2,
+            "member_timeout": 10,
+            "root_timeout": 10
+        }
+
 
 
 def init_plugin(config, manager):
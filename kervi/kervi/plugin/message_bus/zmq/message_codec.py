@@ -0,0 +1,225 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Wire codecs used by the ZMQ bus to serialize message envelopes.
+
+A codec is selected in the message_bus plugin config and negotiated with each
+peer during ping. JSON is always available and is used with peers that do not
+announce any codecs. Incoming frames are decoded by looking at the first byte,
+so a process can receive from peers that use different codecs.
+
+msgpack delivers bytes and datetimes natively while JSON delivers base64 text and ISO 8601
+strings. Decoding does not convert them, components that pass messages on as JSON, like the
+websocket relay and the kervi_io router, encode them with the JSON codec or its encoder.
+
+Large payloads send to remote processes can be compressed. A compressed payload
+starts with the marker byte of its compressor, a byte that does not start an
+encoded message, and the compressor is negotiated with each peer like the codec.
+"""
+
+import json
+import base64
+import datetime
+import zlib
+from kervi.config.configuration import _KerviConfig
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+DEFAULT_CODEC = "json"
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+class _ObjectEncoder(json.JSONEncoder):
+    def default(self, o):
+
+        if o and isinstance(o, datetime.datetime):
+           return o.strftime(DATETIME_FORMAT)
+        elif o and isinstance(o, bytes):
+            return base64.b64encode(o).decode("utf8")
+        elif o and isinstance(o, bytearray):
+            return base64.b64encode(o).decode('utf8')
+        elif o and isinstance(o, _KerviConfig):
+            return o.as_dict()
+        else:
+            return json.JSONEncoder.default(self, o)
+
+class MessageCodec(object):
+    """ Base class for codecs that turn a message dict into bytes and back """
+    name = None
+
+    def can_decode(self, data):
+        raise NotImplementedError
+
+    def encode(self, message):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+class JSONCodec(MessageCodec):
+    """ The original text codec, bytes are base64 encoded and datetimes formatted as strings """
+    name = "json"
+
+    def can_decode(self, data):
+        return data[:1] == b"{"
+
+    def encode(self, message):
+        return json.dumps(message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf8'))
+
+class MsgPackCodec(MessageCodec):
+    """ Compact binary codec, bytes and datetimes are transferred natively """
+    name = "msgpack"
+
+    def can_decode(self, data):
+        # A message is always a map, fixmap 0x80-0x8f, map16 0xde or map32 0xdf
+        first = data[:1]
+        return first != b"" and (0x80 <= first[0] <= 0x8f or first[0] in (0xde, 0xdf))
+
+    def _default(self, o):
+        if isinstance(o, datetime.datetime):
+            if o.tzinfo is None:
+                o = o.replace(tzinfo=datetime.timezone.utc)
+            return msgpack.Timestamp.from_datetime(o)
+        elif isinstance(o, _KerviConfig):
+            return o.as_dict()
+        raise TypeError("Object of type %s is not msgpack serializable" % type(o).__name__)
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True, default=self._default)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False, timestamp=3, strict_map_key=False)
+
+_CODECS = {}
+
+def register_codec(codec):
+    _CODECS[codec.name] = codec
+
+def get_codec(name):
+    """ Returns the codec registered with name or the json codec if it is not available """
+    if name in _CODECS:
+        return _CODECS[name]
+    return _CODECS[DEFAULT_CODEC]
+
+def supported_codecs(preferred=DEFAULT_CODEC):
+    """ Names of the registered codecs with the preferred codec first """
+    result = [name for name in _CODECS if name != preferred]
+    if preferred in _CODECS:
+        result.insert(0, preferred)
+    return result
+
+def negotiate_codec(preferred, peer_codecs):
+    """ Selects the codec to use when sending to a peer that supports peer_codecs """
+    if peer_codecs:
+        for name in supported_codecs(preferred):
+            if name in peer_codecs:
+                return _CODECS[name]
+    return _CODECS[DEFAULT_CODEC]
+
+def decode_message(data):
+    for codec in _CODECS.values():
+        if codec.can_decode(data):
+            return codec.decode(data)
+    raise ValueError("no codec found for message")
+
+register_codec(JSONCodec())
+if msgpack and hasattr(msgpack, "Timestamp"):
+    register_codec(MsgPackCodec())
+
+class PayloadCompressor(object):
+    """ Base class for compressors of encoded payloads """
+    name = None
+    marker = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+class ZlibCompressor(PayloadCompressor):
+    name = "zlib"
+    marker = b"\x01"
+
+    def compress(self, data):
+        # The fastest level gives most of the gain on json at a fraction of the time
+        return self.marker + zlib.compress(data, 1)
+
+    def decompress(self, data):
+        return zlib.decompress(memoryview(data)[1:])
+
+class LZ4Compressor(PayloadCompressor):
+    name = "lz4"
+    marker = b"\x02"
+
+    def compress(self, data):
+        return self.marker + lz4_frame.compress(data)
+
+    def decompress(self, data):
+        return lz4_frame.decompress(bytes(memoryview(data)[1:]))
+
+_COMPRESSORS = {}
+_COMPRESSOR_MARKERS = {}
+
+def register_compressor(compressor):
+    _COMPRESSORS[compressor.name] = compressor
+    _COMPRESSOR_MARKERS[compressor.marker] = compressor
+
+def supported_compressions(preferred=None):
+    """ Names of the registered compressors with the preferred compressor first """
+    result = [name for name in _COMPRESSORS if name != preferred]
+    if preferred in _COMPRESSORS:
+        result.insert(0, preferred)
+    return result
+
+def negotiate_compression(preferred, peer_compressions):
+    """ Selects the compressor to use when sending to a peer, None if compression is off or the peer has none """
+    if preferred and peer_compressions:
+        for name in supported_compressions(preferred):
+            if name in peer_compressions:
+                return _COMPRESSORS[name]
+    return None
+
+def is_compressed(data):
+    return bytes(data[:1]) in _COMPRESSOR_MARKERS
+
+def decompress_payload(data):
+    """ Returns the payload without compression, data itself if it is not compressed """
+    compressor = _COMPRESSOR_MARKERS.get(bytes(data[:1]), None)
+    if compressor is None:
+        return data
+    return compressor.decompress(data)
+
+register_compressor(ZlibCompressor())
+if lz4_frame:
+    register_compressor(LZ4Compressor())
@@ -0,0 +1,175 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Low overhead counters and latency histograms for the ZMQ bus.
+
+Metrics are kept per topic family, the message type and name of a tag without the component
+id, so event:valueChanged:v1 and event:valueChanged:v2 are counted as event:valueChanged.
+Counters are updated without locking, under load an increment can get lost so the numbers
+should be read as close approximations. Metrics are off unless enabled in the bus config.
+"""
+
+import bisect
+
+class Histogram(object):
+    """ Latency histogram with exponential buckets from 0.1ms to about 100s """
+    BOUNDS = tuple(0.0001 * 2 ** i for i in range(21))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """ Upper bound of the bucket that holds the percentile, the max value for the last bucket """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(self.BOUNDS):
+                    return min(self.BOUNDS[index], self.max)
+                break
+        return self.max
+
+    def as_dict(self):
+        """ Summary in milliseconds """
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "max": round(self.max * 1000, 3),
+            "p50": round(self.percentile(50) * 1000, 3),
+            "p90": round(self.percentile(90) * 1000, 3),
+            "p99": round(self.percentile(99) * 1000, 3)
+        }
+
+class TopicMetrics(object):
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.dropped = 0
+        self.handler_time = Histogram()
+        self.queue_wait = Histogram()
+        self.query_rtt = Histogram()
+        self.compressed_from = 0
+        self.compressed_to = 0
+        self.compress_time = Histogram()
+        self.decompress_time = Histogram()
+
+    def as_dict(self):
+        result = {
+            "messagesIn": self.messages_in,
+            "bytesIn": self.bytes_in,
+            "messagesOut": self.messages_out,
+            "bytesOut": self.bytes_out,
+            "dropped": self.dropped
+        }
+        if self.handler_time.count:
+            result["handlerTime"] = self.handler_time.as_dict()
+        if self.queue_wait.count:
+            result["queueWait"] = self.queue_wait.as_dict()
+        if self.query_rtt.count:
+            result["queryRtt"] = self.query_rtt.as_dict()
+        if self.compress_time.count:
+            result["compressionRatio"] = round(self.compressed_from / float(max(1, self.compressed_to)), 2)
+            result["compressTime"] = self.compress_time.as_dict()
+        if self.decompress_time.count:
+            result["decompressTime"] = self.decompress_time.as_dict()
+        return result
+
+def topic_family(tag):
+    """ The tag up to its second colon, command:start and query:getValue are their own family """
+    end = tag.find(":", tag.find(":") + 1)
+    if end > 0:
+        return tag[:end]
+    return tag
+
+class BusMetrics(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._topics = {}
+
+    def topic(self, tag):
+        family = topic_family(tag)
+        topic = self._topics.get(family, None)
+        if topic is None:
+            topic = self._topics.setdefault(family, TopicMetrics())
+        return topic
+
+    def message_in(self, tag, size):
+        if self.enabled:
+            topic = self.topic(tag)
+            topic.messages_in += 1
+            topic.bytes_in += size
+
+    def message_out(self, tag, size):
+        if self.enabled:
+            topic = self.topic(tag)
+            topic.messages_out += 1
+            topic.bytes_out += size
+
+    def dropped(self, tag):
+        if self.enabled:
+            self.topic(tag).dropped += 1
+
+    def handler_time(self, tag, seconds):
+        if self.enabled:
+            self.topic(tag).handler_time.add(seconds)
+
+    def queue_wait(self, tag, seconds):
+        if self.enabled:
+            self.topic(tag).queue_wait.add(seconds)
+
+    def query_rtt(self, tag, seconds):
+        if self.enabled:
+            self.topic(tag).query_rtt.add(seconds)
+
+    def compressed(self, tag, size, compressed_size, seconds):
+        if self.enabled:
+            topic = self.topic(tag)
+            topic.compressed_from += size
+            topic.compressed_to += compressed_size
+            topic.compress_time.add(seconds)
+
+    def decompressed(self, tag, seconds):
+        if self.enabled:
+            self.topic(tag).decompress_time.add(seconds)
+
+    def as_dict(self):
+        return dict((tag, topic.as_dict()) for tag, topic in list(self._topics.items()))
+
+    def top(self, count=10):
+        """ The topics that used most handler time """
+        topics = sorted(list(self._topics.items()), key=lambda item: item[1].handler_time.total, reverse=True)
+        return dict((tag, topic.as_dict()) for tag, topic in topics[:count])
@@ -0,0 +1,177 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Records the messages a bus sends and replays them into another bus.
+
+A recording starts with a file header followed by one record per message:
+
+    time      seconds since the recording started (double)
+    kind      command, event, stream or query
+    flags     1 if the stream data is stored
+    tag       the bus tag of the message
+    payload   the message envelope encoded with msgpack, or json when msgpack is missing
+    data      the stream data
+
+Stream frames can be sampled, only the length of a frame that is not sampled is
+recorded and the replayer sends zeros of the same length in its place. Files that end
+with .gz are compressed.
+"""
+
+import gzip
+import struct
+import threading
+import time
+
+from kervi.plugin.message_bus.zmq.message_codec import get_codec, decode_message
+
+COMMAND = 1
+EVENT = 2
+STREAM = 3
+QUERY = 4
+
+_FILE_HEADER = b"KBR1"
+_RECORD = struct.Struct("<dBBHII")
+_DATA_STORED = 1
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class BusRecorder(object):
+    """ Writes the messages passed to record to path, stream_sample is the share of stream frames that are stored """
+    def __init__(self, path, stream_sample=1.0):
+        self._file = _open(path, "wb")
+        self._file.write(_FILE_HEADER)
+        self._codec = get_codec("msgpack")
+        self._stream_sample = stream_sample
+        self._sampled = 0.0
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.errors = 0
+
+    def record(self, kind, tag, message, data=None):
+        try:
+            payload = self._codec.encode(message)
+        except Exception:
+            # messages to local handlers may hold objects that can not be encoded
+            self.errors += 1
+            return
+        tag = tag.encode()
+        flags = 0
+        data_length = 0
+        with self._lock:
+            if self._file is None:
+                return
+            if data is not None:
+                data_length = len(data)
+                self._sampled += self._stream_sample
+                if self._sampled >= 1:
+                    self._sampled -= 1
+                    flags = _DATA_STORED
+            self._file.write(_RECORD.pack(time.time() - self._start, kind, flags, len(tag), len(payload), data_length))
+            self._file.write(tag)
+            self._file.write(payload)
+            if flags & _DATA_STORED:
+                self._file.write(data)
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+def read_recording(path):
+    """ Yields (time, kind, tag, message, data) for each record in the file at path """
+    with _open(path, "rb") as recording:
+        if recording.read(len(_FILE_HEADER)) != _FILE_HEADER:
+            raise ValueError("not a bus recording: " + path)
+        while True:
+            header = recording.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            offset, kind, flags, tag_length, payload_length, data_length = _RECORD.unpack(header)
+            tag = recording.read(tag_length).decode("utf-8")
+            message = decode_message(recording.read(payload_length))
+            data = None
+            if kind == STREAM:
+                if flags & _DATA_STORED:
+                    data = recording.read(data_length)
+                else:
+                    data = bytes(data_length)
+            yield offset, kind, tag, message, data
+
+class BusReplayer(object):
+    """
+    Sends the messages of a recording with bus. The time between messages is kept,
+    speed 2 replays twice as fast. Queries are send without waiting for the result.
+    """
+    def __init__(self, bus, path, speed=1.0):
+        self._bus = bus
+        self._path = path
+        self._speed = speed
+        self._terminate = False
+        self.stats = {"messages": 0, "commands": 0, "events": 0, "streams": 0, "queries": 0, "max_lag": 0.0, "seconds": 0.0}
+
+    def stop(self):
+        self._terminate = True
+
+    def run(self):
+        """ Replays the recording and returns the stats """
+        start = time.time()
+        for offset, kind, tag, message, data in read_recording(self._path):
+            if self._terminate:
+                break
+            due = start + offset / self._speed
+            now = time.time()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                self.stats["max_lag"] = max(self.stats["max_lag"], now - due)
+            self._send(kind, message, data)
+            self.stats["messages"] += 1
+        self.stats["seconds"] = time.time() - start
+        return self.stats
+
+    def _send(self, kind, message, data):
+        # Every field of the recorded envelope is send again, the trace of a traced message is continued
+        kwargs = dict(message.get("kwargs", None) or {})
+        for name in ["injected", "scope", "groups", "session", "trace", "timeout"]:
+            if message.get(name, None):
+                kwargs[name] = message[name]
+        if message.get("conflate", True) is False:
+            kwargs["conflate"] = False
+        args = message.get("args", [])
+        if kind == COMMAND:
+            self.stats["commands"] += 1
+            self._bus.send_command(message["command"], *args, **kwargs)
+        elif kind == EVENT:
+            self.stats["events"] += 1
+            self._bus.trigger_event(message["event"], message["id"], *args, **kwargs)
+        elif kind == STREAM:
+            self.stats["streams"] += 1
+            self._bus.stream_data(message["id"], message["event"], data, *args, **kwargs)
+        elif kind == QUERY:
+            self.stats["queries"] += 1
+            self._bus.send_query_async(message["query"], *args, **kwargs)
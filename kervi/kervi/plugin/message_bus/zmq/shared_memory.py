@@ -0,0 +1,152 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Shared memory ring buffer used to pass large stream payloads between processes on the same host.
+
+The writing process owns one segment. Payloads are written after each other and wrap around
+when the end of the segment is reached. Only a small descriptor [name, start, length] is send
+over zmq. start is an absolute position that keeps growing, the header of the segment holds the
+size of the ring and the absolute end of the last write, so a reader can tell if a payload is
+overwritten before it is handled.
+
+Shared memory needs python 3.8 or newer, on older versions available is False and the bus
+keeps sending payloads over zmq.
+"""
+
+import struct
+import threading
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+available = shared_memory is not None
+
+# size of the ring, absolute end position of the last write
+_HEADER = struct.Struct("<QQ")
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, create=False, track=False)
+    except TypeError:
+        # Before python 3.13 the resource tracker unlinks attached segments when the
+        # attaching process exits, the segment is owned by the writer so stop tracking it.
+        segment = shared_memory.SharedMemory(name, create=False)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(segment._name, "shared_memory")
+        except Exception:
+            pass
+        return segment
+
+class SharedMemoryWriter(object):
+    def __init__(self, size):
+        self._segment = shared_memory.SharedMemory(create=True, size=_HEADER.size + size)
+        self._size = size
+        self._end = 0
+        self._lock = threading.Lock()
+        _HEADER.pack_into(self._segment.buf, 0, self._size, self._end)
+
+    @property
+    def name(self):
+        return self._segment.name
+
+    def write(self, data):
+        """ Copies data to the ring and returns its descriptor, None if data is too large for the ring """
+        view = memoryview(data)
+        if view.ndim != 1 or view.format != "B":
+            view = view.cast("B")
+        length = view.nbytes
+        if length > self._size // 2:
+            return None
+
+        with self._lock:
+            start = self._end
+            offset = start % self._size
+            if offset + length > self._size:
+                start += self._size - offset
+                offset = 0
+            self._end = start + length
+            # The end is published before the data is written so a reader of a payload
+            # that is being overwritten can see it
+            _HEADER.pack_into(self._segment.buf, 0, self._size, self._end)
+            self._segment.buf[_HEADER.size + offset:_HEADER.size + offset + length] = view
+        return [self.name, start, length]
+
+    def close(self):
+        try:
+            self._segment.close()
+            self._segment.unlink()
+        except Exception:
+            pass
+
+class SharedMemoryReader(object):
+    def __init__(self):
+        self._segments = {}
+        self._failed = set()
+
+    @property
+    def attached(self):
+        return list(self._segments.keys())
+
+    def attach(self, name):
+        """ Attaches to the segment of another process, returns False if it is not on this host """
+        if name in self._segments:
+            return True
+        if name in self._failed:
+            return False
+        try:
+            self._segments[name] = _attach(name)
+            return True
+        except Exception:
+            self._failed.add(name)
+            return False
+
+    def read(self, descriptor):
+        """
+        Returns a memoryview on a copy of the payload or None if it is overwritten or the segment is unknown.
+        The payload is copied out of the ring so the writer can't change it while a handler uses it.
+        """
+        name, start, length = descriptor
+        segment = self._segments.get(name, None)
+        if segment is None:
+            return None
+        size, end = _HEADER.unpack_from(segment.buf, 0)
+        if end - start > size:
+            return None
+        offset = start % size
+        data = bytes(segment.buf[_HEADER.size + offset:_HEADER.size + offset + length])
+        # The writer publishes the end before it writes, if the payload is overwritten
+        # while it is copied the end has passed it
+        size, end = _HEADER.unpack_from(segment.buf, 0)
+        if end - start > size:
+            return None
+        return memoryview(data)
+
+    def close(self):
+        for segment in self._segments.values():
+            try:
+                segment.close()
+            except Exception:
+                pass
+        self._segments = {}
@@ -0,0 +1,142 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Trace context of bus messages.
+
+A traced message carries {"id": trace id, "hops": [[process id, stage, tag, time], ...]}
+in the trace field of its envelope. The bus adds a hop when the message is send, received,
+handled and answered. Messages that a handler sends while it handles a traced message
+continue the trace, so the hops of a message hold the whole path of the request that
+caused it. Each process keeps the paths that ended in it in a TraceCollector.
+"""
+
+import collections
+import threading
+import time
+import uuid
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+if contextvars:
+    # A context variable follows asyncio tasks as well as threads
+    _current_trace = contextvars.ContextVar("kervi_trace", default=None)
+
+    def current_trace():
+        """ The trace of the message that is handled by the calling thread or task """
+        return _current_trace.get()
+
+    def set_current_trace(trace):
+        """ Sets the current trace and returns the previous one """
+        previous = _current_trace.get()
+        _current_trace.set(trace)
+        return previous
+else:
+    _local = threading.local()
+
+    def current_trace():
+        """ The trace of the message that is handled by the calling thread """
+        return getattr(_local, "trace", None)
+
+    def set_current_trace(trace):
+        """ Sets the current trace and returns the previous one """
+        previous = getattr(_local, "trace", None)
+        _local.trace = trace
+        return previous
+
+def new_trace():
+    return {"id": uuid.uuid4().hex, "hops": []}
+
+def add_hop(trace, process_id, stage, tag):
+    """ Returns a copy of trace with a hop added, the hops of a trace are shared by the messages that continue it """
+    return {"id": trace["id"], "hops": trace["hops"] + [[process_id, stage, tag, time.time()]]}
+
+def with_trace(trace, func):
+    """ Wraps func so trace is the current trace while it runs, used for calls on other threads """
+    def call(*args, **kwargs):
+        previous = set_current_trace(trace)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_current_trace(previous)
+    return call
+
+def trace_steps(hops):
+    """ Latency breakdown of a path, the time in milliseconds from each hop to the next """
+    steps = []
+    for hop, next_hop in zip(hops, hops[1:]):
+        steps += [{
+            "from": "%s %s %s" % (hop[0], hop[1], hop[2]),
+            "to": "%s %s %s" % (next_hop[0], next_hop[1], next_hop[2]),
+            "ms": round((next_hop[3] - hop[3]) * 1000, 3)
+        }]
+    return steps
+
+def merge_traces(results):
+    """ Merges the traces returned by getBusTraces from several processes into {trace id: [paths]} """
+    if isinstance(results, dict) or not results:
+        results = [results] if results else []
+    if results and isinstance(results[0], dict):
+        results = [results]
+    merged = {}
+    for process_traces in results:
+        for trace in process_traces or []:
+            merged.setdefault(trace["id"], []).extend(trace["paths"])
+    for paths in merged.values():
+        paths.sort(key=lambda path: path["hops"][-1][3])
+    return merged
+
+class TraceCollector(object):
+    """ Keeps the paths of the last max_traces traces that ended in this process """
+    def __init__(self, max_traces=100):
+        self._max_traces = max_traces
+        self._traces = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        with self._lock:
+            paths = self._traces.get(trace["id"], None)
+            if paths is None:
+                paths = self._traces[trace["id"]] = []
+                while len(self._traces) > self._max_traces:
+                    self._traces.popitem(last=False)
+            paths += [trace["hops"]]
+
+    def as_list(self):
+        with self._lock:
+            traces = list(self._traces.items())
+        result = []
+        for trace_id, paths in traces:
+            result += [{
+                "id": trace_id,
+                "paths": [
+                    {
+                        "hops": hops,
+                        "steps": trace_steps(hops),
+                        "totalMs": round((hops[-1][3] - hops[0][3]) * 1000, 3) if hops else 0
+                    }
+                    for hops in paths
+                ]
+            }]
+        return result
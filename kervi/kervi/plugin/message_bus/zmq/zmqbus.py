@@ -20,21 +20,28 @@
 # SOFTWARE.
 
 import zmq
+import os
 import random
+import socket
+import stat
 import sys
+import tempfile
 import time
 import inspect
 import threading
-import json
 import uuid
 import queue
-import datetime
+import concurrent.futures
 import logging
 from kervi.plugin.message_bus.zmq.named_lists import NamedLists
+from kervi.plugin.message_bus.zmq.message_codec import DEFAULT_CODEC, get_codec, supported_codecs, negotiate_codec, decode_message
+from kervi.plugin.message_bus.zmq.message_codec import supported_compressions, negotiate_compression, is_compressed, decompress_payload
+import kervi.plugin.message_bus.zmq.shared_memory as shared_memory
+import kervi.plugin.message_bus.zmq.recorder as recorder
+import kervi.plugin.message_bus.zmq.tracing as tracing
+from kervi.plugin.message_bus.zmq.metrics import BusMetrics
 import kervi.utility.nethelper as nethelper
 from  kervi.core.utility.kervi_logging import KerviLog
-from kervi.config.configuration import _KerviConfig
-import base64
 
 _KERVI_COMMAND_ADDRESS = "inproc://kervi_commands"
 _KERVI_QUERY_ADDRESS = "inproc://kervi_query"
@@ -42,36 +49,90 @@ _KERVI_QUERY_RESPONSE_ADDRESS = "inproc://kervi_query_response"
 _KERVI_EVENT_ADDRESS = "inproc://kervi_events"
 _KERVI_STREAM_ADDRESS = "inproc://kervi_streams"
 
-class _ObjectEncoder(json.JSONEncoder):
-    def default(self, o):
-        
-        if o and isinstance(o, datetime.datetime):
-           return o.strftime("%Y-%m-%dT%H:%M:%SZ")
-        elif o and isinstance(o, bytes):
-            return base64.b64encode(o).decode("utf8")
-        elif o and isinstance(o, bytearray):
-            return base64.b64encode(o).decode('utf8')
-        elif o and isinstance(o, _KerviConfig):
-            return o.as_dict()
-        else:
-            return json.JSONEncoder.default(self, o)
+# Longest path of a unix domain socket on linux is 107 characters
+_MAX_IPC_PATH = 100
+
+# Times the signal socket tries to bind when its port is taken
+_BIND_ATTEMPTS = 5
+
+def _remove_stale_ipc_files(ipc_dir):
+    """ Removes the socket files of processes that stopped without removing them, no process listens on them """
+    try:
+        names = os.listdir(ipc_dir)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith("kervi-"):
+            continue
+        path = os.path.join(ipc_dir, name)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                probe.connect(path)
+        except ConnectionRefusedError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        except OSError:
+            pass
+        finally:
+            probe.close()
+
+def _encoded_size(encoded):
+    return sum(len(payload) for payload in encoded.values())
 
 class ProcessConnection:
     def __init__(self, bus, is_root=False):
         self.address = None
+        self.endpoint = None
         self.process_id = None
         self.is_connected = False
         self.is_root_connection = is_root
         self.include_ping = False
         self._bus = bus
         self._signal_socket = self._bus._context.socket(zmq.PUB)
+        self._signal_socket.setsockopt(zmq.SNDHWM, self._bus._control_send_hwm)
         self._lock = threading.Lock()
+        # Bulk messages like streams are send on their own socket so they never queue in front
+        # of control messages. When its high-water mark is reached the message is dropped.
+        self._bulk_socket = self._bus._context.socket(zmq.PUB)
+        self._bulk_socket.setsockopt(zmq.SNDHWM, self._bus._bulk_send_hwm)
+        self._bulk_socket.setsockopt(zmq.XPUB_NODROP, 1)
+        self._bulk_lock = threading.Lock()
+        self.dropped = 0
         self.last_ping = None
+        self.last_seen = None
+        self.members = None
+        self.members_version = None
+        self.members_requested = False
+        self.members_legacy = False
+        self.codec = get_codec(DEFAULT_CODEC)
+        self.compression = None
+        self.subscriptions = None
+        self.subscriptions_version = None
+        self.queries = None
+        self.shared_memory = False
         #self._signal_socket.setsockopt(zmq.SNDHWM, 25)
 
     def connect(self, address):
         self.address = address
-        self._signal_socket.connect(address)
+        self._connect(address)
+
+    def _connect(self, endpoint):
+        self.endpoint = endpoint
+        self._signal_socket.connect(endpoint)
+        self._bulk_socket.connect(endpoint)
+
+    def use_endpoint(self, endpoint):
+        """ Sends to the process through another address it is bound to, address is kept as the id of the process.
+        Used to change to the ipc address of a process on the same host. """
+        with self._lock, self._bulk_lock:
+            if self._signal_socket is None or endpoint == self.endpoint:
+                return
+            self._signal_socket.disconnect(self.endpoint)
+            self._bulk_socket.disconnect(self.endpoint)
+            self._connect(endpoint)
 
     # def connect_to(self, address, process_id):
     #     signal_message = {"address": address, "processId": process_id}
@@ -82,7 +143,7 @@ class ProcessConnection:
     def register(self, address, process_id):
         self.address = address
         self.process_id = process_id
-        self._signal_socket.connect(address)
+        self._connect(address)
 
     def disconnect(self):
         if self._signal_socket:
@@ -93,6 +154,11 @@ class ProcessConnection:
                 self._signal_socket = None
             finally:
                 self._lock.release()
+        if self._bulk_socket:
+            with self._bulk_lock:
+                self._bulk_socket.setsockopt(zmq.LINGER, 0)
+                self._bulk_socket.close()
+                self._bulk_socket = None
 
     def ping(self):
         self.last_ping = time.time()
@@ -100,11 +166,38 @@ class ProcessConnection:
     @property
     def is_alive(self):
         if self.is_connected:
-            if time.time() - self.last_ping < 2:
+            if time.time() - self.last_ping < self._bus._liveness_timeout:
                 return True
         return False
 
-    def send_package(self, package):
+    def update_members(self, version, members, delta):
+        """ Updates the processes the peer knows from its heartbeat, returns True if they changed.
+        members is the full list and delta the changes since delta["from"]. When the version changed
+        and no usable delta is received members_requested is set so the full list is asked for. """
+        if members is not None:
+            self.members = dict((member["processId"], member["address"]) for member in members)
+            self.members_version = version
+            self.members_requested = False
+            return True
+        if version is None or version == self.members_version:
+            return False
+        if delta and self.members is not None and delta["from"] == self.members_version:
+            for member in delta["added"]:
+                self.members[member["processId"]] = member["address"]
+            for process_id in delta["removed"]:
+                self.members.pop(process_id, None)
+            self.members_version = version
+            return True
+        self.members_requested = True
+        return False
+
+    def knows(self, process_id):
+        return self.members is not None and process_id in self.members
+
+    def send_package(self, package, bulk=False):
+        """ Sends package to the process, returns False if a bulk package is dropped """
+        if bulk:
+            return self._send_bulk(package)
         self._lock.acquire()
         try:
             if self._signal_socket:
@@ -113,6 +206,70 @@ class ProcessConnection:
             self._bus.log.exception("send package exception")
         finally:
             self._lock.release()
+        return True
+
+    def _send_bulk(self, package):
+        with self._bulk_lock:
+            try:
+                if self._bulk_socket:
+                    self._bulk_socket.send_multipart(package, zmq.NOBLOCK)
+            except zmq.Again:
+                self.dropped += 1
+                return False
+            except Exception as ex:
+                self._bus.log.exception("send package exception")
+        return True
+
+    def update_subscriptions(self, version, subscriptions, query_routing=False):
+        """ Updates the tags the process is subscribed to from its ping.
+        The subscriptions are unknown (None) until a ping with the full list is received.
+        With query_routing the subscriptions hold a query:name tag for each query handler of the process. """
+        if subscriptions is not None:
+            self.subscriptions = tuple(subscription.encode() for subscription in subscriptions)
+            self.subscriptions_version = version
+            if query_routing:
+                self.queries = frozenset(subscription for subscription in self.subscriptions if subscription.startswith(b"query:"))
+            else:
+                self.queries = None
+        elif version != self.subscriptions_version:
+            self.subscriptions = None
+            self.queries = None
+
+    def is_subscribed(self, tag):
+        """ True if the process has a subscription that matches tag or if its subscriptions are unknown """
+        subscriptions = self.subscriptions
+        if subscriptions is None:
+            return True
+        return tag.startswith(subscriptions)
+
+    def handles_query(self, tag):
+        """ True if the process has a handler for the query tag or if its handlers are unknown """
+        queries = self.queries
+        if queries is None:
+            return True
+        return tag in queries
+
+    def send_message(self, tag, message, encoded, *frames, bulk=False):
+        """ Sends message encoded with the codec negotiated with this process.
+        encoded caches the payload per codec so a message is encoded once per codec
+        when it is send to several connections. Payloads above the compression threshold
+        are compressed when a compressor is negotiated with the process. """
+        payload = encoded.get(self.codec.name, None)
+        if payload is None:
+            payload = self.codec.encode(message)
+            encoded[self.codec.name] = payload
+        compression = self.compression
+        if compression and len(payload) >= self._bus._compression_threshold:
+            key = self.codec.name + "+" + compression.name
+            compressed = encoded.get(key, None)
+            if compressed is None:
+                start = time.time()
+                compressed = compression.compress(payload)
+                self._bus._metrics.compressed(tag.decode(), len(payload), len(compressed), time.time() - start)
+                encoded[key] = compressed
+            if len(compressed) < len(payload):
+                payload = compressed
+        return self.send_package([tag, payload] + list(frames), bulk)
 
 class ZMQPingThread(threading.Thread):
     def __init__(self, bus):
@@ -120,40 +277,293 @@ class ZMQPingThread(threading.Thread):
         self._bus = bus
         self.daemon = True
         self._terminate = False
+        self._wake = threading.Event()
 
     def stop(self):
         self._terminate = True
+        self._wake.set()
+
+    def wake(self):
+        """ Sends the next ping now instead of waiting for the interval """
+        self._wake.set()
 
     def run(self):
         while not self._terminate:
             self._bus._ping_connections()
-            time.sleep(.5)
+            self._bus._expire_queries()
+            self._bus._dump_metrics()
+            self._wake.wait(self._bus._ping_interval)
+            self._wake.clear()
+
+class ZMQQueryWorker(threading.Thread):
+    def __init__(self, executor):
+        threading.Thread.__init__(self, None, None, "ZMQQuery")
+        self._executor = executor
+        self.daemon = True
+        self._terminate = False
 
-class ZMQQueryThread(threading.Thread):
-    def __init__(self, bus, tag, message):
-        threading.Thread.__init__(self, None, None, "ZMQQyery")
+    def stop(self):
+        self._terminate = True
+
+    def run(self):
+        while not self._terminate:
+            try:
+                item = self._executor._queue.get(True, 1)
+            except queue.Empty:
+                if self._executor._retire(self):
+                    break
+                continue
+            self._executor._execute(*item)
+
+class ZMQQueryExecutor:
+    """
+    Handles incoming queries on a bounded pool of worker threads.
+
+    Workers are started on demand up to max_workers. When the queue is full a query is
+    answered at once with an empty rejected response, and a query that waited in the queue
+    past its deadline is answered with an empty timeout response instead of being handled.
+
+    A handler that sends a query and waits for the response doesn't hold on to its worker,
+    while it waits an extra worker can be started so nested queries can't use up the pool.
+    Extra workers stop when they have been idle for a second.
+    """
+    def __init__(self, bus, max_workers=16, queue_size=256, deadline=10):
+        self._bus = bus
+        self._max_workers = max_workers
+        self._deadline = deadline
+        self._queue = queue.Queue(queue_size)
+        self._workers = []
+        self._busy = 0
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._executed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._max_queue_depth = 0
+
+    def submit(self, tag, message):
+        timeout = message.get("timeout", None)
+        if not timeout or timeout > self._deadline:
+            timeout = self._deadline
+        try:
+            now = time.time()
+            self._queue.put_nowait((tag, message, now + timeout, now))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            self._bus._reject_query(tag, message, "rejected")
+            return
+
+        with self._lock:
+            depth = self._queue.qsize()
+            if depth > self._max_queue_depth:
+                self._max_queue_depth = depth
+            self._start_worker(depth)
+
+    def _start_worker(self, depth):
+        """ Starts a worker if there are more queries than idle workers, must be called with _lock """
+        if self._busy + depth > len(self._workers) and len(self._workers) < self._max_workers + self._waiting:
+            worker = ZMQQueryWorker(self)
+            self._workers += [worker]
+            worker.start()
+
+    def _retire(self, worker):
+        """ Removes an idle worker that was started while other workers waited, returns True if it should stop """
+        with self._lock:
+            if len(self._workers) > self._max_workers + self._waiting:
+                self._workers.remove(worker)
+                return True
+        return False
+
+    def begin_wait(self):
+        """
+        Called before the calling thread waits for a query response, returns True if it is
+        a worker of this executor. Its place in the pool is free until end_wait is called.
+        """
+        thread = threading.current_thread()
+        if not isinstance(thread, ZMQQueryWorker) or thread._executor is not self:
+            return False
+        with self._lock:
+            self._waiting += 1
+            self._start_worker(self._queue.qsize())
+        return True
+
+    def end_wait(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def _execute(self, tag, message, deadline, queued=None):
+        with self._lock:
+            self._busy += 1
+        if queued:
+            self._bus._metrics.queue_wait(tag, time.time() - queued)
+        try:
+            if time.time() > deadline:
+                with self._lock:
+                    self._expired += 1
+                self._bus._reject_query(tag, message, "timeout")
+            else:
+                self._bus._handle_message(tag, message)
+                with self._lock:
+                    self._executed += 1
+        except Exception:
+            self._bus.log.exception("query handler exception: %s", tag)
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "max_workers": self._max_workers,
+                "busy": self._busy,
+                "waiting": self._waiting,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth,
+                "queue_size": self._queue.maxsize,
+                "executed": self._executed,
+                "rejected": self._rejected,
+                "expired": self._expired
+            }
+
+class ZMQConflationThread(threading.Thread):
+    """
+    Holds back received events that arrive faster than the conflation window of their event name.
+    Per tag only the newest held event is kept and it is handed to the handlers when the window ends.
+    """
+    def __init__(self, bus):
+        threading.Thread.__init__(self, None, None, "ZMQConflation")
         self._bus = bus
-        self._message = message
-        self._tag = tag
         self.daemon = True
         self._terminate = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_send = {}
+        self.conflated = 0
+
+    def hold(self, key, window, event):
+        """ Returns True if the event is held back, False if it should be handled now """
+        now = time.time()
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = (self._pending[key][0], event)
+                self.conflated += 1
+                return True
+            last_send = self._last_send.get(key, None)
+            if last_send is not None and now - last_send < window:
+                self._pending[key] = (last_send + window, event)
+                self._wake.set()
+                return True
+            self._last_send[key] = now
+            return False
 
     def stop(self):
         self._terminate = True
+        self._wake.set()
+
+    def _flush(self):
+        """ Queues the held events that are due and returns the seconds until the next is due """
+        now = time.time()
+        due_events = []
+        next_due = now + 1
+        with self._lock:
+            for key, (due, event) in list(self._pending.items()):
+                if due <= now:
+                    del self._pending[key]
+                    self._last_send[key] = now
+                    due_events += [event]
+                elif due < next_due:
+                    next_due = due
+        for tag, message, stream_data in due_events:
+            try:
+                self._bus._queue_message(tag, message, stream_data, True)
+            except Exception:
+                self._bus.log.exception("conflated event exception: %s", tag)
+        return next_due - now
 
     def run(self):
-        self._bus._handle_message(self._tag, self._message)
+        while not self._terminate:
+            self._wake.wait(self._flush())
+            self._wake.clear()
 
 class ZMQHandlerThread(threading.Thread):
-    def __init__(self, bus):
+    """
+    Handles messages in the order they are added. With max_size the queue is bounded,
+    a message that is added with block waits up to block_timeout for room in a full queue
+    and is dropped if there is none. Without block the oldest message is dropped to make room,
+    so a receiver that is shared with other messages never waits. Dropped messages are counted
+    in dropped and in the metrics of their tag.
+    """
+    def __init__(self, bus, max_size=0, block_timeout=1):
         threading.Thread.__init__(self, None, None, "ZMQHandler")
         self._bus = bus
         self.daemon = True
         self._terminate = False
-        self._messages = queue.Queue()
+        self._messages = queue.Queue(max_size)
+        self._max_size = max_size
+        self._block_timeout = block_timeout
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self.conflated = 0
+        self.dropped = 0
+
+    def _drop_oldest(self):
+        try:
+            tag, message, stream_data, queued = self._messages.get_nowait()
+            self._messages.task_done()
+        except queue.Empty:
+            return
+        if message is None:
+            with self._pending_lock:
+                self._pending.pop(tag, None)
+        self.dropped += 1
+        self._bus._metrics.dropped(tag)
+
+    def _put(self, tag, item, block):
+        if not self._max_size:
+            self._messages.put(item)
+            return
+        if block:
+            try:
+                self._messages.put(item, True, self._block_timeout)
+            except queue.Full:
+                if item[1] is None:
+                    with self._pending_lock:
+                        self._pending.pop(tag, None)
+                self.dropped += 1
+                self._bus._metrics.dropped(tag)
+            return
+        while True:
+            try:
+                self._messages.put_nowait(item)
+                return
+            except queue.Full:
+                self._drop_oldest()
+
+    def add_message(self, tag, message, stream_data, conflate=False, block=False):
+        if conflate:
+            # Only the newest message for a conflated tag is kept while it waits in the queue,
+            # the queue holds a marker that picks up the pending message when it is handled
+            with self._pending_lock:
+                replaced = tag in self._pending
+                self._pending[tag] = (message, stream_data)
+                if replaced:
+                    self.conflated += 1
+                    return
+            self._put(tag, (tag, None, None, time.time()), block)
+        else:
+            self._put(tag, (tag, message, stream_data, time.time()), block)
 
-    def add_message(self, tag, message, stream_data):
-        self._messages.put((tag, message, stream_data))
+    @property
+    def queue_length(self):
+        return self._messages.qsize()
 
     def stop(self):
         self._terminate = True
@@ -161,18 +571,51 @@ class ZMQHandlerThread(threading.Thread):
     def run(self):
         while not self._terminate:
             try:
-                tag, message, stream_data = self._messages.get(True, 1)
+                tag, message, stream_data, queued = self._messages.get(True, 1)
+                if message is None:
+                    with self._pending_lock:
+                        message, stream_data = self._pending.pop(tag)
+                self._bus._metrics.queue_wait(tag, time.time() - queued)
                 self._bus._handle_message(tag, message, stream_data)
                 self._messages.task_done()
             except queue.Empty:
                 pass
 
+def dispatch_frames(bus, frames):
+    """ Decodes a received multipart message and hands it to bus, returns False for the exit signal """
+    stream_data = None
+    if len(frames) == 2:
+        [tag, payload] = frames
+    if len(frames) == 3:
+        [tag, payload, stream_data] = frames
+    size = len(payload) + (len(stream_data) if stream_data else 0)
+    decompress_time = None
+    if is_compressed(payload):
+        start = time.time()
+        payload = decompress_payload(payload)
+        decompress_time = time.time() - start
+    message = decode_message(payload)
+    if tag == b"signal:exit":
+        return False
+    elif tag == b"queryResponse":
+        if decompress_time is not None:
+            bus._metrics.decompressed("queryResponse", decompress_time)
+        bus.resolve_response(message)
+    else:
+        tag = tag.decode('utf-8')
+        bus._metrics.message_in(tag, size)
+        if decompress_time is not None:
+            bus._metrics.decompressed(tag, decompress_time)
+        bus._add_message(tag, message, stream_data)
+    return True
+
 class ZMQMessageThread(threading.Thread):
-    def __init__(self, bus, address, bind=False):
+    def __init__(self, bus, address, bind=False, zero_copy=False):
         threading.Thread.__init__(self, None, None, "ZMQMessage")
         self._bus = bus
         self._address = address
         self._bind = bind
+        self._zero_copy = zero_copy
         self.daemon = True
         self._terminate = False
         self._socket = self._bus._context.socket(zmq.SUB)
@@ -189,28 +632,25 @@ class ZMQMessageThread(threading.Thread):
 
     def connect(self):
         if self._bind:
-            self._socket.bind(self._address)
-        else:
-            self._socket.connect(self._address)
+            # The bus binds the signal socket as its port can change when it is taken
+            self._address = self._bus._bind_signal(self._socket)
+            return
+        addresses = self._address if isinstance(self._address, list) else [self._address]
+        for address in addresses:
+            self._socket.connect(address)
 
     def run(self):
         while not self._terminate:
             connection_message = None
             try:
-                connection_message = self._socket.recv_multipart()
-                stream_data = None
-                if len(connection_message) == 2:
-                    [tag, json_message] = connection_message
-                if len(connection_message) == 3:
-                    [tag, json_message, stream_data] = connection_message
-                message = json.loads(json_message.decode('utf8'))
-                if tag == b"signal:exit":
-                    if not self._bind:
-                        break
-                elif tag == b"queryResponse":
-                    self._bus.resolve_response(message)
+                if self._zero_copy:
+                    # Stream data is kept in the received frame, zmq doesn't reuse its buffer
+                    frames = self._socket.recv_multipart(copy=False)
+                    connection_message = [frame.bytes for frame in frames[:2]] + [frame.buffer for frame in frames[2:]]
                 else:
-                    self._bus._add_message(tag.decode('utf-8'), message, stream_data)
+                    connection_message = self._socket.recv_multipart()
+                if not dispatch_frames(self._bus, connection_message) and not self._bind:
+                    break
             except zmq.ZMQError as e:
                 if e.errno == zmq.EAGAIN:
                     time.sleep(.001)
@@ -220,7 +660,7 @@ class ZMQMessageThread(threading.Thread):
                 else:
                     self._bus.log.exception("message zmq exception: %s %s %s", self._address, e, e.errno)
             except Exception as e:
-                self.bus.log.exception("message exception: %s %s %s", self._address, e, connection_message)
+                self._bus.log.exception("message exception: %s %s %s", self._address, e, connection_message)
         self._socket.close()
 
 class ZMQBus():
@@ -232,37 +672,82 @@ class ZMQBus():
     _query_sock = None
     log = None
 
-    def __init__(self):
-        pass
+    def __init__(self, config=None):
+        self._config = config
+
+    def _config_value(self, name, default_value=None):
+        if self._config:
+            return self._config.get(name, default_value)
+        return default_value
 
     def set_log(self, logName):
         self.log = KerviLog(logName)
 
     @property
     def root_gone(self):
-        return not self._is_root and time.time() - self._last_ping > 10
+        return not self._is_root and time.time() - self._last_ping > self._root_timeout
 
     def reset_bus(self, process_id, signal_port, ip=None, root_address=None, event_port=None):
         self._handlers = NamedLists()
+        self._connections = []
+        self._connections_by_id = {}
         self._process_id = process_id
         self._query_id_count = 0
         self._uuid_handler = uuid.uuid4().hex
         self._is_root = (root_address is None)
         self._root_address = root_address
         self._signal_address = "tcp://"+ ip +":" + str(signal_port)
+        # Processes on the same host send to each other through a unix domain socket,
+        # the tcp address is used by processes on other hosts
+        self._host = socket.gethostname()
+        self._ipc_address = None
+        if self._config_value("ipc", True) and zmq.has("ipc"):
+            ipc_path = os.path.join(self._config_value("ipc_dir", None) or tempfile.gettempdir(), "kervi-" + self._uuid_handler)
+            if len(ipc_path) <= _MAX_IPC_PATH:
+                self._ipc_address = "ipc://" + ipc_path
         self._context = zmq.Context()
-        self._response_events = []
+        self._codec = get_codec(self._config_value("codec", DEFAULT_CODEC))
+        self._response_events = {}
+        self._response_lock = threading.Lock()
         self._last_ping = time.time()
         self._connections_lock = threading.Lock()
 
         self._linked_handlers = []
         self._linked_response_handlers = []
+        self._dispatch_table = {}
+        self._metrics = BusMetrics(self._config_value("metrics", False))
+        self._metrics_dump_interval = self._config_value("metrics_dump_interval", 0)
+        self._metrics_dump_time = time.time()
+
+        # Messages of the bulk types are send and handled in their own lane so they are never
+        # queued in front of commands, queries and events. When the lane is full a process that
+        # sends to itself waits for room, messages from other processes are dropped.
+        self._bulk_prefixes = tuple(message_type + ":" for message_type in self._config_value("bulk_types", ["stream"]))
+        self._control_send_hwm = self._config_value("control_send_hwm", 1000)
+        self._bulk_send_hwm = self._config_value("bulk_send_hwm", 16)
 
         self._message_threads = []
-        self._message_thread = 0
-        self._message_threads_lock = threading.Lock()
-        for i in range(5):
-            self._message_threads += [ZMQHandlerThread(self)]
+        for i in range(max(1, self._config_value("handler_threads", 5))):
+            self._message_threads += [self._create_handler_worker()]
+        self._bulk_threads = []
+        for i in range(max(1, self._config_value("bulk_handler_threads", 2))):
+            self._bulk_threads += [self._create_handler_worker(
+                self._config_value("bulk_queue_size", 32),
+                self._config_value("bulk_block_timeout", 1)
+            )]
+
+        conflation = self._config_value("conflation", {})
+        if hasattr(conflation, "as_dict"):
+            conflation = conflation.as_dict()
+        self._conflation = dict(conflation)
+        self._unconflated_tags = {}
+        self._conflation_thread = self._create_conflation_worker()
+
+        self._query_executor = self._create_query_executor(
+            self._config_value("query_workers", 16),
+            self._config_value("query_queue_size", 256),
+            self._config_value("query_timeout", 10)
+        )
 
         self._root_event = None
         self._event_socket = self._context.socket(zmq.PUB)
@@ -277,36 +762,111 @@ class ZMQBus():
         self._query_socket = self._context.socket(zmq.PUB)
         self._query_socket.bind(_KERVI_QUERY_ADDRESS)
 
-        self._message_handler = ZMQMessageThread(self, self._signal_address, True)
-        self._query_handler = ZMQMessageThread(self, _KERVI_QUERY_ADDRESS)
-        self._event_handler = ZMQMessageThread(self, _KERVI_EVENT_ADDRESS)
-        self._stream_handler = ZMQMessageThread(self, _KERVI_STREAM_ADDRESS)
-        self._command_handler = ZMQMessageThread(self, _KERVI_COMMAND_ADDRESS)
+        self._message_handler = self._create_receiver(self._signal_address, True, True)
+        self._query_handler = self._create_receiver(_KERVI_QUERY_ADDRESS)
+        self._event_handler = self._create_receiver(_KERVI_EVENT_ADDRESS)
+        self._stream_handler = self._create_receiver(_KERVI_STREAM_ADDRESS)
+        self._command_handler = self._create_receiver(_KERVI_COMMAND_ADDRESS)
+
+        self._ping_thread = self._create_ping_worker()
+        self._ping_count = 0
+        self._ping_interval = self._config_value("ping_interval", .5)
+        self._liveness_timeout = self._config_value("liveness_timeout", 2)
+        self._member_timeout = self._config_value("member_timeout", 10)
+        self._root_timeout = self._config_value("root_timeout", 10)
+        self._members_version = 0
+        self._members_send_version = None
+        self._members_deltas = []
+        self._members_requested = False
+        self._subscriptions = {}
+        self._subscriptions_count = 0
+        self._subscriptions_version = None
+        self._subscriptions_send_version = None
+        self._subscriptions_lock = threading.Lock()
+        self._local_subscriptions = (None, ())
 
         self._register_handler("signal:ping", self._on_ping)
-        self._message_handler.register("signal:ping")
-        self._message_handler.register("signal:exit")
+        self._subscribe("signal:ping")
+        self._subscribe("signal:exit")
         
-        self._message_handler.register("queryResponse")
-        self._message_handler.register("query:")
+        self._subscribe("queryResponse")
+        self._subscribe("query:")
 
         self._query_handler.register("query:")
 
-        self._message_handler.register("signal:exit")
+        self._subscribe("signal:exit")
         self._query_handler.register("signal:exit")
         self._event_handler.register("signal:exit")
         self._stream_handler.register("signal:exit")
         self._command_handler.register("signal:exit")
 
-        self._ping_thread = ZMQPingThread(self)
         self._command_lock = threading.Lock()
         self._event_lock = threading.Lock()
         self._stream_lock = threading.Lock()
         self._query_lock = threading.Lock()
 
-        self._observed_streams = []
+        self._observed_streams = set()
+
+        self._shared_memory_size = self._config_value("shared_memory_size", 16 * 1024 * 1024)
+        self._shared_memory_threshold = self._config_value("shared_memory_threshold", 16 * 1024)
+        self._compression = self._config_value("compression", "zlib")
+        self._compression_threshold = self._config_value("compression_threshold", 4096)
+        self._shared_memory_writer = None
+        self._shared_memory_reader = shared_memory.SharedMemoryReader() if shared_memory.available else None
 
         self.register_query_handler("GetRoutingInfo", self._get_routing_info)
+        self.register_query_handler("getBusMetrics", self.get_metrics)
+
+        # Share of the messages send outside a traced request that start a new trace
+        self._trace_sample = self._config_value("trace_sample", 0.0)
+        self._traces = tracing.TraceCollector(self._config_value("trace_history", 100))
+        self.register_query_handler("getBusTraces", self.get_traces)
+
+        self._recorder = None
+        if self._config_value("record_file", None):
+            self.start_recording(self._config_value("record_file"), self._config_value("record_stream_sample", 1.0))
+
+    # The workers of the bus are created by these methods so a bus that runs them in
+    # another way can replace them with objects that have the same methods
+
+    def _create_receiver(self, address, bind=False, zero_copy=False):
+        return ZMQMessageThread(self, address, bind, zero_copy)
+
+    def _create_handler_worker(self, max_size=0, block_timeout=1):
+        return ZMQHandlerThread(self, max_size, block_timeout)
+
+    def _create_query_executor(self, max_workers, queue_size, deadline):
+        return ZMQQueryExecutor(self, max_workers, queue_size, deadline)
+
+    def _create_ping_worker(self):
+        return ZMQPingThread(self)
+
+    def _create_conflation_worker(self):
+        return ZMQConflationThread(self)
+
+    def _subscribe(self, tag):
+        """ Subscribes tag on the signal socket and announces the change to other processes """
+        self._message_handler.register(tag)
+        with self._subscriptions_lock:
+            count = self._subscriptions.get(tag, 0)
+            self._subscriptions[tag] = count + 1
+            if count == 0:
+                self._subscriptions_changed()
+
+    def _unsubscribe(self, tag):
+        self._message_handler.unregister(tag)
+        with self._subscriptions_lock:
+            count = self._subscriptions.get(tag, 0)
+            if count <= 1:
+                self._subscriptions.pop(tag, None)
+                self._subscriptions_changed()
+            else:
+                self._subscriptions[tag] = count - 1
+
+    def _subscriptions_changed(self):
+        self._subscriptions_count += 1
+        self._subscriptions_version = self._uuid_handler + "-" + str(self._subscriptions_count)
+        self._ping_thread.wake()
 
     def _get_routing_info(self):
         result = []
@@ -338,89 +898,150 @@ class ZMQBus():
                 })
         return result
     
-    def _add_linked_handler(self, func, **kwargs):
+    def _handler_entry(self, func, **kwargs):
+        """ Handler tuple used by dispatch, groups and scopes are converted to sets once here
+        so authorization of a message is set intersections. """
         groups = kwargs.get("groups", None)
         scopes = kwargs.get("scopes", [])
         argspec = inspect.getargspec(func)
-        self._linked_handlers.append((func, groups, scopes, argspec.keywords != None))
+        return (
+            func,
+            frozenset(groups) if groups else None,
+            frozenset(scopes) if scopes else frozenset(),
+            argspec.keywords != None
+        )
+
+    def _add_linked_handler(self, func, **kwargs):
+        self._linked_handlers.append(self._handler_entry(func, **kwargs))
+        self._invalidate_dispatch_table()
 
 
     def _add_linked_response_handler(self, handler):
         self._linked_response_handlers.append(handler)
 
     def _register_handler(self, tag, func, **kwargs):
-        groups = kwargs.get("groups", None)
-        scopes = kwargs.get("scopes", [])
-
-        argspec = inspect.getargspec(func)
-        self._handlers.add(tag, (func, groups, scopes, argspec.keywords != None))
+        self._handlers.add(tag, self._handler_entry(func, **kwargs))
+        self._invalidate_dispatch_table()
 
     
     def _unregister_handler(self, tag, func, **kwargs):
-        groups = kwargs.get("groups", None)
-        scopes = kwargs.get("scopes", [])
-
-        argspec = inspect.getargspec(func)
-        self._handlers.remove(tag, (func, groups, scopes, argspec.keywords != None))
+        self._handlers.remove(tag, self._handler_entry(func, **kwargs))
+        self._invalidate_dispatch_table()
+
+    def _invalidate_dispatch_table(self):
+        # Replace rather than clear so a handler thread that is filling the old table
+        # while handlers are changed can't leave stale entries in the new one.
+        self._dispatch_table = {}
+
+    def _get_dispatch_entry(self, tag):
+        """ Returns (handlers, stream_event, conflation) for an incoming tag.
+        The entry combines linked handlers, handlers for the exact tag and handlers for the
+        event:name: / stream:id: wildcard prefix. It is built on first use of a tag and kept
+        until a handler is registered or unregistered. conflation is the conflation window of
+        the event or None if events with the tag are not conflated. """
+        dispatch_table = self._dispatch_table
+        entry = dispatch_table.get(tag, None)
+        if entry is None:
+            func_list = list(self._linked_handlers)
+            functions = self._handlers.get_list_data(tag)
+            if functions:
+                func_list += functions
+
+            stream_event = None
+            if tag.startswith("event:") or tag.startswith("stream:"):
+                tag_parts = tag.split(":")
+                prefix = tag_parts[0] + ":" + tag_parts[1] + ":"
+                if tag_parts[0] == "stream" and len(tag_parts) > 2:
+                    stream_event = tag_parts[2]
+
+                if prefix != tag:
+                    functions = self._handlers.get_list_data(prefix)
+                    if functions:
+                        func_list += functions
+
+            conflation = None
+            if tag.startswith("event:"):
+                if (
+                        tag_parts[1] in self._conflation and
+                        not tag in self._unconflated_tags and
+                        not prefix in self._unconflated_tags
+                    ):
+                    conflation = self._conflation[tag_parts[1]] or 0
+
+            entry = (tuple(func_list), stream_event, conflation)
+            dispatch_table[tag] = entry
+        return entry
 
-    
     def get_handler_info(self):
         return self._handlers.get_list_names()
 
     def get_connection_info(self):
         result = []
         for connection in self._connections:
-            result += [{"process": connection.process_id, "address": connection.address}]
+            result += [{"process": connection.process_id, "address": connection.address, "endpoint": connection.endpoint}]
         return result
 
-    def _add_message(self, tag, message, stream_data):
-        with self._message_threads_lock:
-            if tag.startswith("query:"):
-                query = ZMQQueryThread(self, tag, message)
-                query.start()
-            else:
-                self._message_threads[self._message_thread].add_message(tag, message, stream_data)
-                self._message_thread += 1
-                if self._message_thread >= len(self._message_threads):
-                    self._message_thread = 0
-
-    def _handle_message(self, tag, message, stream_data=None):
-        func_list = [] 
-        func_list += self._linked_handlers
-        functions = self._handlers.get_list_data(tag)
-        if functions:
-            func_list += functions
-        
-        if tag.startswith("event:"):
-            tag_parts = tag.split(":")
-            event = "event:" + tag_parts[1] +":"
-            if event!=tag:
-                functions = self._handlers.get_list_data(event)
-                if functions:
-                    func_list += functions
-
-        
-        stream_event = None
-        if tag.startswith("stream:"):
-            
-            tag_parts = tag.split(":")
-            event = "stream:" + tag_parts[1] +":"
-            if len(tag_parts)>2:
-                stream_event = tag_parts[2]
-            
-            try:
-                self._observed_streams.index(tag)
-            except ValueError:
-                #print("s", tag, event, stream_event, self._process_id)
-                self._observed_streams.append(tag)
-
-            
-            if event!=tag:
-                functions = self._handlers.get_list_data(event)
-                if functions:
-                    func_list += functions
+    def _is_subscribed_locally(self, tag):
+        """ True if tag matches a subscription of this process, the same prefix match as a zmq subscription """
+        local_subscriptions = self._local_subscriptions
+        if local_subscriptions[0] != self._subscriptions_version:
+            with self._subscriptions_lock:
+                local_subscriptions = (self._subscriptions_version, tuple(self._subscriptions.keys()))
+            self._local_subscriptions = local_subscriptions
+        return tag.startswith(local_subscriptions[1])
+
+    def _deliver_local(self, tag, message, stream_data=None):
+        """ Hands a message send by this process to the local handler queues,
+        the message is not encoded and does not pass a socket.
+        Local handlers get the arguments of the sender and not copies, as do senders of
+        local queries with the result, handlers must not change the arguments they get. """
+        if self._is_subscribed_locally(tag):
+            if stream_data is not None and not isinstance(stream_data, bytes):
+                stream_data = bytes(stream_data)
+            # The envelope is copied as the bus adds to it, the arguments are shared
+            self._add_local_message(tag, dict(message), stream_data)
+
+    def _add_local_message(self, tag, message, stream_data):
+        self._metrics.message_in(tag, len(stream_data) if stream_data else 0)
+        # The sender waits for room in a full bulk queue instead of dropping its own messages
+        self._add_message(tag, message, stream_data, True)
+
+    def _add_message(self, tag, message, stream_data, local=False):
+        if "trace" in message:
+            message = dict(message, trace=tracing.add_hop(message["trace"], self._process_id, "receive", tag))
+
+        if tag.startswith("query:"):
+            self._query_executor.submit(tag, message)
+            return
+
+        # Events are conflated by the receiver so handlers that need every event can opt out
+        conflation = self._get_dispatch_entry(tag)[2]
+        if conflation is not None and message.get("conflate", True) is False:
+            conflation = None
+        if conflation and self._conflation_thread.hold(tag, conflation, (tag, message, stream_data)):
+            return
+        self._queue_message(tag, message, stream_data, conflation is not None, local)
+
+    def _queue_message(self, tag, message, stream_data, conflate=False, block=False):
+        message_threads = self._bulk_threads if tag.startswith(self._bulk_prefixes) else self._message_threads
+        # Messages with the same tag are always handled by the same thread so
+        # they are handled in the order they are received
+        message_threads[hash(tag) % len(message_threads)].add_message(tag, message, stream_data, conflate, block)
+
+    def get_handler_queue_lengths(self):
+        return [message_thread.queue_length for message_thread in self._message_threads]
+
+    def _prepare_call(self, tag, message, stream_data=None):
+        """
+        Finds the handlers of tag that the sender of message is authorized to call.
+        Returns (handlers, args, kwargs, response_address) where handlers is a list of
+        (func, has_keywords) or None if the message can not be handled.
+        """
+        func_list, stream_event, conflation = self._get_dispatch_entry(tag)
+
+        if stream_event is not None:
+            self._observed_streams.add(tag)
 
-        result = []
         session = None
         session_groups = None
         message_scopes = None
@@ -447,7 +1068,8 @@ class ZMQBus():
         message_args = []
         message_kwargs = dict()
         if "kwargs" in message:
-            message_kwargs = message["kwargs"]
+            # Copied as messages from this process are shared with the senders to other processes
+            message_kwargs = dict(message["kwargs"])
 
         if "id" in message:
             if tag.startswith("query:"):
@@ -458,8 +1080,15 @@ class ZMQBus():
         if stream_event:
             message_args += [stream_event]
 
+        if stream_data is None and "shm" in message:
+            stream_data = self._shared_memory_reader.read(message["shm"]) if self._shared_memory_reader else None
+            if stream_data is None:
+                self.log.warn("stream data in shared memory is overwritten or not available: %s", tag)
+                return None
+
         if stream_data:
-            message_args += [stream_data]
+            # Handlers get a memoryview wherever the data comes from
+            message_args += [memoryview(stream_data)]
 
         response_address = None
         if "responseAddress" in message:
@@ -477,51 +1106,143 @@ class ZMQBus():
         if "args" in message:
             message_args += message["args"]
 
-        message_kwargs = dict(message_kwargs, injected=injected, session=session, topic_tag=tag, response_address=response_address, process_id=process_id)
-        send_response = True
-        try:
-            if func_list:
-                for func, groups, handler_scopes, has_keywords in func_list:
-                    authorized = True
-                    if session_groups != None and groups and len(groups) > 0:
-                        for group in groups:
-                            if group in session_groups:
-                                break
-                        else:
-                            authorized = False
-
-                    if message_scopes:
-                        for message_scope in message_scopes:
-                            if message_scope in handler_scopes:
-                                break
-                        else:
-                            authorized = False
-
-                    if authorized:
-                        if not has_keywords:
-                            sub_result = func(*message_args)
-                            if sub_result and sub_result == "****no_response****":
-                                send_response = False
-                            if sub_result:
-                                result += [sub_result]
-                        else:
-                            sub_result = func(*message_args, **message_kwargs)
-                            if sub_result and sub_result == "****no_response****":
-                                send_response = False
-                            elif sub_result:
-                                result += [sub_result]
-            if len(result) == 1:
-                result = result[0]
-        except Exception as e:
-            raise e
-
-        
+        message_kwargs = dict(
+            message_kwargs,
+            injected=injected,
+            session=session,
+            topic_tag=tag,
+            response_address=response_address,
+            process_id=process_id,
+            trace=message.get("trace", None)
+        )
+
+        handlers = []
+        for func, groups, handler_scopes, has_keywords in func_list:
+            if session_groups != None and groups and groups.isdisjoint(session_groups):
+                continue
+            if message_scopes and handler_scopes.isdisjoint(message_scopes):
+                continue
+            handlers += [(func, has_keywords)]
+        return handlers, message_args, message_kwargs, response_address
+
+    def _add_result(self, result, sub_result):
+        """ Adds the result of a handler to result, returns False if the handler asks for no response """
+        if sub_result and sub_result == "****no_response****":
+            return False
+        if sub_result:
+            result += [sub_result]
+        return True
+
+    def _complete_call(self, message, result, response_address, send_response):
+        if len(result) == 1:
+            result = result[0]
         if response_address and send_response:
-            self.send_query_response(response_address, message["id"], result)
+            self.send_query_response(response_address, message["id"], result, trace=message.get("trace", None))
         return result
 
-    def send_query_response(self, response_address, query_id, result):
-        message = {"messageType":"queryResponse", "address": self._signal_address, "id":query_id, "response":result}
+    def _handle_message(self, tag, message, stream_data=None):
+        call = self._prepare_call(tag, message, stream_data)
+        if call is None:
+            return []
+        handlers, message_args, message_kwargs, response_address = call
+
+        trace, previous_trace = self._start_handling(tag, message)
+        result = []
+        send_response = True
+        handler_start = time.time()
+        try:
+            for func, has_keywords in handlers:
+                if not has_keywords:
+                    sub_result = func(*message_args)
+                else:
+                    sub_result = func(*message_args, **message_kwargs)
+                if not self._add_result(result, sub_result):
+                    send_response = False
+        finally:
+            if handlers:
+                self._metrics.handler_time(tag, time.time() - handler_start)
+            if trace:
+                self._end_handling(tag, trace, previous_trace)
+
+        return self._complete_call(message, result, response_address, send_response)
+
+    def _start_trace(self, tag, trace):
+        """
+        Returns the trace to send with a message or None if it is not traced. The message
+        continues trace if it is given, else the trace of the message that is handled by
+        the calling thread, else a new trace is started for a sample of the messages.
+        """
+        if trace is None:
+            trace = tracing.current_trace()
+            if trace is None:
+                if not self._trace_sample or random.random() >= self._trace_sample:
+                    return None
+                trace = tracing.new_trace()
+        return tracing.add_hop(trace, self._process_id, "send", tag)
+
+    def _start_handling(self, tag, message):
+        """ Makes the trace of message the current trace while its handlers run, returns (trace, previous trace) """
+        trace = message.get("trace", None)
+        if not trace:
+            return None, None
+        trace = tracing.add_hop(trace, self._process_id, "start", tag)
+        return trace, tracing.set_current_trace(trace)
+
+    def _end_handling(self, tag, trace, previous_trace):
+        tracing.set_current_trace(previous_trace)
+        self._traces.record(tracing.add_hop(trace, self._process_id, "end", tag))
+
+    def get_traces(self):
+        """ The latency breakdown of the traced requests that ended in this process,
+        use tracing.merge_traces on the result of a getBusTraces query with fanout to see all processes """
+        return self._traces.as_list()
+
+    def _reject_query(self, tag, message, state):
+        self.log.warn("query %s: %s %s", state, tag, self._query_executor.stats)
+        if "responseAddress" in message:
+            self.send_query_response(message["responseAddress"], message["id"], [], state)
+
+    def get_query_stats(self):
+        return self._query_executor.stats
+
+    def get_metrics(self):
+        """ Per topic family counters and latencies of this process together with the queue and conflation stats """
+        return {
+            "processId": self._process_id,
+            "topics": self._metrics.as_dict(),
+            "handlerQueues": self.get_handler_queue_lengths(),
+            "bulkQueues": [message_thread.queue_length for message_thread in self._bulk_threads],
+            "queries": self._query_executor.stats,
+            "conflated": {
+                "events": self._conflation_thread.conflated,
+                "handlerQueues": sum(message_thread.conflated for message_thread in self._message_threads)
+            },
+            "dropped": {
+                "send": sum(connection.dropped for connection in self._connections),
+                "bulkQueues": sum(message_thread.dropped for message_thread in self._bulk_threads)
+            }
+        }
+
+    def start_recording(self, path, stream_sample=1.0):
+        """ Records the messages this process sends to path, they can be replayed with recorder.BusReplayer """
+        self.stop_recording()
+        self._recorder = recorder.BusRecorder(path, stream_sample)
+
+    def stop_recording(self):
+        bus_recorder = self._recorder
+        self._recorder = None
+        if bus_recorder:
+            bus_recorder.close()
+
+    def _dump_metrics(self):
+        if self._metrics_dump_interval and time.time() - self._metrics_dump_time > self._metrics_dump_interval:
+            self._metrics_dump_time = time.time()
+            self.log.info("bus metrics, queries: %s handler queues: %s top topics: %s", self._query_executor.stats, self.get_handler_queue_lengths(), self._metrics.top())
+
+    def send_query_response(self, response_address, query_id, result, state="ok", trace=None):
+        message = {"messageType":"queryResponse", "address": self._signal_address, "id":query_id, "response":result, "state": state}
+        if trace:
+            message["trace"] = tracing.add_hop(trace, self._process_id, "respond", "queryResponse")
         if response_address == "inproc_query":
             self.resolve_response(message)
         else:
@@ -529,9 +1250,11 @@ class ZMQBus():
 
     def run(self):
 
-        for message_thread in self._message_threads:
+        for message_thread in self._message_threads + self._bulk_threads:
             message_thread.start()
 
+        self._conflation_thread.start()
+
         self._message_handler.connect()
         self._message_handler.start()
         #time.sleep(1)
@@ -555,7 +1278,7 @@ class ZMQBus():
 
     def stop(self):
         exit_tag = "signal:exit"
-        package = [exit_tag.encode(), json.dumps({}, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')]
+        package = [exit_tag.encode(), get_codec(DEFAULT_CODEC).encode({})]
 
         for connection in self._connections:
             connection.send_package(package)
@@ -597,8 +1320,23 @@ class ZMQBus():
         for connection in self._connections:
             connection.disconnect()
 
-        for message_thread in self._message_threads:
+        for message_thread in self._message_threads + self._bulk_threads:
             message_thread.stop()
+
+        self._query_executor.stop()
+        self._conflation_thread.stop()
+
+        self.stop_recording()
+        if self._shared_memory_writer:
+            self._shared_memory_writer.close()
+        if self._shared_memory_reader:
+            self._shared_memory_reader.close()
+        if self._ipc_address:
+            # The socket of the signal receiver is not closed when it is stopped
+            try:
+                os.remove(self._ipc_address[len("ipc://"):])
+            except OSError:
+                pass
         
     def connect_to_root(self):
         self._root_event = threading.Event()
@@ -606,6 +1344,7 @@ class ZMQBus():
         connection.process_id = "kervi-main"
         self._connections_lock.acquire()
         self._connections += [connection]
+        self._connections_by_id[connection.process_id] = connection
         connection.connect(self._root_address)
         self._connections_lock.release()
 
@@ -636,86 +1375,261 @@ class ZMQBus():
     def send_connection_message(self, address, tag, message):
         for connection in self._connections:
             if connection.address == address:
-                p = json.dumps(message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
-                connection.send_package([tag.encode(), p])
+                connection.send_message(tag.encode(), message, {})
                 return
         self.log.warn("connection not found %s %s %s", address, tag, message)
 
-    def _on_ping(self, address, process_id, process_list):
-        #print("p", address, process_id)
+    def _on_ping(self, address, peer_process_id, process_list, **kwargs):
+        peer_codecs = kwargs.get("codecs", None)
+        subscriptions_version = kwargs.get("subscriptionsVersion", None)
+        subscriptions = kwargs.get("subscriptions", None)
+        members_version = kwargs.get("membersVersion", None)
+        # Peers without membersVersion send the full process list with every ping, other
+        # peers mark the pings that hold the full list as it can be empty
+        members = process_list if members_version is None or kwargs.get("membersFull", False) else None
+        # A process on the same host can attach to the shared memory of the peer, the peer
+        # only sends descriptors after it sees that this process has attached
+        if kwargs.get("shm", None) and self._shared_memory_reader:
+            self._shared_memory_reader.attach(kwargs["shm"])
+        shared_memory_attached = self._shared_memory_writer is not None and self._shared_memory_writer.name in kwargs.get("shmAttached", [])
         self._connections_lock.acquire()
-        new_connection = True
-        connection_list = []
         try:
-            is_connected = False
-            for process in process_list:
-                if process["processId"] == self._process_id:
-                    is_connected = True
-                    break
-            
-            for connection in self._connections:
-                if connection.process_id == process_id:
-                    if not connection.is_connected and is_connected:
-                        connection.is_connected = True
-                        connection.include_ping = True
-                        if connection.is_root_connection and self._root_event:
-                            self._root_event.set()
-                    if connection.is_connected:
-                        connection.ping()
-
-                    new_connection = False
-
-            if new_connection:
+            connection = self._connections_by_id.get(peer_process_id, None)
+            if connection is None:
                 connection = ProcessConnection(self)
-                connection.include_ping = True
+                # Make sure the new process gets our subscriptions with the next ping
+                self._subscriptions_send_version = None
                 self._connections += [connection]
-                connection.register(address, process_id)
+                self._connections_by_id[peer_process_id] = connection
+                connection.register(address, peer_process_id)
+
+            connection.last_seen = time.time()
+            if not connection.include_ping:
+                connection.include_ping = True
+                self._change_members({connection.process_id: connection.address}, [])
+
+            connection.members_legacy = members_version is None
+            members_requested = connection.members_requested
+            members_changed = connection.update_members(members_version, members, kwargs.get("membersDelta", None))
+            if connection.members_requested and not members_requested:
+                self._ping_thread.wake()
+            if self._process_id in kwargs.get("membersRequest", []):
+                self._members_requested = True
+                self._ping_thread.wake()
+
+            if not connection.is_connected and connection.knows(self._process_id):
+                connection.is_connected = True
+                if connection.is_root_connection and self._root_event:
+                    self._root_event.set()
+            if connection.is_connected:
+                connection.ping()
+            ipc_address = kwargs.get("ipcAddress", None)
+            if ipc_address and connection.endpoint != ipc_address and self._ipc_reachable(ipc_address, kwargs.get("host", None)):
+                connection.use_endpoint(ipc_address)
+            connection.codec = negotiate_codec(self._codec.name, peer_codecs)
+            # Compression is only worth its time on links that leave the host
+            if connection.endpoint and connection.endpoint.startswith("ipc://"):
+                connection.compression = None
+            else:
+                connection.compression = negotiate_compression(self._compression, kwargs.get("compressions", None))
+            connection.update_subscriptions(subscriptions_version, subscriptions, kwargs.get("queryRouting", False))
+            connection.shared_memory = shared_memory_attached
 
             if not self._is_root and address == self._root_address:
                 self._last_ping = time.time()
-                for process in process_list:
-                    if process["processId"] == self._process_id:
-                        break
-                    for connection in self._connections:
-                        if connection.process_id == process["processId"]:
-                            break
-                    else:
-                        connection = ProcessConnection(self)
-                        self._connections += [connection]
-                        connection.register(process["address"], process["processId"])
-
+                if members_changed:
+                    # The root knows all processes, connect to the ones that are new to this process
+                    # and drop the ones the root removed before they ever pinged this process
+                    for process_id, process_address in connection.members.items():
+                        if process_id != self._process_id and process_id not in self._connections_by_id:
+                            new_connection = ProcessConnection(self)
+                            self._connections += [new_connection]
+                            self._connections_by_id[process_id] = new_connection
+                            new_connection.register(process_address, process_id)
+                    root_members = connection.members
+                    gone = [
+                        other for other in self._connections
+                        if not other.include_ping and not other.is_root_connection and other.process_id not in root_members
+                    ]
+                    if gone:
+                        self._connections = [other for other in self._connections if other not in gone]
+                        for other in gone:
+                            self._connections_by_id.pop(other.process_id, None)
+                            other.disconnect()
         finally:
             self._connections_lock.release()
 
+    def _bind_signal(self, signal_socket):
+        """
+        Binds the signal socket to the tcp address and the ipc address, returns the addresses.
+        The port is picked before the process starts and another process can take it before
+        it is bound. A process that is not the root then moves to another free port, the
+        other processes know the root by its address so the root tries its port again.
+        """
+        for attempt in range(_BIND_ATTEMPTS):
+            try:
+                signal_socket.bind(self._signal_address)
+                break
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EADDRINUSE or attempt == _BIND_ATTEMPTS - 1:
+                    raise
+                self.log.warn("signal address in use: %s", self._signal_address)
+                if self._is_root:
+                    time.sleep(.2)
+                else:
+                    ip = self._signal_address[len("tcp://"):].rsplit(":", 1)[0]
+                    self._signal_address = "tcp://" + ip + ":" + str(nethelper.get_free_port())
+
+        addresses = [self._signal_address]
+        if self._ipc_address:
+            ipc_path = self._ipc_address[len("ipc://"):]
+            _remove_stale_ipc_files(os.path.dirname(ipc_path))
+            if os.path.exists(ipc_path):
+                os.remove(ipc_path)
+            signal_socket.bind(self._ipc_address)
+            addresses += [self._ipc_address]
+        return addresses
+
+    def _ipc_reachable(self, ipc_address, host):
+        """ True if the ipc address of a peer is a socket file on this host """
+        return (
+            self._ipc_address is not None and
+            host == self._host and
+            os.path.exists(ipc_address[len("ipc://"):])
+        )
+
+    def _change_members(self, added, removed):
+        """ Records a change of the processes this process has heard from, must be called with _connections_lock """
+        self._members_version += 1
+        self._members_deltas += [(self._members_version, added, removed)]
+        # Peers that missed more changes than kept here ask for the full list
+        self._members_deltas = self._members_deltas[-20:]
+
+    def _members_delta(self, from_version):
+        """ Merged changes since from_version or None if they are not known anymore """
+        if from_version is None or not self._members_deltas or self._members_deltas[0][0] > from_version + 1:
+            return None
+        added = {}
+        removed = set()
+        for version, version_added, version_removed in self._members_deltas:
+            if version > from_version:
+                for process_id, address in version_added.items():
+                    added[process_id] = address
+                    removed.discard(process_id)
+                for process_id in version_removed:
+                    added.pop(process_id, None)
+                    removed.add(process_id)
+        return {
+            "from": [self._uuid_handler, from_version],
+            "added": [{"address": address, "processId": process_id} for process_id, address in added.items()],
+            "removed": list(removed)
+        }
+
+    def _remove_dead_connections(self):
+        """ Removes processes that have not pinged for member_timeout, must be called with _connections_lock """
+        now = time.time()
+        dead = [
+            connection for connection in self._connections
+            if connection.include_ping and connection.last_seen and now - connection.last_seen > self._member_timeout
+        ]
+        if not dead:
+            return
+        for connection in dead:
+            self.log.warn("process not responding, removed: %s %s", connection.process_id, connection.address)
+            connection.include_ping = False
+            connection.is_connected = False
+            connection.members = None
+            connection.members_version = None
+        self._change_members({}, [connection.process_id for connection in dead])
+        removed = [connection for connection in dead if not connection.is_root_connection]
+        # The list is replaced so threads that iterate over it while sending are not affected
+        self._connections = [connection for connection in self._connections if connection not in removed]
+        for connection in removed:
+            self._connections_by_id.pop(connection.process_id, None)
+            connection.disconnect()
+
     def _ping_connections(self):
+        """
+        Sends a heartbeat to all connected processes.
+
+        The heartbeat holds the version of the processes this process has heard from. Changes are
+        only sent when the version changes and the full list only when a peer asks for it, because it
+        missed a change, so the size of a heartbeat does not grow with the number of processes.
+        """
         self._connections_lock.acquire()
         try:
-            connection_list = []
-            for connection in self._connections:
-                if connection.include_ping:
-                    connection_list += [{"address":connection.address, "processId":connection.process_id}]
-
-            ping_message = {
-                'address':self._signal_address,
-                'processId':self._process_id,
-                'processList': connection_list
+            self._remove_dead_connections()
+            members_version = [self._uuid_handler, self._members_version]
+            ping_kwargs = {
+                "codecs": supported_codecs(self._codec.name),
+                "compressions": supported_compressions(self._compression) if self._compression else [],
+                "subscriptionsVersion": self._subscriptions_version,
+                "membersVersion": members_version,
+                "queryRouting": True
             }
-            p = json.dumps(ping_message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
-            ping_tag = "signal:ping"
-            package = [ping_tag.encode(), p]
-            
-            for connection in self._connections:
-                connection.send_package(package)
-        
+
+            member_list = []
+            # Peers of older versions only know the full list
+            send_members = self._members_requested or any(connection.members_legacy for connection in self._connections)
+            if self._members_send_version != self._members_version:
+                delta = self._members_delta(self._members_send_version)
+                if delta is None:
+                    send_members = True
+                else:
+                    ping_kwargs["membersDelta"] = delta
+            if send_members:
+                member_list = [
+                    {"address":connection.address, "processId":connection.process_id}
+                    for connection in self._connections if connection.include_ping
+                ]
+                ping_kwargs["membersFull"] = True
+            self._members_send_version = self._members_version
+            self._members_requested = False
+
+            members_request = [connection.process_id for connection in self._connections if connection.members_requested]
+            if members_request:
+                ping_kwargs["membersRequest"] = members_request
+
+            if self._ipc_address:
+                ping_kwargs["ipcAddress"] = self._ipc_address
+                ping_kwargs["host"] = self._host
+            if self._shared_memory_writer:
+                ping_kwargs["shm"] = self._shared_memory_writer.name
+            if self._shared_memory_reader:
+                ping_kwargs["shmAttached"] = self._shared_memory_reader.attached
+            # The full subscription list is only sent when it changed, when a process is added
+            # and every 10th ping in case a ping is lost
+            self._ping_count += 1
+            if self._subscriptions_send_version != self._subscriptions_version or self._ping_count % 10 == 0:
+                with self._subscriptions_lock:
+                    ping_kwargs["subscriptionsVersion"] = self._subscriptions_version
+                    ping_kwargs["subscriptions"] = list(self._subscriptions.keys())
+                self._subscriptions_send_version = ping_kwargs["subscriptionsVersion"]
+            connections = list(self._connections)
         finally:
             self._connections_lock.release()
 
+        ping_message = {
+            'address':self._signal_address,
+            'processId':self._process_id,
+            'processList': member_list,
+            'kwargs': ping_kwargs
+        }
+        # Ping is always json encoded as it is used to negotiate the codec
+        p = get_codec(DEFAULT_CODEC).encode(ping_message)
+        ping_tag = "signal:ping"
+        package = [ping_tag.encode(), p]
+
+        for connection in connections:
+            connection.send_package(package)
+
     def send_command(self, command, *args, **kwargs):
         injected = kwargs.pop("injected", "")
         scope = kwargs.pop("scope", None)
         groups = kwargs.pop("groups", None)
         session = kwargs.pop("session", None)
         local_only = kwargs.pop("local_only", False)
+        trace = kwargs.pop("trace", None)
         command_message = {
             "command":command,
             "args":args,
@@ -725,37 +1639,46 @@ class ZMQBus():
             "groups": groups,
             "kwargs": kwargs
         }
-        p = json.dumps(command_message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
         command_tag = "command:" + command
-        package = [command_tag.encode(), p]
-        self._command_lock.acquire()
-        try:
-            self._command_socket.send_multipart(package)
-        finally:
-            self._command_lock.release()
-
+        trace = self._start_trace(command_tag, trace)
+        if trace:
+            command_message["trace"] = trace
+        bus_recorder = self._recorder
+        if bus_recorder:
+            bus_recorder.record(recorder.COMMAND, command_tag, command_message)
+        self._deliver_local(command_tag, command_message)
+
+        # The message is only encoded when it is send to another process
+        encoded = {}
         if not local_only:
+            tag = command_tag.encode()
+            bulk = command_tag.startswith(self._bulk_prefixes)
             for connection in self._connections:
-                connection.send_package(package)
+                if connection.is_subscribed(tag):
+                    if not connection.send_message(tag, command_message, encoded, bulk=bulk):
+                        self._metrics.dropped(command_tag)
+        self._metrics.message_out(command_tag, _encoded_size(encoded))
 
     def register_command_handler(self, command, func, **kwargs):
         tag = "command:"+command
         self._register_handler(tag, func, **kwargs)
         self._command_handler.register(tag)
-        self._message_handler.register(tag)
+        self._subscribe(tag)
 
     def unregister_command_handler(self, command, func, **kwargs):
         tag = "command:"+command
         self._unregister_handler(tag, func, **kwargs)
         self._command_handler.unregister(tag)
-        self._message_handler.unregister(tag)
+        self._unsubscribe(tag)
 
     def trigger_event(self, event, id, *args, **kwargs):
+        conflate = kwargs.pop("conflate", True)
         injected = kwargs.pop("injected", "")
         scope = kwargs.pop("scope", None)
         groups = kwargs.pop("groups", None)
         session = kwargs.pop("session", None)
         local_only = kwargs.pop("local_only", False)
+        trace = kwargs.pop("trace", None)
         event_message = {
             'event':event,
             'id':id,
@@ -767,39 +1690,70 @@ class ZMQBus():
             "kwargs": kwargs,
             "process_id": self._process_id
         }
-        p = json.dumps(event_message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
+        if not conflate:
+            # Receivers hand every sample of the event to their handlers
+            event_message["conflate"] = False
         event_tag = "event:" + event + ":"
         if id:
             event_tag += id
-        package = [event_tag.encode(), p]
-        self._event_lock.acquire()
-        try:
-            self._event_socket.send_multipart(package)
-        finally:
-            self._event_lock.release()
-
+        trace = self._start_trace(event_tag, trace)
+        if trace:
+            event_message["trace"] = trace
+        bus_recorder = self._recorder
+        if bus_recorder:
+            bus_recorder.record(recorder.EVENT, event_tag, event_message)
+        self._deliver_local(event_tag, event_message)
+
+        encoded = {}
         if not local_only:
+            tag = event_tag.encode()
+            bulk = event_tag.startswith(self._bulk_prefixes)
             for connection in self._connections:
-                connection.send_package(package)
+                if connection.is_subscribed(tag):
+                    if not connection.send_message(tag, event_message, encoded, bulk=bulk):
+                        self._metrics.dropped(event_tag)
+        self._metrics.message_out(event_tag, _encoded_size(encoded))
+
+    def has_event_subscribers(self, event, id=None):
+        """ True if this or another process subscribes to the event, senders use it to skip building unused events """
+        event_tag = "event:" + event + ":"
+        if id:
+            event_tag += id
+        if self._is_subscribed_locally(event_tag):
+            return True
+        tag = event_tag.encode()
+        for connection in self._connections:
+            if connection.is_subscribed(tag):
+                return True
+        return False
 
     def register_event_handler(self, event, func, component_id=None, **kwargs):
         tag = "event:"+event +":"
         if component_id:
             tag +=  component_id
+        if not kwargs.pop("conflate", True):
+            # The handler needs every event, incoming events for the tag are not conflated
+            self._unconflated_tags[tag] = self._unconflated_tags.get(tag, 0) + 1
+            self._invalidate_dispatch_table()
         if func:
             self._register_handler(tag, func, **kwargs)
         self._event_handler.register(tag)
-        self._message_handler.register(tag)
+        self._subscribe(tag)
 
     def unregister_event_handler(self, event, func, component_id=None, **kwargs):
         tag = "event:"+event +":"
         if component_id:
             tag +=  component_id
+        if not kwargs.pop("conflate", True) and tag in self._unconflated_tags:
+            self._unconflated_tags[tag] -= 1
+            if self._unconflated_tags[tag] <= 0:
+                del self._unconflated_tags[tag]
+            self._invalidate_dispatch_table()
         
         if func:
             self._unregister_handler(tag, func, **kwargs)
         self._event_handler.unregister(tag)
-        self._message_handler.unregister(tag)
+        self._unsubscribe(tag)
 
     def stream_data(self, stream_id, stream_event, data, *args, **kwargs):
         injected = kwargs.pop("injected", "")
@@ -807,6 +1761,8 @@ class ZMQBus():
         groups = kwargs.pop("groups", None)
         session = kwargs.pop("session", None)
         local_only = kwargs.pop("local_only", False)
+        # Streams are not traced
+        kwargs.pop("trace", None)
         event_message = {
             'event':stream_event,
             'id':stream_id,
@@ -819,18 +1775,55 @@ class ZMQBus():
             "kwargs": kwargs,
             "process_id": self._process_id
         }
-        p = json.dumps(event_message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
         event_tag = "stream:" + stream_id + ":" + stream_event + ":"
-        package = [event_tag.encode(), p, data]
-        self._stream_lock.acquire()
-        try:
-            self._stream_socket.send_multipart(package)
-        finally:
-            self._stream_lock.release()
+        bus_recorder = self._recorder
+        if bus_recorder:
+            bus_recorder.record(recorder.STREAM, event_tag, event_message, data)
+        self._deliver_local(event_tag, event_message, data)
 
+        encoded = {}
+        shared_memory_encoded = {}
         if not local_only:
+            tag = event_tag.encode()
+            bulk = event_tag.startswith(self._bulk_prefixes)
+            data_frame = None
+            shared_memory_message = None
+            use_shared_memory = len(data) >= self._shared_memory_threshold and self._get_shared_memory_writer()
             for connection in self._connections:
-                connection.send_package(package)
+                if connection.is_subscribed(tag):
+                    if use_shared_memory and connection.shared_memory:
+                        # The payload is written once to shared memory and only the descriptor is send
+                        if shared_memory_message is None:
+                            descriptor = self._shared_memory_writer.write(data)
+                            if descriptor is None:
+                                use_shared_memory = False
+                            else:
+                                shared_memory_message = dict(event_message, shm=descriptor)
+                        if shared_memory_message:
+                            if not connection.send_message(tag, shared_memory_message, shared_memory_encoded, bulk=bulk):
+                                self._metrics.dropped(event_tag)
+                            continue
+                    if data_frame is None:
+                        # One frame is created for the data and shared by all sends, zmq only
+                        # copies the data when it is below the copy threshold
+                        data_frame = zmq.Frame(data)
+                    if not connection.send_message(tag, event_message, encoded, data_frame, bulk=bulk):
+                        self._metrics.dropped(event_tag)
+        self._metrics.message_out(event_tag, _encoded_size(encoded) + _encoded_size(shared_memory_encoded) + len(data))
+
+    def _get_shared_memory_writer(self):
+        """ Returns the shared memory ring of this process, it is created with the first large stream payload """
+        if self._shared_memory_writer is None and self._shared_memory_size and shared_memory.available:
+            with self._stream_lock:
+                if self._shared_memory_writer is None:
+                    try:
+                        self._shared_memory_writer = shared_memory.SharedMemoryWriter(self._shared_memory_size)
+                    except Exception:
+                        self.log.exception("could not create shared memory for streams")
+                        self._shared_memory_size = 0
+                        return None
+                    self._ping_thread.wake()
+        return self._shared_memory_writer
 
     def register_stream_handler(self, stream_id, func, stream_event=None, **kwargs):
         tag = "stream:" + stream_id + ":"
@@ -841,7 +1834,7 @@ class ZMQBus():
         
         #print("rsh", self._process_id, tag, func)
         self._stream_handler.register(tag)
-        self._message_handler.register(tag)
+        self._subscribe(tag)
 
     def unregister_stream_handler(self, stream_id, func, stream_event=None, **kwargs):
         tag = "stream:" + stream_id + ":"
@@ -851,56 +1844,97 @@ class ZMQBus():
         if func:
             self._unregister_handler(tag, func, **kwargs)
         self._stream_handler.unregister(tag)
-        self._message_handler.unregister(tag)
+        self._unsubscribe(tag)
 
     def resolve_response(self, message):
-        for event in self._response_events:
-            if event["id"] == message["id"] and not event["processed"]:
-                if message["response"]:
-                    event["response"] += [message["response"]]
-                event["process_count"] = event["process_count"] - 1
-                event["handled_by"] += [message["address"]]
-                if  event["process_count"] <= 0:
-                    event["processed"] = True
-                    event["eventSignal"].set()
-                    for handler in self._linked_response_handlers:
-                        handler(event)
+        if "trace" in message:
+            self._traces.record(tracing.add_hop(message["trace"], self._process_id, "response", "queryResponse"))
+        with self._response_lock:
+            event = self._response_events.get(message["id"], None)
+            if event is None:
+                return
+            if message["response"]:
+                event["response"] += [message["response"]]
+            event["process_count"] = event["process_count"] - 1
+            event["handled_by"] += [message["address"]]
+            if event["process_count"] > 0:
+                return
+            del self._response_events[message["id"]]
+        self._complete_query(event)
+
+    def _complete_query(self, event):
+        event["processed"] = True
+        self._metrics.query_rtt("query:" + event["query"], time.time() - event["sent"])
+        for handler in self._linked_response_handlers:
+            handler(event)
+        event["future"].set_result(self._query_result(event))
+
+    def _query_result(self, event):
+        result = event["response"]
+        if isinstance(result, list) and not isinstance(result, dict) and len(result) == 1:
+            return result[0]
+        return result
 
-    def send_query(self, query, *args, **kwargs):
+    def _timeout_query(self, event):
+        """ Completes a query that did not get a response from all processes with the responses received so far """
+        with self._response_lock:
+            if self._response_events.pop(event["id"], None) is None:
+                return
+        self.log.warn("send query timeout %s %s %s %s", self._signal_address, event["query"], event["handled_by"], event["id"])
+        self._metrics.query_rtt("query:" + event["query"], time.time() - event["sent"])
+        event["future"].set_result(self._query_result(event))
+
+    def _expire_queries(self):
+        now = time.time()
+        with self._response_lock:
+            expired = [event for event in self._response_events.values() if event["deadline"] < now]
+        for event in expired:
+            self._timeout_query(event)
+
+    def _send_query(self, query, *args, **kwargs):
+        injected = kwargs.pop("injected", "")
+        scope = kwargs.pop("scope", None)
+        groups = kwargs.pop("groups", None)
+        session = kwargs.pop("session", None)
+        processes = kwargs.pop("processes", None)
+        timeout = kwargs.pop("timeout", 10)
+        headers = kwargs.pop("headers", None)
+        local_only = kwargs.pop("local_only", False)
+        fanout = kwargs.pop("fanout", False)
+        trace = kwargs.pop("trace", None)
+        event_data = {
+            "id":None,
+            "future":concurrent.futures.Future(),
+            "response":[],
+            "processed":False,
+            "process_count": 0,
+            "process_id": self._process_id,
+            "query": query,
+            "handled_by": [],
+            "headers": headers,
+            "deadline": time.time() + timeout,
+            "sent": time.time()
+        }
+        registered = False
         self._connections_lock.acquire()
         try:
             self._query_id_count += 1
-            result = []
-            injected = kwargs.pop("injected", "")
-            scope = kwargs.pop("scope", None)
-            groups = kwargs.pop("groups", None)
-            session = kwargs.pop("session", None)
-            processes = kwargs.pop("processes", None)
-            timeout = kwargs.pop("timeout", 10)
-            wait = kwargs.pop("wait", True)
-            headers = kwargs.pop("headers", None)
-            local_only = kwargs.pop("local_only", False)
             query_id = self._uuid_handler + "-" + str(self._query_id_count)
+            event_data["id"] = query_id
+            query_tag = "query:" + query
 
-            process_count = 1
+            # The query is only send to the processes that have a handler for it, with fanout
+            # it is send to all processes and the query completes when all of them have answered
+            local = fanout or len(self._get_dispatch_entry(query_tag)[0]) > 0
+            targets = []
             if not local_only:
+                tag = query_tag.encode()
                 for connection in self._connections:
                     if connection.is_alive and (not processes or (connection.process_id in processes)):
-                        process_count += 1
-
-            event = threading.Event()
-            event_data = {
-                "id":query_id,
-                "eventSignal":event,
-                "response":[],
-                "processed":False,
-                "process_count": process_count,
-                "process_id": self._process_id,
-                "query": query,
-                "handled_by": [],
-                "headers": headers
-            }
-            self._response_events += [event_data]
+                        if fanout or connection.handles_query(tag):
+                            targets += [connection]
+            process_count = len(targets) + (1 if local else 0)
+            event_data["process_count"] = process_count
             query_message = {
                 'query':query,
                 "id":query_id,
@@ -910,44 +1944,91 @@ class ZMQBus():
                 "scope":scope,
                 "groups":groups,
                 "session":session,
+                "timeout": timeout,
                 "kwargs": kwargs
             }
-            p = json.dumps(query_message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
-            query_tag = "query:" + query
-            package = [query_tag.encode(), p]
-            self._query_lock.acquire()
-            try:
-                self._query_socket.send_multipart(package)
-            finally:
-                self._query_lock.release()
-
-            if not local_only and len(self._connections) > 0:
-                query_message["responseAddress"] = self._signal_address
-                p = json.dumps(query_message, ensure_ascii=False, cls=_ObjectEncoder).encode('utf8')
-                package = [query_tag.encode(), p]
-
-                for connection in self._connections:
-                    if connection.is_alive and (not processes or (connection.process_id in processes)):
-                        connection.send_package(package)
+            trace = self._start_trace(query_tag, trace)
+            if trace:
+                query_message["trace"] = trace
+            bus_recorder = self._recorder
+            if bus_recorder:
+                bus_recorder.record(recorder.QUERY, query_tag, query_message)
+            if process_count == 0:
+                # No process has a handler
+                self._complete_query(event_data)
+                return event_data
+            with self._response_lock:
+                self._response_events[query_id] = event_data
+            registered = True
+            if local:
+                self._deliver_local(query_tag, query_message)
+
+            encoded = {}
+            if targets:
+                remote_message = dict(query_message, responseAddress=self._signal_address)
+                for connection in targets:
+                    connection.send_message(tag, remote_message, encoded)
+            self._metrics.message_out(query_tag, _encoded_size(encoded))
         except Exception as ex:
             self.log.exception("error send query %s", query)
+            # complete the query with the responses received so far unless a response
+            # already completed it, callers always get a resolved future
+            with self._response_lock:
+                pending = self._response_events.pop(event_data["id"], None) is not None
+            if (pending or not registered) and not event_data["future"].done():
+                event_data["future"].set_result(self._query_result(event_data))
         finally:
             self._connections_lock.release()
+        return event_data
 
+    def send_query(self, query, *args, **kwargs):
+        timeout = kwargs.get("timeout", 10)
+        wait = kwargs.pop("wait", True)
+        event_data = self._send_query(query, *args, **kwargs)
         if wait:
-            event.wait(timeout)
-            if not event_data["processed"]:
-                self.log.warn("send query timeout %s %s %s %s", self._signal_address, query, event_data["handled_by"], event_data["id"])
-            result = event_data["response"]
-            self._response_events.remove(event_data)
-            if isinstance(result, list) and not isinstance(result, dict) and len(result) == 1:
-                return result[0]
-            else:
-                return result
+            waiting = self._query_executor.begin_wait()
+            try:
+                return event_data["future"].result(timeout)
+            except concurrent.futures.TimeoutError:
+                self._timeout_query(event_data)
+                return event_data["future"].result()
+            finally:
+                if waiting:
+                    self._query_executor.end_wait()
         return None
 
+    def send_query_async(self, query, *args, **kwargs):
+        """
+        Sends a query without blocking the calling thread.
+
+        Returns a concurrent.futures.Future that is resolved with the query result when all
+        processes have answered or with the responses received so far when the timeout expires.
+        Use asyncio.wrap_future to await it from a coroutine.
+        """
+        kwargs.pop("wait", None)
+        return self._send_query(query, *args, **kwargs)["future"]
+
     def register_query_handler(self, query, func, **kwargs):
-        self._register_handler("query:"+query, func, **kwargs)
+        tag = "query:"+query
+        self._register_handler(tag, func, **kwargs)
+        # All queries are received through the query: subscription, the tag is announced
+        # so other processes only send the query to processes that handle it
+        self._subscribe(tag)
 
     def unregister_query_handler(self, query, func, **kwargs):
-        self._unregister_handler("query:"+query, func, **kwargs)
+        tag = "query:"+query
+        self._unregister_handler(tag, func, **kwargs)
+        self._unsubscribe(tag)
+
+    def get_query_processes(self, query):
+        """ Ids of the processes that have a handler for query, this process included.
+        Processes that have not announced their handlers yet are included. """
+        tag = "query:" + query
+        result = []
+        if self._get_dispatch_entry(tag)[0]:
+            result += [self._process_id]
+        encoded_tag = tag.encode()
+        for connection in self._connections:
+            if connection.is_alive and connection.handles_query(encoded_tag):
+                result += [connection.process_id]
+        return result
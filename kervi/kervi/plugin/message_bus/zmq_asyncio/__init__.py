@@ -0,0 +1,49 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Message bus plugin that runs the ZMQ bus on a single asyncio event loop per process.
+Enable it instead of kervi.plugin.message_bus.zmq in the plugins section of the config.
+"""
+
+from kervi.plugin.message_bus.zmq import ZMQPlugin
+
+class ZMQAsyncioPlugin(ZMQPlugin):
+    def __init__(self, config, manager):
+        ZMQPlugin.__init__(self, config, manager)
+        self._name = "ZMQAsyncioBus"
+
+    def load(self, process_id, spine_port, root_address = None, ip=None):
+        from kervi.plugin.message_bus.zmq_asyncio.asyncio_bus import AsyncZMQBus
+        self._bus = AsyncZMQBus(self.plugin_config)
+        self._bus.set_log(process_id)
+        self._bus.reset_bus(process_id, spine_port, ip, root_address)
+        self._bus.run()
+        return self
+
+    def get_default_config(self):
+        config = ZMQPlugin.get_default_config(self)
+        config["executor_workers"] = 4
+        return config
+
+def init_plugin(config, manager):
+    return ZMQAsyncioPlugin(config, manager)
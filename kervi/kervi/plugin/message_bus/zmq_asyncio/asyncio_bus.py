@@ -0,0 +1,560 @@
+#MIT License
+#Copyright (c) 2017 Tim Wentzlau
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Message bus that runs on a single asyncio event loop.
+
+AsyncZMQBus uses the same wire protocol and api as ZMQBus and can be mixed with it in an
+application. Receiving, handling and pinging run as tasks on one event loop in a background
+thread instead of a thread per socket and handler queue. Coroutine handlers are awaited on the
+loop, other handlers are called on a small thread pool that grows while its threads wait in
+send_query. Messages with the same tag are still
+handled in the order they are received.
+
+Coroutine handlers must not block the loop, use await bus.query() instead of send_query.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import queue
+import threading
+import time
+import zmq
+import zmq.asyncio
+from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus, ZMQConflationThread, dispatch_frames
+import kervi.plugin.message_bus.zmq.tracing as tracing
+
+class _LoopEvent(object):
+    """ Event that can be set from any thread and waited for on the event loop of bus """
+    def __init__(self, bus):
+        self._bus = bus
+        self._event = None
+
+    def set(self):
+        loop = self._bus._loop
+        if loop and not loop.is_closed():
+            loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        if self._event:
+            self._event.set()
+
+    def clear(self):
+        if self._event:
+            self._event.clear()
+
+    async def wait(self, timeout):
+        if self._event is None:
+            self._event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+class AsyncReceiver(object):
+    """ Receives from a SUB socket on the event loop """
+    def __init__(self, bus, address, bind=False, zero_copy=False):
+        self._bus = bus
+        self._address = address
+        self._bind = bind
+        self._zero_copy = zero_copy
+        self._terminate = False
+        self._socket = None
+        self._options = []
+        self._lock = threading.Lock()
+
+    def _set_option(self, option, tag):
+        with self._lock:
+            if self._socket is None:
+                self._options += [(option, tag)]
+                return
+        # zmq sockets are not thread safe, the option is set by the loop that uses the socket
+        self._bus._loop.call_soon_threadsafe(self._socket.setsockopt_string, option, tag)
+
+    def register(self, tag):
+        self._set_option(zmq.SUBSCRIBE, tag)
+
+    def unregister(self, tag):
+        self._set_option(zmq.UNSUBSCRIBE, tag)
+
+    def connect(self):
+        pass
+
+    def start(self):
+        """ Opens the socket and starts receiving, must be called on the event loop """
+        socket = self._bus._async_context.socket(zmq.SUB)
+        with self._lock:
+            for option, tag in self._options:
+                socket.setsockopt_string(option, tag)
+            self._options = []
+            self._socket = socket
+        if self._bind:
+            self._address = self._bus._bind_signal(socket)
+        else:
+            addresses = self._address if isinstance(self._address, list) else [self._address]
+            for address in addresses:
+                socket.connect(address)
+        self._bus._start_task(self._run())
+
+    def stop(self):
+        self._terminate = True
+
+    async def _run(self):
+        try:
+            while not self._terminate:
+                connection_message = None
+                try:
+                    if self._zero_copy:
+                        frames = await self._socket.recv_multipart(copy=False)
+                        connection_message = [frame.bytes for frame in frames[:2]] + [frame.buffer for frame in frames[2:]]
+                    else:
+                        connection_message = await self._socket.recv_multipart()
+                    if not dispatch_frames(self._bus, connection_message) and not self._bind:
+                        break
+                except zmq.ZMQError as e:
+                    if e.errno == zmq.ETERM:
+                        break
+                    self._bus.log.exception("message zmq exception: %s %s %s", self._address, e, e.errno)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._bus.log.exception("message exception: %s %s %s", self._address, e, connection_message)
+        finally:
+            self._socket.close(linger=0)
+
+class AsyncHandlerWorker(object):
+    """ Handles the messages of a share of the tags in the order they are received """
+    def __init__(self, bus, max_size=0):
+        self._bus = bus
+        self._messages = collections.deque()
+        self._max_size = max_size
+        self._ready = None
+        self._pending = {}
+        self.conflated = 0
+        self.dropped = 0
+
+    def add_message(self, tag, message, stream_data, conflate=False, block=False):
+        # The event loop can't wait for room, a full queue always drops its oldest message
+        if self._max_size and len(self._messages) >= self._max_size:
+            dropped_tag, dropped_message = self._messages.popleft()[:2]
+            if dropped_message is None:
+                self._pending.pop(dropped_tag, None)
+            self.dropped += 1
+            self._bus._metrics.dropped(dropped_tag)
+        if conflate:
+            replaced = tag in self._pending
+            self._pending[tag] = (message, stream_data)
+            if replaced:
+                self.conflated += 1
+                return
+            self._messages.append((tag, None, None, time.time()))
+        else:
+            self._messages.append((tag, message, stream_data, time.time()))
+        if self._ready:
+            self._ready.set()
+
+    @property
+    def queue_length(self):
+        return len(self._messages)
+
+    def start(self):
+        self._ready = asyncio.Event()
+        self._bus._start_task(self._run())
+
+    def stop(self):
+        pass
+
+    async def _run(self):
+        while True:
+            if not self._messages:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            tag, message, stream_data, queued = self._messages.popleft()
+            if message is None:
+                message, stream_data = self._pending.pop(tag)
+            self._bus._metrics.queue_wait(tag, time.time() - queued)
+            try:
+                await self._bus._handle_message_async(tag, message, stream_data)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._bus.log.exception("handler exception: %s", tag)
+
+class AsyncHandlerExecutor(concurrent.futures.Executor):
+    """
+    Thread pool for the handlers that are not coroutines. Like ZMQQueryExecutor it starts an
+    extra thread while one of its threads waits for a query response, so handlers that query
+    other handlers can't use up the pool. Idle threads stop after a second.
+    """
+    def __init__(self, max_workers=4):
+        self._max_workers = max(1, max_workers)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._busy = 0
+        self._waiting = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queue.put((future, fn, args, kwargs))
+            self._start_thread()
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _start_thread(self):
+        """ Starts a thread if there are more calls than idle threads, must be called with _lock """
+        if self._busy + self._queue.qsize() > len(self._threads) and len(self._threads) < self._max_workers + self._waiting:
+            thread = threading.Thread(target=self._run, name="ZMQAsyncioHandler")
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self):
+        self._local.worker = True
+        while True:
+            try:
+                future, fn, args, kwargs = self._queue.get(True, 1)
+            except queue.Empty:
+                with self._lock:
+                    if self._shutdown or len(self._threads) > self._max_workers + self._waiting:
+                        self._threads.remove(threading.current_thread())
+                        return
+                continue
+            with self._lock:
+                self._busy += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as ex:
+                        future.set_exception(ex)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+
+    def begin_wait(self):
+        """ Returns True and lends the place of the calling thread to other calls if it is a thread of this pool """
+        if not getattr(self._local, "worker", False):
+            return False
+        with self._lock:
+            self._waiting += 1
+            self._start_thread()
+        return True
+
+    def end_wait(self):
+        with self._lock:
+            self._waiting -= 1
+
+class AsyncQueryExecutor(object):
+    """
+    Handles incoming queries as tasks, at most max_workers at a time.
+    Queries are rejected and expired in the same way as by ZMQQueryExecutor.
+    """
+    def __init__(self, bus, max_workers=16, queue_size=256, deadline=10):
+        self._bus = bus
+        self._max_workers = max(1, max_workers)
+        self._queue_size = queue_size
+        self._deadline = deadline
+        self._semaphore = None
+        self._queued = 0
+        self._busy = 0
+        self._executed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._max_queue_depth = 0
+        self._local = threading.local()
+
+    def start(self):
+        self._semaphore = asyncio.Semaphore(self._max_workers)
+
+    def stop(self):
+        pass
+
+    def run_handler(self, func):
+        """ Calls the sync handler of a query on a handler thread, the thread holds the slot of the query """
+        self._local.query = True
+        try:
+            return func()
+        finally:
+            self._local.query = False
+
+    def begin_wait(self):
+        """
+        Called before a handler thread waits for a query response. A thread that handles a
+        query lends its slot to other queries until end_wait is called.
+        """
+        if not self._bus._executor.begin_wait():
+            return False
+        self._local.lent = getattr(self._local, "query", False)
+        if self._local.lent:
+            self._bus._loop.call_soon_threadsafe(self._semaphore.release)
+        return True
+
+    def end_wait(self):
+        self._bus._executor.end_wait()
+        if self._local.lent:
+            self._local.lent = False
+            self._bus._loop.call_soon_threadsafe(self._reclaim)
+
+    def _reclaim(self):
+        self._bus._start_task(self._semaphore.acquire())
+
+    def submit(self, tag, message):
+        if self._queued >= self._queue_size:
+            self._rejected += 1
+            self._bus._reject_query(tag, message, "rejected")
+            return
+        timeout = message.get("timeout", None)
+        if not timeout or timeout > self._deadline:
+            timeout = self._deadline
+        now = time.time()
+        self._queued += 1
+        self._max_queue_depth = max(self._max_queue_depth, self._queued)
+        self._bus._start_task(self._execute(tag, message, now + timeout, now))
+
+    async def _execute(self, tag, message, deadline, queued):
+        await self._semaphore.acquire()
+        self._queued -= 1
+        self._busy += 1
+        self._bus._metrics.queue_wait(tag, time.time() - queued)
+        try:
+            if time.time() > deadline:
+                self._expired += 1
+                self._bus._reject_query(tag, message, "timeout")
+            else:
+                await self._bus._handle_message_async(tag, message)
+                self._executed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._bus.log.exception("query handler exception: %s", tag)
+        finally:
+            self._busy -= 1
+            self._semaphore.release()
+
+    @property
+    def stats(self):
+        return {
+            "workers": self._max_workers,
+            "max_workers": self._max_workers,
+            "busy": self._busy,
+            "queue_depth": self._queued,
+            "max_queue_depth": self._max_queue_depth,
+            "queue_size": self._queue_size,
+            "executed": self._executed,
+            "rejected": self._rejected,
+            "expired": self._expired
+        }
+
+class AsyncPingWorker(object):
+    def __init__(self, bus):
+        self._bus = bus
+        self._terminate = False
+        self._wake = _LoopEvent(bus)
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._bus._start_task(self._run())
+
+    def wake(self):
+        """ Sends the next ping now instead of waiting for the interval """
+        self._wake.set()
+
+    def stop(self):
+        self._terminate = True
+        self._wake.set()
+
+    def join(self, timeout=2):
+        self._stopped.wait(timeout)
+
+    async def _run(self):
+        try:
+            while not self._terminate:
+                self._bus._ping_connections()
+                self._bus._expire_queries()
+                self._bus._dump_metrics()
+                await self._wake.wait(self._bus._ping_interval)
+                self._wake.clear()
+        finally:
+            self._stopped.set()
+
+class AsyncConflationWorker(ZMQConflationThread):
+    """ Sends the held back events from the event loop """
+    def __init__(self, bus):
+        ZMQConflationThread.__init__(self, bus)
+        self._wake = _LoopEvent(bus)
+
+    def start(self):
+        self._bus._start_task(self._run())
+
+    async def _run(self):
+        while not self._terminate:
+            await self._wake.wait(self._flush())
+            self._wake.clear()
+
+class AsyncZMQBus(ZMQBus):
+    def __init__(self, config=None):
+        ZMQBus.__init__(self, config)
+        self._loop = None
+        self._loop_thread = None
+
+    def reset_bus(self, process_id, signal_port, ip=None, root_address=None, event_port=None):
+        self._loop = None
+        self._loop_thread = None
+        self._tasks = set()
+        self._executor = AsyncHandlerExecutor(self._config_value("executor_workers", 4))
+        ZMQBus.reset_bus(self, process_id, signal_port, ip, root_address, event_port)
+
+    def _create_receiver(self, address, bind=False, zero_copy=False):
+        return AsyncReceiver(self, address, bind, zero_copy)
+
+    def _create_handler_worker(self, max_size=0, block_timeout=1):
+        return AsyncHandlerWorker(self, max_size)
+
+    def _create_query_executor(self, max_workers, queue_size, deadline):
+        return AsyncQueryExecutor(self, max_workers, queue_size, deadline)
+
+    def _create_ping_worker(self):
+        return AsyncPingWorker(self)
+
+    def _create_conflation_worker(self):
+        return AsyncConflationWorker(self)
+
+    def _start_task(self, coroutine):
+        """ Runs coroutine as a task on the event loop, must be called on the event loop """
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _add_local_message(self, tag, message, stream_data):
+        # The handler queues are only used from the event loop
+        if self._loop is None or threading.current_thread() is self._loop_thread:
+            ZMQBus._add_local_message(self, tag, message, stream_data)
+        else:
+            self._loop.call_soon_threadsafe(ZMQBus._add_local_message, self, tag, message, stream_data)
+
+    async def _handle_message_async(self, tag, message, stream_data=None):
+        call = self._prepare_call(tag, message, stream_data)
+        if call is None:
+            return []
+        handlers, message_args, message_kwargs, response_address = call
+
+        # The trace is set in the context of the worker task, calls on the thread pool set it themselves
+        trace, previous_trace = self._start_handling(tag, message)
+        result = []
+        send_response = True
+        handler_start = time.time()
+        try:
+            for func, has_keywords in handlers:
+                kwargs = message_kwargs if has_keywords else {}
+                if asyncio.iscoroutinefunction(func):
+                    sub_result = await func(*message_args, **kwargs)
+                else:
+                    call = functools.partial(tracing.with_trace(trace, func) if trace else func, *message_args, **kwargs)
+                    if tag.startswith("query:"):
+                        call = functools.partial(self._query_executor.run_handler, call)
+                    sub_result = await self._loop.run_in_executor(self._executor, call)
+                if not self._add_result(result, sub_result):
+                    send_response = False
+        finally:
+            if handlers:
+                self._metrics.handler_time(tag, time.time() - handler_start)
+            if trace:
+                self._end_handling(tag, trace, previous_trace)
+
+        return self._complete_call(message, result, response_address, send_response)
+
+    def run(self):
+        started = threading.Event()
+        self._loop_thread = threading.Thread(target=self._run_loop, args=(started,), name="ZMQAsyncio")
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        started.wait()
+
+        if self._root_address:
+            self.connect_to_root()
+
+        if self._is_root:
+            self.log.verbose("IPC address: %s", self._signal_address)
+
+    def _run_loop(self, started):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._async_context = zmq.asyncio.Context.shadow(self._context.underlying)
+
+        for message_thread in self._message_threads + self._bulk_threads:
+            message_thread.start()
+        self._conflation_thread.start()
+        self._query_executor.start()
+
+        self._message_handler.start()
+        self._event_handler.start()
+        self._stream_handler.start()
+        self._command_handler.start()
+        self._query_handler.start()
+
+        self._ping_thread.start()
+        loop.call_soon(started.set)
+        try:
+            loop.run_forever()
+        finally:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    def stop(self):
+        ZMQBus.stop(self)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join(5)
+        self._executor.shutdown(wait=False)
+        # No thread is left that uses the sockets, close them so the context is not blocked
+        # in term when it is garbage collected
+        self._context.destroy(linger=0)
+
+    def send_query(self, query, *args, **kwargs):
+        if kwargs.get("wait", True) and threading.current_thread() is self._loop_thread:
+            raise RuntimeError("send_query would block the event loop, use await bus.query() in coroutine handlers")
+        return ZMQBus.send_query(self, query, *args, **kwargs)
+
+    async def query(self, query, *args, **kwargs):
+        """ Sends a query and waits for the result without blocking the event loop """
+        return await asyncio.wrap_future(self.send_query_async(query, *args, **kwargs))
@@ -8,6 +8,7 @@ from amqpstorm import Connection
 from amqpstorm import UriConnection
 import json
 import requests
+from kervi.plugin.message_bus.zmq.message_codec import get_codec
 
 logging.basicConfig(level=logging.CRITICAL)
 
@@ -140,7 +141,8 @@ class _MQPublisher(object):
             'content_type': 'application/json',
             'headers': headers
         }
-        json_body = json.dumps(payload, ensure_ascii=False)
+        # Messages from msgpack peers can hold bytes and datetimes, the json codec encodes them
+        json_body = get_codec("json").encode(payload).decode("utf8")
         #print("sm",topic + self._connection._bus_topic, payload)
         self._channel.basic.publish(
             json_body,
@@ -98,6 +98,7 @@ class RouterPlugin(KerviPlugin):
         self._connections_lock = threading.Lock()
         self._mq_sessions = {}
         self._pending_queries = {}
+        self._values_route = False
         self._response_events = []
         self._check_dead_connections_thread = _CheckDeadConnectionsThread(self)
         self._check_dead_connections_thread.start()
@@ -303,7 +304,7 @@ class RouterPlugin(KerviPlugin):
                 self.register_bus_connection(self._connections[headers["connection_id"]])
                 for route in routes:
                     if route["topic_type"] == "event":
-                        self._spine.register_event_handler(route["topic"], self._event_handler)
+                        self._register_event_route(route["topic"])
                     if route["topic_type"] == "command":
                         self._spine.register_command_handler(route["topic"], self._command_handler)
                     if route["topic_type"] == "query":
@@ -312,6 +313,13 @@ class RouterPlugin(KerviPlugin):
             with self._connections_lock:
                 self._connections[headers["connection_id"]].last_ping = datetime.datetime.now()
 
+    def _register_event_route(self, topic):
+        self._spine.register_event_handler(topic, self._event_handler)
+        if topic == "valueChanged" and not self._values_route:
+            # Changes of a value batch are routed as one message
+            self._values_route = True
+            self._spine.register_event_handler("valuesChanged", self._event_handler)
+
     def _remove_dead_connections(self):
         for connection_id in list(self._connections.keys()):
             connection = self._connections[connection_id]
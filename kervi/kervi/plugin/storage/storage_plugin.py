@@ -36,6 +36,11 @@ class StoragePlugin(KerviPlugin):
     def store_value(self, value_id, value, persist=False):
         raise NotImplementedError
 
+    def store_values(self, values, persist=False):
+        """ Stores a batch of value changes, override to store them in one transaction """
+        for value in values:
+            self.store_value(value["id"], value, persist)
+
     def get_value_data(self, date_from, date_to, limit):
         raise NotImplementedError
 
@@ -58,6 +58,7 @@ class Router(object):
         self._connection_id = None
         self._connections = {}
         self._mq_sessions= {}
+        self._values_route = False
         
     @property
     def routes_in(self):
@@ -96,11 +97,18 @@ class Router(object):
         self._spine._add_linked_response_handler(self._on_response)     
         for route in self._routes_out:
             if route.topic_type == "event":
-                self._spine.register_event_handler(route.topic, self._event_handler)
+                self._register_event_route(route.topic)
             if route.topic_type == "command":
                 self._spine.register_command_handler(route.topic, self._command_handler)
         self._route_table_ready = True
 
+    def _register_event_route(self, topic):
+        self._spine.register_event_handler(topic, self._event_handler)
+        if topic == "valueChanged" and not self._values_route:
+            # Changes of a value batch are routed as one message
+            self._values_route = True
+            self._spine.register_event_handler("valuesChanged", self._event_handler)
+
     def _spine_handler(self, *args, **kwargs):
         topic = kwargs.get("topic_tag", None)
         
@@ -181,7 +189,7 @@ class Router(object):
             self.register_bus_connection(self._connections[headers["connection_id"]])
             for route in routes:
                 if route["topic_type"] == "event":
-                    self._spine.register_event_handler(route["topic"], self._event_handler)
+                    self._register_event_route(route["topic"])
                 if route["topic_type"] == "command":
                     self._spine.register_command_handler(route["topic"], self._command_handler)
         else:
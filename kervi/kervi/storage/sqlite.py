@@ -6,6 +6,7 @@ from datetime import datetime
 import threading
 import sqlite3 as lite
 from kervi.core.utility.thread import KerviThread
+from kervi.core.utility.timestamp import format_timestamp
 from kervi.plugin.storage.storage_plugin import StoragePlugin
 
 _DB_CREATE_SQL = """
@@ -106,7 +107,24 @@ class SQLiteStoragePlugin(StoragePlugin):
             cursor = self._connection.cursor()
             cursor.execute(
                 "INSERT INTO dynamicData ('dynamicValue','value','timeStamp')  VALUES (?, ?, ?)",
-                (value["id"], self.to_json(value["value"]) , value["timestamp"])
+                (value["id"], self.to_json(value["value"]) , format_timestamp(value["timestamp"]))
+            )
+            self._connection.commit()
+        except lite.Error as er:
+            self.log_error('error store dynamic data, persist{0} error:{1}', persist, er)
+        finally:
+            self._db_lock.release()
+
+    def store_values(self, values, persist=False):
+        self._db_lock.acquire()
+        try:
+            cursor = self._connection.cursor()
+            cursor.executemany(
+                "INSERT INTO dynamicData ('dynamicValue','value','timeStamp')  VALUES (?, ?, ?)",
+                [
+                    (value["id"], self.to_json(value["value"]), format_timestamp(value["timestamp"]))
+                    for value in values
+                ]
             )
             self._connection.commit()
         except lite.Error as er:
@@ -13,6 +13,7 @@ class StorageManager(Controller):
         
         self._spine = Spine()
         self._spine.register_event_handler("valueChanged", self._store_value)
+        self._spine.register_event_handler("valuesChanged", self._store_values)
         self._spine.register_query_handler("getValueData", self._get_value_data)
         
         self._spine.register_command_handler("storeSetting", self._store_setting)
@@ -38,6 +39,18 @@ class StorageManager(Controller):
                     plugin.store_value(value_id, value, persist)
             except NotImplementedError:
                 pass
+
+    def _store_values(self, batch_id, changes):
+        persisted = [value for value, persist, groups in changes if persist]
+        logged = [value for value, persist, groups in changes if not persist]
+        for plugin in self._plugin_manager.plugins:
+            try:
+                if persisted and plugin.storage_type == "persisted":
+                    plugin.store_values(persisted, True)
+                elif logged and not plugin.storage_type == "persisted":
+                    plugin.store_values(logged, False)
+            except NotImplementedError:
+                pass
         
     def _get_value_data(self, value, date_from=None, date_to=None, limit=60):
         for plugin in self._plugin_manager.plugins:
@@ -41,6 +41,7 @@ setup(
         'kervi/plugin/ipc/websocket',
         'kervi/plugin/message_bus',
         'kervi/plugin/message_bus/zmq',
+        'kervi/plugin/message_bus/zmq_asyncio',
         'kervi/plugin/messaging',
         'kervi/plugin/messaging/email',
         'kervi/plugin/messaging/user_log',
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+import pytest
+from kervi.plugin.message_bus.zmq_asyncio.asyncio_bus import AsyncZMQBus
+import kervi.utility.nethelper as nethelper
+
+@pytest.fixture
+def async_bus():
+    bus = AsyncZMQBus()
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9880]), "127.0.0.1")
+    bus.run()
+    yield bus
+    bus.stop()
+
+def _wait_for(condition, timeout=5):
+    wait_until = time.time() + timeout
+    while not condition() and time.time() < wait_until:
+        time.sleep(.05)
+
+def test_coroutine_and_sync_handlers(async_bus):
+    received = []
+    threads = set()
+
+    async def on_event_async(value_id, value):
+        await asyncio.sleep(0)
+        threads.add(threading.current_thread().name)
+        received.append(("async", value))
+
+    def on_event(value_id, value):
+        received.append(("sync", value))
+
+    async_bus.register_event_handler("valueChanged", on_event_async, "v1")
+    async_bus.register_event_handler("valueChanged", on_event, "v1")
+    time.sleep(.2)
+
+    for i in range(50):
+        async_bus.trigger_event("valueChanged", "v1", i)
+    _wait_for(lambda: len(received) == 100)
+
+    assert [value for kind, value in received if kind == "async"] == list(range(50))
+    assert [value for kind, value in received if kind == "sync"] == list(range(50))
+    assert threads == set(["ZMQAsyncio"])
+
+def test_queries(async_bus):
+    async def double(value):
+        await asyncio.sleep(.01)
+        return value * 2
+
+    async def quadruple(value):
+        return await async_bus.query("double", value) * 2
+
+    async_bus.register_query_handler("double", double)
+    async_bus.register_query_handler("quadruple", quadruple)
+    async_bus.register_query_handler("triple", lambda value: value * 3)
+
+    assert async_bus.send_query("double", 21) == 42
+    assert async_bus.send_query("triple", 3) == 9
+    assert async_bus.send_query("quadruple", 2) == 8
+    futures = [async_bus.send_query_async("double", i) for i in range(1, 21)]
+    assert [future.result(5) for future in futures] == [i * 2 for i in range(1, 21)]
+
+def test_nested_queries_from_sync_handlers():
+    bus = AsyncZMQBus({"executor_workers": 1, "query_workers": 1})
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9880]), "127.0.0.1")
+    bus.run()
+    try:
+        bus.register_query_handler("inner", lambda value: value + 1)
+        bus.register_query_handler("outer", lambda value: bus.send_query("inner", value, timeout=5) * 2)
+
+        futures = [bus.send_query_async("outer", i) for i in range(5)]
+
+        assert [future.result(10) for future in futures] == [(i + 1) * 2 for i in range(5)]
+        assert bus._executor._waiting == 0
+    finally:
+        bus.stop()
+
+def test_only_query_handlers_lend_their_slot():
+    bus = AsyncZMQBus({"executor_workers": 1, "query_workers": 1})
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9880]), "127.0.0.1")
+    bus.run()
+    try:
+        semaphore = bus._query_executor._semaphore
+        slots = []
+        bus.register_query_handler("inner", lambda: "free slots %d" % semaphore._value)
+        bus.register_command_handler("check", lambda: slots.append(bus.send_query("inner", timeout=5)))
+
+        # a command handler that waits for a query holds no query slot and lends none
+        bus.send_command("check")
+        _wait_for(lambda: slots)
+        assert slots == ["free slots 0"]
+        _wait_for(lambda: semaphore._value == 1)
+        assert semaphore._value == 1
+    finally:
+        bus.stop()
+
+def test_send_query_on_loop_is_refused(async_bus):
+    errors = []
+    async def on_command():
+        try:
+            async_bus.send_query("anything")
+        except RuntimeError as e:
+            errors.append(e)
+
+    async_bus.register_command_handler("check", on_command)
+    time.sleep(.2)
+    async_bus.send_command("check")
+    _wait_for(lambda: errors)
+    assert len(errors) == 1
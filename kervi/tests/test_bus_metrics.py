@@ -0,0 +1,53 @@
+from kervi.plugin.message_bus.zmq.metrics import Histogram, BusMetrics, topic_family
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for i in range(99):
+        histogram.add(0.001)
+    histogram.add(2.0)
+
+    summary = histogram.as_dict()
+    assert summary["count"] == 100
+    assert summary["max"] == 2000.0
+    assert summary["p50"] <= 1.6
+    assert summary["p99"] <= 1.6
+    assert histogram.percentile(100) == 2.0
+
+def test_bus_metrics_per_topic():
+    metrics = BusMetrics(True)
+    metrics.message_in("event:valueChanged:v1", 10)
+    metrics.message_in("event:valueChanged:v2", 20)
+    metrics.message_out("command:start", 5)
+    metrics.handler_time("event:valueChanged:v1", 0.002)
+
+    topics = metrics.as_dict()
+    assert sorted(topics.keys()) == ["command:start", "event:valueChanged"]
+    assert topics["event:valueChanged"]["messagesIn"] == 2
+    assert topics["event:valueChanged"]["bytesIn"] == 30
+    assert topics["event:valueChanged"]["handlerTime"]["count"] == 1
+    assert topics["command:start"]["messagesOut"] == 1
+    assert "handlerTime" not in topics["command:start"]
+    assert list(metrics.top(1).keys()) == ["event:valueChanged"]
+
+def test_topic_family():
+    assert topic_family("event:valueChanged:v1") == "event:valueChanged"
+    assert topic_family("event:valueChanged:") == "event:valueChanged"
+    assert topic_family("stream:cam:frame:") == "stream:cam"
+    assert topic_family("query:double") == "query:double"
+    assert topic_family("queryResponse") == "queryResponse"
+
+def test_bus_metrics_are_off_by_default():
+    metrics = BusMetrics()
+    metrics.message_in("event:valueChanged:v1", 10)
+    assert metrics.as_dict() == {}
+
+def test_compression_metrics():
+    metrics = BusMetrics(True)
+    metrics.compressed("queryResponse", 10000, 2500, 0.001)
+    metrics.decompressed("event:valueChanged:v1", 0.0005)
+
+    topics = metrics.as_dict()
+    assert topics["queryResponse"]["compressionRatio"] == 4.0
+    assert topics["queryResponse"]["compressTime"]["count"] == 1
+    assert topics["event:valueChanged"]["decompressTime"]["count"] == 1
+    assert "compressionRatio" not in topics["event:valueChanged"]
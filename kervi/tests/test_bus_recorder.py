@@ -0,0 +1,71 @@
+import time
+import pytest
+from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus
+from kervi.plugin.message_bus.zmq.recorder import BusRecorder, BusReplayer, read_recording, COMMAND, EVENT, STREAM
+import kervi.utility.nethelper as nethelper
+
+@pytest.fixture
+def running_bus():
+    bus = ZMQBus()
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9850]), "127.0.0.1")
+    bus.run()
+    yield bus
+    bus.stop()
+
+def test_stream_frames_are_sampled(tmpdir):
+    path = str(tmpdir.join("traffic.rec.gz"))
+    recorder = BusRecorder(path, stream_sample=0.5)
+    recorder.record(COMMAND, "command:start", {"command": "start", "args": [1]})
+    for i in range(4):
+        recorder.record(STREAM, "stream:cam:frame:", {"id": "cam", "event": "frame", "args": []}, bytes([i + 1]) * 10)
+    recorder.close()
+
+    records = list(read_recording(path))
+    assert [record[1] for record in records] == [COMMAND, STREAM, STREAM, STREAM, STREAM]
+    assert records[0][3]["args"] == [1]
+    # frames that are not sampled are replayed as zeros of the same length
+    assert [record[4] for record in records[1:]] == [bytes(10), bytes([2]) * 10, bytes(10), bytes([4]) * 10]
+
+def test_record_and_replay(running_bus, tmpdir):
+    path = str(tmpdir.join("traffic.rec"))
+    received = []
+    running_bus.register_event_handler("valueChanged", lambda value_id, value: received.append(value), "v1")
+    running_bus.register_command_handler("setValue", lambda value, **kwargs: received.append(kwargs["session"]))
+
+    running_bus.start_recording(path)
+    for i in range(5):
+        running_bus.trigger_event("valueChanged", "v1", i)
+        time.sleep(.05)
+    running_bus.send_command("setValue", 1, session={"groups": []})
+    running_bus.stop_recording()
+    time.sleep(.2)
+    del received[:]
+
+    replay_start = time.time()
+    stats = BusReplayer(running_bus, path, speed=10).run()
+    assert time.time() - replay_start < .2
+    assert stats["events"] == 5
+    assert stats["commands"] == 1
+    time.sleep(.2)
+    assert received == [0, 1, 2, 3, 4, {"groups": []}]
+
+def test_replay_keeps_the_envelope(running_bus, tmpdir):
+    path = str(tmpdir.join("traffic.rec"))
+    replay_path = str(tmpdir.join("replay.rec"))
+    running_bus.start_recording(path)
+    running_bus.trigger_event("valueChanged", "v1", 1, conflate=False, trace={"id": "t1", "hops": []})
+    running_bus.stop_recording()
+
+    running_bus.start_recording(replay_path)
+    BusReplayer(running_bus, path, speed=10).run()
+    running_bus.stop_recording()
+
+    records = list(read_recording(path)) + list(read_recording(replay_path))
+    assert [record[1] for record in records] == [EVENT, EVENT]
+    recorded, replayed = records[0][3], records[1][3]
+    assert replayed["conflate"] is False
+    assert replayed["trace"]["id"] == "t1"
+    # the replay continues the recorded trace
+    assert replayed["trace"]["hops"][:-1] == recorded["trace"]["hops"]
+    assert replayed["args"] == recorded["args"]
@@ -0,0 +1,60 @@
+import time
+import pytest
+from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus
+import kervi.plugin.message_bus.zmq.tracing as tracing
+import kervi.utility.nethelper as nethelper
+
+@pytest.fixture
+def running_bus():
+    bus = ZMQBus({"trace_sample": 1.0})
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9870]), "127.0.0.1")
+    bus.run()
+    yield bus
+    bus.stop()
+
+def test_collector_keeps_last_traces():
+    collector = tracing.TraceCollector(2)
+    for i in range(3):
+        trace = tracing.add_hop(tracing.new_trace(), "p1", "send", "command:start")
+        collector.record(tracing.add_hop(trace, "p2", "end", "command:start"))
+
+    traces = collector.as_list()
+    assert len(traces) == 2
+    steps = traces[0]["paths"][0]["steps"]
+    assert steps[0]["from"] == "p1 send command:start"
+    assert steps[0]["to"] == "p2 end command:start"
+    assert steps[0]["ms"] >= 0
+
+def test_trace_follows_request(running_bus):
+    received = []
+    running_bus.register_query_handler("getValue", lambda: 42)
+    running_bus.register_command_handler("setValue", lambda value: received.append(running_bus.send_query("getValue")))
+    running_bus.register_event_handler("buttonPressed", lambda button_id, **kwargs: running_bus.send_command("setValue", 1), "b1")
+
+    running_bus.trigger_event("buttonPressed", "b1")
+    time.sleep(.5)
+    assert received == [42]
+
+    traces = tracing.merge_traces(running_bus.send_query("getBusTraces"))
+    assert len(traces) == 1
+    paths = [[hop[1] + " " + hop[2] for hop in path["hops"]] for path in list(traces.values())[0]]
+    command = [
+        "send event:buttonPressed:b1", "receive event:buttonPressed:b1", "start event:buttonPressed:b1",
+        "send command:setValue", "receive command:setValue", "start command:setValue"
+    ]
+    query = command + ["send query:getValue", "receive query:getValue"]
+    assert command + ["end command:setValue"] in paths
+    assert query + ["start query:getValue", "end query:getValue"] in paths
+    assert query + ["respond queryResponse", "response queryResponse"] in paths
+    assert tracing.current_trace() is None
+
+def test_messages_are_not_traced_without_sample(running_bus):
+    running_bus._trace_sample = 0
+    received = []
+    running_bus.register_command_handler("setValue", lambda value, **kwargs: received.append(kwargs["trace"]))
+    running_bus.send_command("setValue", 1)
+    running_bus.send_command("setValue", 2, trace=tracing.new_trace())
+    time.sleep(.2)
+    assert received[0] is None
+    assert received[1]["hops"][0][1] == "send"
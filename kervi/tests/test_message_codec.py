@@ -0,0 +1,63 @@
+import datetime
+import pytest
+from kervi.plugin.message_bus.zmq.message_codec import get_codec, negotiate_codec, supported_codecs, decode_message, msgpack
+from kervi.plugin.message_bus.zmq.message_codec import negotiate_compression, is_compressed, decompress_payload
+
+def test_json_codec():
+    codec = get_codec("json")
+    payload = codec.encode({"id": "v1", "args": [1, 2.5, "x"], "data": b"\x00\x01"})
+
+    assert payload.startswith(b"{")
+    message = decode_message(payload)
+    assert message["id"] == "v1"
+    assert message["args"] == [1, 2.5, "x"]
+    assert message["data"] == "AAE="
+
+def test_unknown_codec_falls_back_to_json():
+    assert get_codec("unknown").name == "json"
+    assert negotiate_codec("msgpack", None).name == "json"
+    assert negotiate_codec("msgpack", ["json"]).name == "json"
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack not installed")
+def test_msgpack_codec():
+    codec = get_codec("msgpack")
+    now = datetime.datetime(2018, 1, 2, 3, 4, 5, 600000)
+    payload = codec.encode({"id": "v1", "args": (1, 2.5, "x"), "data": b"\x00\x01", "ts": now})
+
+    message = decode_message(payload)
+    assert message["args"] == [1, 2.5, "x"]
+    assert message["data"] == b"\x00\x01"
+    assert message["ts"] == now.replace(tzinfo=datetime.timezone.utc)
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack not installed")
+def test_msgpack_payload_relayed_as_json():
+    now = datetime.datetime(2018, 1, 2, 3, 4, 5)
+    message = {"id": "v1", "args": [1, b"\x00\x01", now, [b"\x02", {"ts": now}]]}
+
+    # a message from a msgpack peer is the same as one from a json peer once it is relayed as json
+    from_json = decode_message(get_codec("json").encode(message))
+    from_msgpack = decode_message(get_codec("msgpack").encode(message))
+    assert decode_message(get_codec("json").encode(from_msgpack)) == from_json
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack not installed")
+def test_negotiate_codec():
+    assert supported_codecs("msgpack")[0] == "msgpack"
+    assert negotiate_codec("msgpack", ["json", "msgpack"]).name == "msgpack"
+    assert negotiate_codec("json", ["msgpack", "json"]).name == "json"
+
+def test_zlib_compression():
+    payload = get_codec("json").encode({"id": "v1", "args": ["x" * 10000]})
+    compressor = negotiate_compression("zlib", ["zlib"])
+    compressed = compressor.compress(payload)
+
+    assert len(compressed) < len(payload)
+    assert is_compressed(compressed)
+    assert not is_compressed(payload)
+    assert decompress_payload(compressed) == payload
+    assert decompress_payload(payload) is payload
+
+def test_compression_needs_both_peers():
+    assert negotiate_compression(None, ["zlib"]) is None
+    assert negotiate_compression("zlib", None) is None
+    assert negotiate_compression("zlib", []) is None
+    assert negotiate_compression("lz4", ["zlib"]).name == "zlib"
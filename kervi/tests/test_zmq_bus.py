@@ -0,0 +1,551 @@
+import os
+import socket
+import time
+import pytest
+import zmq
+from kervi.plugin.message_bus.zmq.zmqbus import ZMQBus, ZMQQueryExecutor, ProcessConnection, ZMQHandlerThread, ZMQConflationThread
+import kervi.plugin.message_bus.zmq.shared_memory as shared_memory
+import kervi.utility.nethelper as nethelper
+
+@pytest.fixture
+def bus():
+    bus = ZMQBus()
+    bus.set_log("test")
+    bus.reset_bus("test", 0, "127.0.0.1")
+    yield bus
+    bus._context.destroy(linger=0)
+
+@pytest.fixture
+def running_bus():
+    bus = ZMQBus()
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9850]), "127.0.0.1")
+    bus.run()
+    yield bus
+    bus.stop()
+
+def test_dispatch_exact_and_wildcard_event(bus):
+    received = []
+    def on_any(value_id, value):
+        received.append(("any", value_id, value))
+
+    def on_v1(value_id, value):
+        received.append(("v1", value_id, value))
+
+    bus.register_event_handler("valueChanged", on_any)
+    bus.register_event_handler("valueChanged", on_v1, "v1")
+
+    bus._handle_message("event:valueChanged:v1", {"id": "v1", "args": [1]})
+    bus._handle_message("event:valueChanged:v2", {"id": "v2", "args": [2]})
+
+    assert received == [("v1", "v1", 1), ("any", "v1", 1), ("any", "v2", 2)]
+
+def test_dispatch_invalidated_on_unregister(bus):
+    received = []
+    def on_value(value_id, value):
+        received.append(value)
+
+    bus.register_event_handler("valueChanged", on_value, "v1")
+    bus._handle_message("event:valueChanged:v1", {"id": "v1", "args": [1]})
+    bus.unregister_event_handler("valueChanged", on_value, "v1")
+    bus._handle_message("event:valueChanged:v1", {"id": "v1", "args": [2]})
+
+    assert received == [1]
+
+def test_dispatch_authorization(bus):
+    received = []
+    def on_command(value, **kwargs):
+        received.append(value)
+
+    bus.register_command_handler("secure", on_command, groups=["admin"], scopes=["app"])
+
+    bus._handle_message("command:secure", {"args": [1], "session": {"groups": ["user"]}})
+    bus._handle_message("command:secure", {"args": [2], "session": {"groups": ["admin"]}})
+    bus._handle_message("command:secure", {"args": [3], "scope": ["other"]})
+    bus._handle_message("command:secure", {"args": [4], "scope": ["app"]})
+
+    assert received == [2, 4]
+
+def test_send_query_async(running_bus):
+    running_bus.register_query_handler("double", lambda value: value * 2)
+
+    futures = [running_bus.send_query_async("double", i) for i in range(1, 11)]
+
+    assert [future.result(5) for future in futures] == [i * 2 for i in range(1, 11)]
+    assert running_bus.send_query("double", 21) == 42
+    assert running_bus._response_events == {}
+
+class _QueryBus(object):
+    def __init__(self):
+        self.handled = []
+        self.rejected = []
+
+    def _handle_message(self, tag, message):
+        self.handled.append(tag)
+
+    def _reject_query(self, tag, message, state):
+        self.rejected.append((tag, state))
+
+def test_query_executor_rejects_when_full():
+    query_bus = _QueryBus()
+    executor = ZMQQueryExecutor(query_bus, max_workers=0, queue_size=1)
+
+    executor.submit("query:a", {"id": "1"})
+    executor.submit("query:b", {"id": "2"})
+
+    assert query_bus.rejected == [("query:b", "rejected")]
+    assert executor.stats["queue_depth"] == 1
+    assert executor.stats["rejected"] == 1
+
+def test_query_executor_expires_queries():
+    query_bus = _QueryBus()
+    executor = ZMQQueryExecutor(query_bus, max_workers=0)
+
+    executor._execute("query:a", {"id": "1"}, 0)
+    executor._execute("query:b", {"id": "2"}, time.time() + 10)
+
+    assert query_bus.rejected == [("query:a", "timeout")]
+    assert query_bus.handled == ["query:b"]
+    assert executor.stats["expired"] == 1
+
+def test_nested_queries_do_not_use_up_workers(running_bus):
+    running_bus._query_executor._max_workers = 1
+    running_bus.register_query_handler("inner", lambda value: value + 1)
+    running_bus.register_query_handler("outer", lambda value: running_bus.send_query("inner", value, timeout=5) * 2)
+
+    futures = [running_bus.send_query_async("outer", i) for i in range(5)]
+
+    assert [future.result(10) for future in futures] == [(i + 1) * 2 for i in range(5)]
+    assert running_bus._query_executor.stats["waiting"] == 0
+
+def test_events_for_same_tag_keep_order(running_bus):
+    received = []
+    running_bus.register_event_handler("valueChanged", lambda value_id, value: received.append(value), "v1")
+    time.sleep(.2)
+
+    for i in range(200):
+        running_bus.trigger_event("valueChanged", "v1", i)
+
+    for i in range(50):
+        if len(received) == 200:
+            break
+        time.sleep(.1)
+
+    assert received == list(range(200))
+    assert len(running_bus.get_handler_queue_lengths()) == 5
+
+def test_connection_subscriptions(bus):
+    connection = ProcessConnection(bus)
+    assert connection.is_subscribed(b"event:valueChanged:v1")
+
+    connection.update_subscriptions("a-1", ["query:", "event:valueChanged:"])
+    assert connection.is_subscribed(b"event:valueChanged:v1")
+    assert not connection.is_subscribed(b"event:other:v1")
+
+    connection.update_subscriptions("a-1", None)
+    assert not connection.is_subscribed(b"event:other:v1")
+
+    connection.update_subscriptions("a-2", None)
+    assert connection.is_subscribed(b"event:other:v1")
+    connection.disconnect()
+
+def test_subscriptions_are_counted(bus):
+    version = bus._subscriptions_version
+    bus.register_event_handler("valueChanged", lambda value_id: None, "v1")
+    bus.register_event_handler("valueChanged", lambda value_id: None, "v1")
+    assert "event:valueChanged:v1" in bus._subscriptions
+    assert bus._subscriptions_version != version
+
+    bus.unregister_event_handler("valueChanged", None, "v1")
+    assert "event:valueChanged:v1" in bus._subscriptions
+    bus.unregister_event_handler("valueChanged", None, "v1")
+    assert "event:valueChanged:v1" not in bus._subscriptions
+
+def test_handler_queue_conflation(bus):
+    handler_thread = ZMQHandlerThread(bus)
+    for i in range(3):
+        handler_thread.add_message("event:valueChanged:v1", {"id": "v1", "args": [i]}, None, True)
+    handler_thread.add_message("event:valueChanged:v2", {"id": "v2", "args": [0]}, None, True)
+
+    assert handler_thread.queue_length == 2
+    assert handler_thread.conflated == 2
+    assert handler_thread._pending["event:valueChanged:v1"][0]["args"] == [2]
+
+def test_event_conflation_window(bus):
+    conflation_thread = ZMQConflationThread(bus)
+
+    assert not conflation_thread.hold(("valueChanged", "v1"), 10, 1)
+    assert conflation_thread.hold(("valueChanged", "v1"), 10, 2)
+    assert conflation_thread.hold(("valueChanged", "v1"), 10, 3)
+    assert not conflation_thread.hold(("valueChanged", "v2"), 10, 1)
+
+    assert conflation_thread.conflated == 1
+    assert conflation_thread._pending[("valueChanged", "v1")][1] == 3
+
+def test_trigger_event_conflation():
+    bus = ZMQBus({"conflation": {"valueChanged": 0.2}})
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9850]), "127.0.0.1")
+    bus.run()
+    try:
+        received = []
+        every_sample = []
+        send_every_sample = []
+        bus.register_event_handler("valueChanged", lambda value_id, value: received.append(value), "v1")
+        bus.register_event_handler("valueChanged", lambda value_id, value: every_sample.append(value), "v2", conflate=False)
+        bus.register_event_handler("valueChanged", lambda value_id, value: send_every_sample.append(value), "v3")
+        time.sleep(.2)
+
+        # events are conflated by the receiver, a handler or a sender can ask for every event
+        for i in range(20):
+            bus.trigger_event("valueChanged", "v1", i)
+            bus.trigger_event("valueChanged", "v2", i)
+            bus.trigger_event("valueChanged", "v3", i, conflate=False)
+        time.sleep(.6)
+
+        assert received[0] == 0
+        assert received[-1] == 19
+        assert len(received) < 5
+        assert every_sample == list(range(20))
+        assert send_every_sample == list(range(20))
+    finally:
+        bus.stop()
+
+def test_conflation_opt_out_updates_dispatch(bus):
+    bus._conflation = {"valueChanged": 0}
+    bus.register_event_handler("valueChanged", lambda value_id, value: None, "v1")
+    assert bus._get_dispatch_entry("event:valueChanged:v1")[2] == 0
+
+    bus.register_event_handler("valueChanged", None, "v1", conflate=False)
+    assert bus._get_dispatch_entry("event:valueChanged:v1")[2] is None
+    bus.unregister_event_handler("valueChanged", None, "v1", conflate=False)
+    assert bus._get_dispatch_entry("event:valueChanged:v1")[2] == 0
+
+@pytest.mark.skipif(not shared_memory.available, reason="shared memory needs python 3.8")
+def test_shared_memory_ring():
+    writer = shared_memory.SharedMemoryWriter(100)
+    reader = shared_memory.SharedMemoryReader()
+    try:
+        assert reader.attach(writer.name)
+        assert not reader.attach("kervi-unknown-segment")
+
+        first = writer.write(b"a" * 40)
+        second = writer.write(bytearray(b"b" * 40))
+        assert bytes(reader.read(first)) == b"a" * 40
+        assert bytes(reader.read(second)) == b"b" * 40
+        assert writer.write(b"c" * 60) is None
+
+        # wraps to the start of the ring and overwrites the first payload
+        third = writer.write(b"c" * 40)
+        assert third[1] == 100
+        assert reader.read(first) is None
+        assert bytes(reader.read(second)) == b"b" * 40
+        assert bytes(reader.read(third)) == b"c" * 40
+
+        # a payload that is read is a copy the writer can't change
+        payload = reader.read(third)
+        writer.write(b"d" * 40)
+        writer.write(b"e" * 40)
+        assert reader.read(third) is None
+        assert bytes(payload) == b"c" * 40
+    finally:
+        reader.close()
+        writer.close()
+
+def test_get_bus_metrics(running_bus):
+    running_bus._metrics.enabled = True
+    running_bus.register_query_handler("double", lambda value: value * 2)
+    running_bus.register_event_handler("valueChanged", lambda value_id, value: None, "v1")
+    time.sleep(.2)
+
+    running_bus.trigger_event("valueChanged", "v1", 1)
+    assert running_bus.send_query("double", 2) == 4
+    time.sleep(.2)
+
+    metrics = running_bus.send_query("getBusMetrics")
+    assert metrics["processId"] == "test"
+    event_metrics = metrics["topics"]["event:valueChanged"]
+    assert event_metrics["messagesIn"] == 1
+    assert event_metrics["messagesOut"] == 1
+    assert event_metrics["handlerTime"]["count"] == 1
+    assert event_metrics["queueWait"]["count"] == 1
+    assert metrics["topics"]["query:double"]["queryRtt"]["count"] == 1
+    assert metrics["queries"]["executed"] >= 1
+
+def test_connection_members(bus):
+    connection = ProcessConnection(bus)
+    assert not connection.update_members(["a", 1], None, None)
+    assert connection.members_requested
+
+    assert connection.update_members(["a", 1], [{"processId": "p1", "address": "tcp://p1"}], None)
+    assert connection.knows("p1")
+    assert not connection.members_requested
+
+    delta = {"from": ["a", 1], "added": [{"processId": "p2", "address": "tcp://p2"}], "removed": ["p1"]}
+    assert connection.update_members(["a", 2], None, delta)
+    assert connection.members == {"p2": "tcp://p2"}
+
+    # a delta from a version this process has not seen means a ping was lost
+    delta = {"from": ["a", 3], "added": [], "removed": ["p2"]}
+    assert not connection.update_members(["a", 4], None, delta)
+    assert connection.members_requested
+    connection.disconnect()
+
+def test_empty_member_list(bus):
+    bus._on_ping("tcp://127.0.0.1:1", "p1", [], membersVersion=["a", 1], membersFull=True)
+    connection = bus._connections_by_id["p1"]
+    assert connection.members == {}
+    assert not connection.members_requested
+
+    # a ping without the full list leaves the known members alone
+    bus._on_ping("tcp://127.0.0.1:1", "p1", [], membersVersion=["a", 1])
+    assert connection.members == {}
+    assert not connection.members_requested
+    connection.disconnect()
+
+def test_members_delta(bus):
+    bus._change_members({"p1": "tcp://p1"}, [])
+    bus._change_members({"p2": "tcp://p2"}, [])
+    bus._change_members({}, ["p1"])
+
+    delta = bus._members_delta(1)
+    assert delta["from"] == [bus._uuid_handler, 1]
+    assert delta["added"] == [{"processId": "p2", "address": "tcp://p2"}]
+    assert delta["removed"] == ["p1"]
+    assert bus._members_delta(None) is None
+
+    for i in range(30):
+        bus._change_members({}, [])
+    assert bus._members_delta(1) is None
+
+def test_local_delivery_is_not_encoded(running_bus):
+    running_bus._metrics.enabled = True
+    received = []
+    running_bus.register_event_handler("valueChanged", lambda value_id, value: received.append(value), "v1")
+    running_bus.register_command_handler("setValue", lambda value: received.append(value))
+    running_bus.register_query_handler("getValue", lambda value: value)
+
+    # objects that no codec can encode reach local handlers unchanged
+    value = object()
+    running_bus.trigger_event("valueChanged", "v1", value)
+    running_bus.send_command("setValue", value)
+    assert running_bus.send_query("getValue", value) is value
+
+    for i in range(50):
+        if len(received) == 2:
+            break
+        time.sleep(.1)
+    assert received == [value, value]
+    assert running_bus.get_metrics()["topics"]["event:valueChanged"]["bytesOut"] == 0
+
+def test_local_handlers_share_the_arguments(running_bus):
+    received = []
+    running_bus.register_command_handler("setValues", lambda values, data: received.append((values, data)))
+    running_bus.register_query_handler("getValues", lambda values: values)
+
+    # arguments are passed by reference and bytes are not encoded
+    values = [1, 2]
+    running_bus.send_command("setValues", values, b"\x00\x01")
+    assert running_bus.send_query("getValues", values) is values
+
+    for i in range(50):
+        if received:
+            break
+        time.sleep(.1)
+    assert received[0][0] is values
+    assert received[0][1] == b"\x00\x01"
+
+def test_query_routing(bus):
+    sent = []
+    connection = ProcessConnection(bus)
+    connection.register("tcp://127.0.0.1:9999", "p1")
+    connection.is_connected = True
+    connection.ping()
+    connection.send_message = lambda tag, message, encoded=None: sent.append(("p1", tag))
+    bus._connections += [connection]
+    bus._deliver_local = lambda tag, message: sent.append(("test", tag))
+    bus.register_query_handler("getLocal", lambda: "local")
+
+    # handlers of the peer are unknown until its subscriptions are received
+    assert bus.get_query_processes("getValue") == ["p1"]
+
+    connection.update_subscriptions("p1-1", ["query:", "query:getValue"], True)
+    assert bus.get_query_processes("getValue") == ["p1"]
+    assert bus.get_query_processes("getLocal") == ["test"]
+    assert bus.get_query_processes("unknown") == []
+
+    # no process has a handler, the query completes at once
+    event = bus._send_query("unknown")
+    assert event["future"].result(0) == []
+    assert sent == []
+
+    bus._send_query("getValue")
+    assert sent == [("p1", b"query:getValue")]
+    del sent[:]
+    bus._send_query("getLocal")
+    assert sent == [("test", "query:getLocal")]
+    del sent[:]
+    bus._send_query("unknown", fanout=True)
+    assert sent == [("test", "query:unknown"), ("p1", b"query:unknown")]
+    bus._response_events = {}
+    connection.disconnect()
+
+def test_failed_query_completes(bus):
+    def send_message(tag, message, encoded=None):
+        raise ValueError("send failed")
+
+    connection = ProcessConnection(bus)
+    connection.register("tcp://127.0.0.1:9999", "p1")
+    connection.is_connected = True
+    connection.ping()
+    connection.update_subscriptions("p1-1", ["query:", "query:getValue"], True)
+    connection.send_message = send_message
+    bus._connections += [connection]
+
+    assert bus.send_query_async("getValue").result(0) == []
+    assert bus.send_query("getValue", timeout=1) == []
+    assert bus._response_events == {}
+    connection.disconnect()
+
+def test_reset_bus_does_not_share_connections(bus):
+    other = ZMQBus()
+    other.set_log("test")
+    other.reset_bus("other", 0, "127.0.0.1")
+
+    connection = ProcessConnection(bus)
+    connection.register("tcp://127.0.0.1:9999", "p1")
+    bus._connections += [connection]
+
+    assert other._connections == []
+    connection.disconnect()
+    other._context.destroy(linger=0)
+
+def test_has_event_subscribers(bus):
+    assert not bus.has_event_subscribers("valueChanged", "v1")
+    bus.register_event_handler("valueChanged", lambda value_id, value: None, "v1")
+    assert bus.has_event_subscribers("valueChanged", "v1")
+    assert not bus.has_event_subscribers("valueChanged", "v2")
+
+    connection = ProcessConnection(bus)
+    connection.register("tcp://127.0.0.1:9999", "p1")
+    bus._connections += [connection]
+    # the subscriptions of a process are unknown until its first ping
+    assert bus.has_event_subscribers("valueChanged", "v2")
+    connection.update_subscriptions("p1-1", ["event:valueChanged:"])
+    assert bus.has_event_subscribers("valueChanged", "v2")
+    assert not bus.has_event_subscribers("sensorChanged", "s1")
+    connection.disconnect()
+
+def test_bulk_lane_drops_oldest(bus):
+    bus._metrics.enabled = True
+    handler_thread = ZMQHandlerThread(bus, 2)
+    for i in range(4):
+        handler_thread.add_message("stream:cam:frame:", {"args": [i]}, b"data")
+
+    assert handler_thread.queue_length == 2
+    assert handler_thread.dropped == 2
+    assert handler_thread._messages.get_nowait()[1]["args"] == [2]
+    assert bus._metrics.as_dict()["stream:cam"]["dropped"] == 2
+
+def test_bulk_lane_blocks_local_sender(bus):
+    handler_thread = ZMQHandlerThread(bus, 2, .1)
+    for i in range(3):
+        handler_thread.add_message("stream:cam:frame:", {"args": [i]}, b"data", block=True)
+
+    # the third message waited for room and was dropped when none was made
+    assert handler_thread.queue_length == 2
+    assert handler_thread.dropped == 1
+    assert handler_thread._messages.get_nowait()[1]["args"] == [0]
+
+def test_local_streams_are_not_dropped(running_bus):
+    received = []
+    def on_frame(stream_id, stream_event, data):
+        time.sleep(.002)
+        received.append(bytes(data))
+    running_bus.register_stream_handler("cam", on_frame, "frame")
+
+    frames = [str(i).encode() for i in range(100)]
+    for frame in frames:
+        running_bus.stream_data("cam", "frame", frame)
+
+    for i in range(50):
+        if len(received) == len(frames):
+            break
+        time.sleep(.1)
+    assert received == frames
+    assert running_bus.get_metrics()["dropped"]["bulkQueues"] == 0
+
+def test_local_stream_data_is_a_memoryview_copy(running_bus):
+    received = []
+    running_bus.register_stream_handler("cam", lambda stream_id, stream_event, data: received.append(data), "frame")
+
+    frame = bytearray(b"frame")
+    running_bus.stream_data("cam", "frame", frame)
+    frame[:] = b"reuse"
+
+    for i in range(50):
+        if received:
+            break
+        time.sleep(.1)
+    assert isinstance(received[0], memoryview)
+    assert received[0].readonly
+    assert bytes(received[0]) == b"frame"
+
+def test_streams_use_bulk_lane(bus):
+    bus._add_message("stream:cam:frame:", {"args": []}, b"data")
+    bus._add_message("command:stop", {"args": []}, None)
+
+    assert sum(bus.get_handler_queue_lengths()) == 1
+    assert bus.get_metrics()["bulkQueues"] in ([1, 0], [0, 1])
+
+def test_connection_uses_ipc_endpoint(running_bus):
+    if not running_bus._ipc_address:
+        pytest.skip("ipc transport not available")
+    assert running_bus._ipc_reachable(running_bus._ipc_address, running_bus._host)
+    assert not running_bus._ipc_reachable(running_bus._ipc_address, "other-host")
+
+    connection = ProcessConnection(running_bus)
+    connection.register("tcp://127.0.0.1:9999", "p1")
+    connection.use_endpoint(running_bus._ipc_address)
+    assert connection.address == "tcp://127.0.0.1:9999"
+    assert connection.endpoint == running_bus._ipc_address
+    connection.disconnect()
+
+def test_stale_ipc_files_are_removed(tmp_path):
+    if not hasattr(socket, "AF_UNIX"):
+        pytest.skip("unix domain sockets not available")
+    stale_path = os.path.join(str(tmp_path), "kervi-stale")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(stale_path)
+    stale.close()
+
+    bus = ZMQBus({"ipc_dir": str(tmp_path)})
+    bus.set_log("test")
+    bus.reset_bus("test", nethelper.get_free_port([9860]), "127.0.0.1")
+    if not bus._ipc_address:
+        bus._context.destroy(linger=0)
+        pytest.skip("ipc transport not available")
+    bus.run()
+    ipc_path = bus._ipc_address[len("ipc://"):]
+    assert not os.path.exists(stale_path)
+    assert os.path.exists(ipc_path)
+
+    bus.stop()
+    assert not os.path.exists(ipc_path)
+
+def test_signal_port_taken(bus):
+    taken = socket.socket()
+    taken.bind(("127.0.0.1", 0))
+    taken.listen(1)
+    bus._is_root = False
+    bus._ipc_address = None
+    bus._signal_address = "tcp://127.0.0.1:" + str(taken.getsockname()[1])
+
+    signal_socket = bus._context.socket(zmq.SUB)
+    try:
+        addresses = bus._bind_signal(signal_socket)
+        assert addresses == [bus._signal_address]
+        assert bus._signal_address != "tcp://127.0.0.1:" + str(taken.getsockname()[1])
+    finally:
+        signal_socket.close()
+        taken.close()